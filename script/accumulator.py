@@ -0,0 +1,308 @@
+"""
+Online correlation power analysis.
+
+Instead of correlating a full hypothesis matrix with a full, pre-standardized traces matrix,
+running sums are kept over all traces seen so far:
+
+    n, sum(h), sum(h^2), sum(t), sum(t^2), sum(h*t)
+
+for each key byte and key guess. The Pearson correlation of any prefix of the traces can be
+computed from these sums at any time, so a whole guessing entropy vs. number of traces curve
+is obtained in a single pass over the data. Each prefix is standardized with its own
+statistics.
+"""
+from typing import List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+import kernel
+import leakage
+from instrumentation import stage
+from ranking import full_key_rank, key_ranks
+
+# GUESS_XOR_VALUE[k, v] = v xor k
+VALUES = np.arange(256)
+GUESS_XOR_VALUE = VALUES[np.newaxis, :] ^ VALUES[:, np.newaxis]
+# bytes of the hypotheses of a chunk converted to the dtype of an accumulator at once
+HYPOTHESES_BLOCK_BYTES = 1 << 26
+# traces multiplied at once in float32: 8192 * 8 * 255 < 2^24, so the products of hamming weight or distance
+# hypotheses and uint8 samples are exact integers
+FLOAT32_EXACT_ROWS = 1 << 13
+
+
+class CPAResult(NamedTuple):
+    """
+    State of an attack after n_traces traces.
+    :param int n_traces: number of traces the result is based on
+    :param np.ndarray key: best key guess for each key byte
+    :param np.ndarray samples: trace sample with the maximum correlation for each key byte
+    :param np.ndarray max_corr: maximum absolute correlation of each key guess, ( n_bytes, 256 )
+    :param np.ndarray ranks: rank of the correct key byte for each key byte, None if the key is unknown
+    :param float ge: guessing entropy ( mean of ranks ), None if the key is unknown
+    :param np.ndarray poi: trace samples the attack was restricted to, None if all samples were used
+    :param tuple key_rank: log2 of the lower bound, estimate and upper bound of the rank of the full key,
+                           None if the key is unknown
+    """
+    n_traces: int
+    key: np.ndarray
+    samples: np.ndarray
+    max_corr: np.ndarray
+    ranks: np.ndarray = None
+    ge: float = None
+    poi: np.ndarray = None
+    key_rank: Tuple[float, float, float] = None
+
+
+def concat_results(parts: List[CPAResult], correct_key: np.ndarray = None) -> CPAResult:
+    """
+    Join results of disjoint groups of key bytes over the same traces, in the given order.
+    The rank of the full key is estimated again if the correct key is given.
+    """
+    ranks, ge, key_rank = None, None, None
+    max_corr = np.concatenate([part.max_corr for part in parts])
+    if all(part.ranks is not None for part in parts):
+        ranks = np.concatenate([part.ranks for part in parts])
+        ge = float(np.mean(ranks))
+    if correct_key is not None:
+        key_rank = full_key_rank(max_corr, parts[0].n_traces, correct_key)
+    return CPAResult(parts[0].n_traces,
+                     np.concatenate([part.key for part in parts]),
+                     np.concatenate([part.samples for part in parts]),
+                     max_corr, ranks, ge, parts[0].poi, key_rank)
+
+
+def rank_result(result: CPAResult, correct_key: np.ndarray = None) -> CPAResult:
+    """ Returns the result with the ranks, guessing entropy and full key rank of the correct key, if given. """
+    if correct_key is None:
+        return result
+    with stage("guessing_entropy", result.max_corr.nbytes):
+        ranks = key_ranks(result.max_corr, correct_key)
+    with stage("key rank estimation", result.max_corr.nbytes):
+        key_rank = full_key_rank(result.max_corr, result.n_traces, correct_key)
+    return result._replace(ranks=ranks, ge=float(np.mean(ranks)), key_rank=key_rank)
+
+
+def split_result(result: CPAResult, n_parts: int, correct_keys: List[np.ndarray] = None) -> List[CPAResult]:
+    """
+    Split a result of n_parts stacked groups of key bytes of the same size ( e.g. of several
+    leakage models ) into the result of each group, ranked against its correct key if given.
+    """
+    parts = []
+    for i, rows in enumerate(np.array_split(np.arange(result.key.shape[0]), n_parts)):
+        part = CPAResult(result.n_traces, result.key[rows], result.samples[rows], result.max_corr[rows],
+                         poi=result.poi)
+        parts.append(rank_result(part, correct_keys[i] if correct_keys is not None else None))
+    return parts
+
+
+class CPAAccumulator:
+    """
+    Running sums needed to compute the correlation between hypotheses and traces.
+    :param int n_bytes: number of attacked key bytes
+    :param int trace_length: number of samples in a trace
+    :param int n_guesses: number of key guesses per key byte
+    :param dtype: dtype of the per-chunk intermediates, the sums are always kept in float64.
+                  float32 halves the memory of a chunk. Its products are computed over at most
+                  FLOAT32_EXACT_ROWS traces and added in float64, which is exact for hypotheses of
+                  at most 8 and uint8 samples whatever the chunk size, wider samples are rounded.
+    :param str backend: kernel computing sum(h*t) of a chunk, see kernel.BACKENDS
+    :param int n_threads: number of threads of the kernel, all cores if 0
+
+    The hypotheses of a chunk are converted to dtype in blocks of key bytes of at most HYPOTHESES_BLOCK_BYTES,
+    so stacking many leakage models ( see cpa.find_key_models ) does not multiply the memory of a chunk.
+    """
+    def __init__(self, n_bytes: int, trace_length: int, n_guesses: int = 256, dtype=np.float64,
+                 backend: str = "numpy", n_threads: int = 0):
+        if backend not in kernel.BACKENDS:
+            raise ValueError("Unknown correlation backend.")
+        self.n_bytes = n_bytes
+        self.trace_length = trace_length
+        self.n_guesses = n_guesses
+        self.dtype = dtype
+        self.backend = backend
+        self.n_threads = n_threads
+        self.n = 0
+        self.sum_h = np.zeros((n_bytes, n_guesses))
+        self.sum_h2 = np.zeros((n_bytes, n_guesses))
+        self.sum_t = np.zeros(trace_length)
+        self.sum_t2 = np.zeros(trace_length)
+        self.sum_ht = np.zeros((n_bytes, n_guesses, trace_length))
+
+    def update(self, hypotheses: np.ndarray, traces: np.ndarray):
+        """
+        Add a chunk of traces to the sums.
+
+        Sizes:
+        Hypotheses : ( n_bytes, chunk_len, n_guesses )
+        Traces     : ( chunk_len, trace_length )
+        """
+        with stage("accumulate", hypotheses.nbytes + traces.nbytes):
+            t = traces.astype(self.dtype)
+            self.n += t.shape[0]
+            self.sum_t += np.sum(t, axis=0, dtype=np.float64)
+            self.sum_t2 += np.sum(t * t, axis=0, dtype=np.float64)
+            block = max(HYPOTHESES_BLOCK_BYTES // max(hypotheses[0].size * np.dtype(self.dtype).itemsize, 1), 1)
+            rows = t.shape[0] if np.dtype(self.dtype).itemsize >= 8 else FLOAT32_EXACT_ROWS
+            for start in range(0, hypotheses.shape[0], block):
+                stop = min(start + block, hypotheses.shape[0])
+                h = hypotheses[start:stop].astype(self.dtype)
+                self.sum_h[start:stop] += np.sum(h, axis=1, dtype=np.float64)
+                self.sum_h2[start:stop] += np.sum(h * h, axis=1, dtype=np.float64)
+                for row_start in range(0, t.shape[0], rows):
+                    row_stop = row_start + rows
+                    self.sum_ht[start:stop] += kernel.products(h[:, row_start:row_stop], t[row_start:row_stop],
+                                                               self.backend, self.n_threads)
+
+    def merge(self, other: "CPAAccumulator"):
+        """ Add the sums of another accumulator over a disjoint set of traces. """
+        self.n += other.n
+        self.sum_h += other.sum_h
+        self.sum_h2 += other.sum_h2
+        self.sum_t += other.sum_t
+        self.sum_t2 += other.sum_t2
+        self.sum_ht += other.sum_ht
+
+    def correlation(self, byte_idx: int) -> np.ndarray:
+        """
+        Returns the absolute correlation matrix ( n_guesses, trace_length ) of a key byte
+        over all traces seen so far. Constant hypotheses or samples have zero correlation.
+        """
+        with stage("correlation", self.sum_ht[byte_idx].nbytes, byte_idx):
+            n = self.n
+            numerator = n * self.sum_ht[byte_idx] - np.outer(self.sum_h[byte_idx], self.sum_t)
+            h_dev = np.sqrt(np.maximum(n * self.sum_h2[byte_idx] - self.sum_h[byte_idx] ** 2, 0))
+            t_dev = np.sqrt(np.maximum(n * self.sum_t2 - self.sum_t ** 2, 0))
+            denominator = np.outer(h_dev, t_dev)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                correlation_matrix = np.where(denominator > 0, numerator / denominator, 0.0)
+            return np.abs(correlation_matrix)
+
+    def result(self, correct_key: np.ndarray = None) -> CPAResult:
+        """
+        Returns the best key, the samples of maximum correlation and, if the correct key
+        is known, the rank of each correct key byte and the guessing entropy.
+        """
+        max_corr = np.zeros((self.n_bytes, self.n_guesses))
+        key = np.zeros(self.n_bytes, dtype=np.uint8)
+        samples = np.zeros(self.n_bytes, dtype=np.int64)
+        for i in range(self.n_bytes):
+            correlation_matrix = self.correlation(i)
+            with stage("find_max", correlation_matrix.nbytes, i):
+                key[i], samples[i] = np.unravel_index(np.argmax(correlation_matrix), correlation_matrix.shape)
+                max_corr[i] = np.max(correlation_matrix, axis=1)
+        return rank_result(CPAResult(self.n, key, samples, max_corr), correct_key)
+
+
+def class_sums(classes: np.ndarray, traces: np.ndarray, n_classes: int = 256) -> np.ndarray:
+    """
+    Returns the sum of the traces of each class, ( n_classes, trace_length ).
+    The traces are sorted by their class, so every class is reduced in one np.add.reduceat pass.
+    """
+    sums = np.zeros((n_classes, traces.shape[1]))
+    if classes.size == 0:
+        return sums
+    order = np.argsort(classes, kind="stable")
+    sorted_classes = classes[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_classes[1:] != sorted_classes[:-1])))
+    sums[sorted_classes[starts]] = np.add.reduceat(traces[order].astype(np.float64), starts, axis=0)
+    return sums
+
+
+class PartitionedAccumulator(CPAAccumulator):
+    """
+    Correlation power analysis on traces reduced to per byte-value class sums.
+
+    The first round hypothesis of a trace depends only on its plaintext byte, so
+    sum(h*t) of a key guess k is M[k] @ A, where A[v] is the sum of the traces with plaintext
+    byte v and M[k, v] = HW( sbox[ v xor k ] ). For the last round hamming distance model
+    HW( x xor y ) = sum_j x_j + y_j - 2 x_j y_j, with x = sboxinv[ c[b] xor k ] and y = c[shiftrowinv[b]],
+    so the class sums of the traces by c[b] and by c[b] restricted to each set bit j of y are sufficient.
+    After the accumulation, the cost of the correlation does not depend on the number of traces.
+    :param str attack_mode: lrnd or frnd
+    :param list byte_indices: attacked key bytes
+    :param int trace_length: number of samples in a trace
+    """
+    def __init__(self, attack_mode: str, byte_indices: Sequence[int], trace_length: int):
+        if attack_mode not in leakage.ATTACK_MODES:
+            raise ValueError("Unknown attack mode.")
+        super().__init__(len(byte_indices), trace_length)
+        self.attack_mode = attack_mode
+        self.byte_indices = np.asarray(byte_indices)
+        self.class_sums = np.zeros((self.n_bytes, 256, trace_length))
+        if attack_mode == "lrnd":
+            # class sums restricted to the traces where bit j of the shifted ciphertext byte is set
+            self.bit_class_sums = np.zeros((self.n_bytes, 8, 256, trace_length))
+            # number of traces of each ( c[b], c[shiftrowinv[b]] ) pair
+            self.class_counts = np.zeros((self.n_bytes, 256, 256))
+        else:
+            self.class_counts = np.zeros((self.n_bytes, 256))
+        self.reduced = np.ones(self.n_bytes, dtype=bool)
+
+    def update(self, texts: np.ndarray, traces: np.ndarray):
+        """
+        Add a chunk of traces to the class sums.
+
+        Sizes:
+        Texts  : ( chunk_len, 16 ) plaintexts for frnd, ciphertexts for lrnd
+        Traces : ( chunk_len, trace_length )
+        """
+        with stage("accumulate partitioned", texts.nbytes + traces.nbytes):
+            self._update(texts, traces)
+
+    def _update(self, texts: np.ndarray, traces: np.ndarray):
+        t = traces.astype(np.float64)
+        self.n += t.shape[0]
+        self.sum_t += np.sum(t, axis=0)
+        self.sum_t2 += np.sum(t * t, axis=0)
+        for i, byte_idx in enumerate(self.byte_indices):
+            values = texts[:, byte_idx]
+            self.class_sums[i] += class_sums(values, t)
+            if self.attack_mode == "lrnd":
+                shifted = texts[:, leakage.ShiftRowInverse[byte_idx]]
+                self.class_counts[i] += np.bincount(values.astype(np.int64) * 256 + shifted,
+                                                    minlength=256 * 256).reshape(256, 256)
+                for j in range(8):
+                    bit_set = (shifted >> j) & 1 == 1
+                    self.bit_class_sums[i, j] += class_sums(values[bit_set], t[bit_set])
+            else:
+                self.class_counts[i] += np.bincount(values, minlength=256)
+        self.reduced[:] = False
+
+    def merge(self, other: "PartitionedAccumulator"):
+        """ Add the class sums of another accumulator over a disjoint set of traces. """
+        self.n += other.n
+        self.sum_t += other.sum_t
+        self.sum_t2 += other.sum_t2
+        self.class_sums += other.class_sums
+        self.class_counts += other.class_counts
+        if self.attack_mode == "lrnd":
+            self.bit_class_sums += other.bit_class_sums
+        self.reduced[:] = False
+
+    def reduce(self, i: int):
+        """ Compute sum(h), sum(h^2) and sum(h*t) of the i-th attacked key byte from its class sums. """
+        with stage("reduce partitions", self.class_sums[i].nbytes, i):
+            self._reduce(i)
+
+    def _reduce(self, i: int):
+        if self.attack_mode == "lrnd":
+            # D[v, x] = sum_w counts[v, w] * HD[x, w], sum(h)[k] = sum_x D[x ^ k, x]
+            distances = leakage.InvSBoxHammingDistance.astype(np.float64)
+            self.sum_h[i] = np.sum((self.class_counts[i] @ distances.T)[GUESS_XOR_VALUE, VALUES], axis=1)
+            self.sum_h2[i] = np.sum((self.class_counts[i] @ (distances ** 2).T)[GUESS_XOR_VALUE, VALUES], axis=1)
+            state9 = leakage.SBoxInverse[GUESS_XOR_VALUE]
+            sum_y = np.sum(self.bit_class_sums[i], axis=(0, 1))
+            self.sum_ht[i] = leakage.HammingWeight[state9].astype(np.float64) @ self.class_sums[i] + sum_y
+            for j in range(8):
+                self.sum_ht[i] -= 2 * ((state9 >> j) & 1).astype(np.float64) @ self.bit_class_sums[i, j]
+        else:
+            weights = leakage.SBoxHammingWeight[GUESS_XOR_VALUE].astype(np.float64)
+            self.sum_h[i] = weights @ self.class_counts[i]
+            self.sum_h2[i] = (weights ** 2) @ self.class_counts[i]
+            self.sum_ht[i] = weights @ self.class_sums[i]
+        self.reduced[i] = True
+
+    def correlation(self, byte_idx: int) -> np.ndarray:
+        if not self.reduced[byte_idx]:
+            self.reduce(byte_idx)
+        return super().correlation(byte_idx)
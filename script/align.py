@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Alignment of jittery traces by FFT cross-correlation.
+
+The shift of every trace is the lag of the maximum of its cross-correlation with a reference
+trace over a window of samples, computed for a whole chunk of traces at once with real FFTs.
+The traces are shifted back ( the samples moved in from outside the trace repeat its edge )
+and written to a new traces.bin, the plaintexts and ciphertexts are copied next to it,
+so the aligned capture is attacked like any other.
+The reference is the mean of the first traces after aligning them to their own mean once.
+Chunks are read from the memory mapped traces and can be aligned by a process pool.
+"""
+import os
+import shutil
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import numpy as np
+
+from instrumentation import stage
+from measurement import Measurement, open_capture
+from simulate import DEFAULT_CIPHERTEXT_NAME, DEFAULT_PLAINTEXT_NAME, DEFAULT_TRACES_NAME, write_hex_lines
+
+
+def estimate_shifts(traces: np.ndarray, reference: np.ndarray, window: Tuple[int, int],
+                    max_shift: int) -> np.ndarray:
+    """
+    Returns the shift of every trace relative to the reference, in [ -max_shift, max_shift ]:
+    trace[ j + shift ] matches reference[ j ] over the window.
+
+    Sizes:
+    Traces    : ( chunk_len, trace_length )
+    Reference : ( trace_length, )
+    """
+    start, stop = window
+    # the window of the traces is extended by max_shift, so every lag sees whole reference samples
+    padded_start, padded_stop = max(start - max_shift, 0), min(stop + max_shift, traces.shape[1])
+    segments = traces[:, padded_start:padded_stop].astype(np.float64)
+    segments -= np.mean(segments, axis=1, keepdims=True)
+    template = reference[start:stop] - np.mean(reference[start:stop])
+    # linear correlation of the zero padded signals, index lag % n_fft is the lag
+    n_fft = 1 << int(np.ceil(np.log2(segments.shape[1] + template.shape[0])))
+    spectrum = np.fft.rfft(segments, n_fft, axis=1) * np.conj(np.fft.rfft(template, n_fft))
+    correlation = np.fft.irfft(spectrum, n_fft, axis=1)
+    lags = np.arange(-max_shift, max_shift + 1)
+    # lag relative to the padded start
+    best = np.argmax(correlation[:, (lags + start - padded_start) % n_fft], axis=1)
+    return lags[best]
+
+
+def apply_shifts(traces: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """ Returns the traces with aligned[ i, j ] = traces[ i, j + shifts[i] ], edge samples are repeated. """
+    samples = np.clip(np.arange(traces.shape[1]) + shifts[:, np.newaxis], 0, traces.shape[1] - 1)
+    return np.take_along_axis(traces, samples, axis=1)
+
+
+def build_reference(measurement: Measurement, window: Tuple[int, int], max_shift: int,
+                    n_reference: int = 1000) -> np.ndarray:
+    """
+    Mean of the first n_reference traces, aligned once to their plain mean. The aligned traces are
+    centered on their median shift, so the shifts of the traces relative to the reference are centered too.
+    """
+    traces = np.asarray(measurement.traces[:min(n_reference, measurement.cnt)])
+    reference = np.mean(traces, axis=0)
+    shifts = estimate_shifts(traces, reference, window, max_shift)
+    return np.mean(apply_shifts(traces, shifts - int(np.median(shifts))), axis=0)
+
+
+def align_chunk(measurement: Measurement, start: int, stop: int, reference: np.ndarray,
+                window: Tuple[int, int], max_shift: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Returns the aligned traces start to stop and their shifts. """
+    with stage("align", (stop - start) * measurement.trace_length):
+        traces = np.asarray(measurement.traces[start:stop])
+        shifts = estimate_shifts(traces, reference, window, max_shift)
+        return apply_shifts(traces, shifts), shifts
+
+
+def align(measurement: Measurement, out_dir: str, window: Tuple[int, int] = None, max_shift: int = 16,
+          n_reference: int = 1000, chunk_size: int = 8192, workers: int = 1) -> Measurement:
+    """
+    Align the traces of a measurement and write them with its plaintexts and ciphertexts to out_dir.
+    :param tuple window: samples [ start, stop ) compared with the reference, the whole trace if not given
+    :param int max_shift: largest shift searched in both directions
+    :param int n_reference: number of traces averaged into the reference
+    :param int chunk_size: number of traces aligned at once
+    :param int workers: number of processes aligning the chunks
+    Returns the aligned measurement.
+    """
+    if window is None:
+        window = (0, measurement.trace_length)
+    if not 0 <= window[0] < window[1] <= measurement.trace_length:
+        raise ValueError("The alignment window is outside of the traces.")
+    if os.path.abspath(os.path.join(out_dir, DEFAULT_TRACES_NAME)) == os.path.abspath(str(measurement.trace_path)):
+        raise ValueError("The aligned traces would overwrite the traces being aligned.")
+    reference = build_reference(measurement, window, max_shift, n_reference)
+    os.makedirs(out_dir, exist_ok=True)
+    shift_counts = np.zeros(2 * max_shift + 1, dtype=np.int64)
+    chunks = [ (start, min(start + chunk_size, measurement.cnt)) for start in range(0, measurement.cnt, chunk_size) ]
+
+    with open(os.path.join(out_dir, DEFAULT_TRACES_NAME), 'wb') as trace_file:
+        def write(aligned: np.ndarray, shifts: np.ndarray):
+            trace_file.write(aligned.astype(measurement.trace_dtype).tobytes())
+            shift_counts[:] += np.bincount(shifts + max_shift, minlength=shift_counts.shape[0])
+
+        if workers <= 1:
+            for start, stop in chunks:
+                write(*align_chunk(measurement, start, stop, reference, window, max_shift))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # chunks are written in order, a bounded number of them in flight
+                pending = deque()
+                for start, stop in chunks:
+                    pending.append(pool.submit(align_chunk, measurement, start, stop, reference, window, max_shift))
+                    if len(pending) >= 2 * workers:
+                        write(*pending.popleft().result())
+                while pending:
+                    write(*pending.popleft().result())
+
+    for path, texts, name in ((measurement.plaintext_path, measurement.plaintexts, DEFAULT_PLAINTEXT_NAME),
+                              (measurement.ciphertext_path, measurement.ciphertexts, DEFAULT_CIPHERTEXT_NAME)):
+        if path is None:
+            # a concatenated measurement has no single text file
+            with open(os.path.join(out_dir, name), 'wb') as file:
+                write_hex_lines(file, texts)
+        else:
+            shutil.copyfile(path, os.path.join(out_dir, name))
+    shifts = np.arange(-max_shift, max_shift + 1)
+    mean_abs_shift = np.sum(np.abs(shifts) * shift_counts) / max(measurement.cnt, 1)
+    print(f"Aligned {measurement.cnt} traces, mean absolute shift {mean_abs_shift:.2f} samples")
+    if shift_counts[0] + shift_counts[-1] > 0.01 * measurement.cnt:
+        print(f"Warning: {shift_counts[0] + shift_counts[-1]} traces are shifted by the maximum of "
+              f"{max_shift} samples, the maximum shift may be too small.")
+    return open_capture(out_dir, measurement.encryption_key, measurement.trace_dtype)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Not enough arguments: python3 align.py /path/to/capture_dir /path/to/out_dir "
+              "[window_start window_stop] [max_shift] [workers]")
+        exit()
+    measurement = open_capture(sys.argv[1])
+    window = (int(sys.argv[3]), int(sys.argv[4])) if len(sys.argv) >= 5 else None
+    max_shift = int(sys.argv[5]) if len(sys.argv) >= 6 else 16
+    workers = int(sys.argv[6]) if len(sys.argv) >= 7 else 1
+    align(measurement, sys.argv[2], window, max_shift, workers=workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Averaging of the traces of repeated plaintexts ( or ciphertexts ).
+
+Captures of the same plaintexts are grouped and every group is replaced by its mean trace,
+which divides the number of traces the attack has to touch by the repeat factor and raises
+the SNR of every remaining trace. The groups are found with a single np.unique over the
+16 byte texts, then the traces are read group by group in chunks of about chunk_size rows,
+so the memory does not depend on the size of the capture.
+Several capture directories can be merged on the way ( see ConcatenatedMeasurement ).
+"""
+import os
+import sys
+
+import numpy as np
+
+from accumulator import class_sums
+from measurement import ConcatenatedMeasurement, Measurement, open_capture
+from simulate import DEFAULT_CIPHERTEXT_NAME, DEFAULT_PLAINTEXT_NAME, DEFAULT_TRACES_NAME, write_hex_lines
+
+GROUP_BY = [ "plaintext", "ciphertext" ]
+
+
+def group_texts(texts: np.ndarray):
+    """
+    Returns the index of the first row of each distinct text ( sorted by text ),
+    the group of every row and the number of rows in each group.
+    """
+    keys = np.ascontiguousarray(texts).view(np.dtype((np.void, texts.shape[1]))).ravel()
+    _, first_rows, groups, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    return first_rows, groups.ravel(), counts
+
+
+def average_by_text(measurement: Measurement, out_dir: str, group_by: str = "plaintext",
+                    trace_dtype = np.uint8, chunk_size: int = 65536) -> Measurement:
+    """
+    Write the mean trace of every distinct plaintext ( ciphertext ) of a measurement to out_dir
+    with its plaintext and ciphertext, and return the averaged measurement.
+    :param str group_by: plaintext or ciphertext
+    :param trace_dtype: sample type of the averaged traces, uint8 rounds the means,
+                        float32 keeps them exactly ( open the result with trace_dtype=np.float32 )
+    :param int chunk_size: approximate number of traces read at once
+    """
+    if group_by not in GROUP_BY:
+        raise ValueError("Unknown text to group by.")
+    texts = measurement.plaintexts if group_by == "plaintext" else measurement.ciphertexts
+    first_rows, groups, counts = group_texts(texts)
+    # rows of the measurement ordered by group, and the first of them of every group
+    order = np.argsort(groups, kind="stable")
+    group_starts = np.concatenate(([0], np.cumsum(counts)))
+    os.makedirs(out_dir, exist_ok=True)
+
+    with open(os.path.join(out_dir, DEFAULT_PLAINTEXT_NAME), 'wb') as pt_file, \
+         open(os.path.join(out_dir, DEFAULT_CIPHERTEXT_NAME), 'wb') as ct_file, \
+         open(os.path.join(out_dir, DEFAULT_TRACES_NAME), 'wb') as trace_file:
+        first_group = 0
+        while first_group < counts.shape[0]:
+            # whole groups of about chunk_size traces
+            last_group = max(int(np.searchsorted(group_starts, group_starts[first_group] + chunk_size, side='right')) - 1,
+                             first_group + 1)
+            rows = order[group_starts[first_group]:group_starts[last_group]]
+            # rows are read in file order
+            read_order = np.argsort(rows)
+            chunk = np.empty((rows.shape[0], measurement.trace_length), dtype=measurement.trace_dtype)
+            chunk[read_order] = measurement.traces[rows[read_order]]
+            sums = class_sums(groups[rows] - first_group, chunk, last_group - first_group)
+            means = sums / counts[first_group:last_group, np.newaxis]
+            if np.dtype(trace_dtype).kind in "ui":
+                means = np.rint(means)
+            trace_file.write(means.astype(trace_dtype).tobytes())
+            write_hex_lines(pt_file, measurement.plaintexts[first_rows[first_group:last_group]])
+            write_hex_lines(ct_file, measurement.ciphertexts[first_rows[first_group:last_group]])
+            first_group = last_group
+
+    print(f"Averaged {measurement.cnt} traces into {counts.shape[0]} traces of distinct {group_by}s "
+          f"(mean repeat factor {measurement.cnt / counts.shape[0]:.1f})")
+    return open_capture(out_dir, measurement.encryption_key, trace_dtype)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Not enough arguments: python3 average.py /path/to/out_dir /path/to/capture_dir "
+              "[/path/to/capture_dir ...]")
+        print("Averages the traces of the same plaintexts of all capture directories into out_dir.")
+        exit()
+    out_dir = sys.argv[1]
+    captures = [ open_capture(capture_dir) for capture_dir in sys.argv[2:] ]
+    measurement = captures[0] if len(captures) == 1 else ConcatenatedMeasurement(captures)
+    average_by_text(measurement, out_dir)
+
+
+if __name__ == "__main__":
+    main()
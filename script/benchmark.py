@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the CPA pipeline on synthetic measurements.
+
+For every number of traces and attack mode a measurement is simulated ( see simulate.py ),
+then each stage of the attack is timed separately and the whole find_key_sweep is timed for
+every engine and number of workers. Wall time, throughput ( traces/s ) and the peak resident memory
+of every stage are reported, with the memory mapped pages of the traces it touched. Worker processes
+are reported separately by the peak of the largest worker so far. Every correlation backend ( see kernel.py )
+is checked against the reference correlate of cpa.py first.
+"""
+import json
+import os
+import shutil
+import sys
+import resource
+import tempfile
+from glob import glob
+from time import perf_counter
+from typing import List
+
+import numpy as np
+
+import kernel
+import leakage
+from accumulator import CPAAccumulator
+from cpa import (ENGINES, attacked_key, build_hamm_distance_mtx, build_hamming_weight_mtx, build_hypothesis,
+                 build_traces_mtx, correlate, find_key_sweep)
+from ranking import key_ranks
+from measurement import Measurement
+from simulate import simulate
+
+
+def reset_peak_rss():
+    """ Reset the peak resident memory of the process to its current size, possible on Linux only. """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def measure(stage: str, n_traces: int, function, *args, **kwargs) -> dict:
+    """
+    Run function and return its wall time, throughput, the peak resident memory of the process
+    during the run ( since the start of the process where it cannot be reset ) and of the largest
+    worker process so far.
+    """
+    reset_peak_rss()
+    start = perf_counter()
+    function(*args, **kwargs)
+    seconds = perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    return { "stage": stage, "n_traces": n_traces, "seconds": seconds,
+             "traces_per_second": n_traces / seconds if seconds > 0 else float("inf"),
+             "peak_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+             "worker_peak_mib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 }
+
+
+def open_measurement(measurement: Measurement) -> Measurement:
+    """ Open a measurement again and load its plaintexts and ciphertexts. """
+    reopened = Measurement(measurement.plaintext_path, measurement.ciphertext_path,
+                           measurement.trace_path, measurement.encryption_key)
+    reopened.plaintexts, reopened.ciphertexts
+    return reopened
+
+
+def build_all_hypotheses(measurement: Measurement, attack_mode: str, chunk_size: int):
+    texts = measurement.ciphertexts if attack_mode == "lrnd" else measurement.plaintexts
+    for start in range(0, measurement.cnt, chunk_size):
+        leakage.hypotheses(texts[start:start+chunk_size], attack_mode)
+
+
+def accumulate(accumulator: CPAAccumulator, hypotheses: list, measurement: Measurement, chunk_size: int):
+    for i, start in enumerate(range(0, measurement.cnt, chunk_size)):
+        accumulator.update(hypotheses[i], measurement.traces[start:start+chunk_size])
+
+
+def benchmark_stages(measurement: Measurement, attack_mode: str, chunk_size: int = 1024) -> List[dict]:
+    """ Time the stages of a single attack on a measurement. """
+    n = measurement.cnt
+    rows = []
+    for cache in glob(os.path.join(os.path.dirname(measurement.plaintext_path), ".*.npy")):
+        os.remove(cache)
+    rows.append(measure("open (parse text)", n, open_measurement, measurement))
+    rows.append(measure("open (cached)", n, open_measurement, measurement))
+    rows.append(measure("hypotheses", n, build_all_hypotheses, measurement, attack_mode, chunk_size))
+
+    texts = measurement.ciphertexts if attack_mode == "lrnd" else measurement.plaintexts
+    hypotheses = [ leakage.hypotheses(texts[start:start+chunk_size], attack_mode)
+                   for start in range(0, n, chunk_size) ]
+    accumulator = CPAAccumulator(measurement.key_length, measurement.trace_length)
+    rows.append(measure("accumulate", n, accumulate, accumulator, hypotheses, measurement, chunk_size))
+    del hypotheses
+    rows.append(measure("result", n, accumulator.result, attacked_key(measurement, attack_mode)))
+    return rows
+
+
+def check_backends(measurement: Measurement, attack_mode: str, n_traces: int = 0) -> List[str]:
+    """
+    Run find_key_sweep with every available backend in float64 and float32 and compare its key and ranks
+    with the correlation of the whole standardized traces matrix by correlate.
+    Returns the backends and dtypes that found a different key or ranks.
+    """
+    if n_traces == 0 or n_traces > measurement.cnt:
+        n_traces = measurement.cnt
+    correct_key = attacked_key(measurement, attack_mode)
+    std_traces = build_traces_mtx(measurement, n_traces)
+    reference_key = np.zeros(measurement.key_length, dtype=np.uint8)
+    max_corr = np.zeros((measurement.key_length, 256))
+    for byte_idx in range(measurement.key_length):
+        if attack_mode == "lrnd":
+            hamming = build_hamm_distance_mtx(measurement.ciphertexts, n_traces, byte_idx)
+        else:
+            hamming = build_hamming_weight_mtx(build_hypothesis(measurement, byte_idx, n_traces)).astype(np.float64)
+        correlation = correlate(hamming, std_traces)
+        max_corr[byte_idx] = np.max(correlation, axis=1)
+        reference_key[byte_idx] = np.argmax(max_corr[byte_idx])
+    reference_ranks = key_ranks(max_corr, correct_key) if correct_key is not None else None
+
+    mismatches = []
+    for backend in kernel.available_backends():
+        for dtype in (np.float64, np.float32):
+            result = find_key_sweep(measurement, measurement.key_length, [n_traces], attack_mode=attack_mode,
+                                    dtype=dtype, backend=backend)[-1]
+            if (not np.array_equal(result.key, reference_key)
+                    or (reference_ranks is not None and not np.array_equal(result.ranks, reference_ranks))):
+                mismatches.append(f"{backend} {np.dtype(dtype).name}")
+    return mismatches
+
+
+def benchmark_find_key(measurement: Measurement, attack_mode: str, workers_list: List[int]) -> List[dict]:
+    """ Time the whole attack for every engine and number of workers. """
+    rows = []
+    for engine in ENGINES:
+        for workers in workers_list:
+            rows.append(measure(f"find_key {engine} x{workers}", measurement.cnt, find_key_sweep,
+                                measurement, measurement.key_length, [measurement.cnt],
+                                attack_mode=attack_mode, workers=workers, engine=engine))
+    return rows
+
+
+def run_benchmark(sizes: List[int], attack_modes: List[str] = leakage.ATTACK_MODES,
+                  workers_list: List[int] = None, trace_length: int = 256,
+                  work_dir: str = None) -> List[dict]:
+    """
+    Simulate a measurement of each size and attack mode in work_dir ( a temporary directory
+    if not given ) and benchmark it with every number of workers in workers_list ( 1 if not given ).
+    """
+    if workers_list is None:
+        workers_list = [ 1 ]
+    temporary = work_dir is None
+    if temporary:
+        work_dir = tempfile.mkdtemp(prefix="cpa_benchmark_")
+    rows = []
+    try:
+        for attack_mode in attack_modes:
+            for n_traces in sizes:
+                measurement = simulate(os.path.join(work_dir, f"{attack_mode}_{n_traces}"), n_traces,
+                                       trace_length=trace_length, leakage_model=attack_mode)
+                mismatches = check_backends(measurement, attack_mode)
+                if mismatches:
+                    print(f"Backends differing from correlate on {n_traces} {attack_mode} traces: {', '.join(mismatches)}")
+                for row in (benchmark_stages(measurement, attack_mode)
+                            + benchmark_find_key(measurement, attack_mode, workers_list)):
+                    row["attack_mode"] = attack_mode
+                    print_row(row)
+                    rows.append(row)
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir)
+    return rows
+
+
+def print_row(row: dict):
+    print(f"{row['attack_mode']:<5} {row['n_traces']:>9} {row['stage']:<28} {row['seconds']:>9.3f} s "
+          f"{row['traces_per_second']:>12.0f} traces/s {row['peak_mib']:>9.1f} MiB "
+          f"{row['worker_peak_mib']:>9.1f} MiB workers")
+
+
+def main():
+    sizes = [ int(size) for size in sys.argv[1:] ] if len(sys.argv) > 1 else [ 5000, 20000 ]
+    workers_list = sorted({ 1, min(16, os.cpu_count() or 1) })
+    rows = run_benchmark(sizes, workers_list=workers_list)
+    with open("benchmark.json", "w") as file:
+        json.dump(rows, file, indent=1)
+    print("Results written to benchmark.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Bootstrapped guessing entropy curves.
+
+The guessing entropy after n traces of a single attack depends on which traces were used.
+Here the attack is repeated on R random subsets of the traces ( drawn without replacement ),
+each resample is a single pass over its subset with results at every number of traces,
+and the mean guessing entropy is reported with a confidence interval of the mean and
+the percentile band of the single attacks.
+The resamples run concurrently on a process pool. The measurement is pickled without its
+memory maps ( see Measurement.__getstate__ ), so every worker maps the same files and the
+traces are loaded only once, into the page cache.
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from statistics import NormalDist
+from time import time
+from typing import List, NamedTuple
+
+import numpy as np
+
+import leakage
+from accumulator import PartitionedAccumulator
+from cpa import ENGINES, attacked_key, new_accumulator
+from measurement import Measurement
+
+
+class BootstrapGE(NamedTuple):
+    """
+    n_traces: numbers of traces of the curve
+    ge: guessing entropy of every resample at every number of traces, ( n_resamples, len(n_traces) )
+    mean: mean guessing entropy over the resamples
+    lower, upper: confidence interval of the mean
+    band_lower, band_upper: percentiles of the guessing entropy of a single attack
+    """
+    n_traces: np.ndarray
+    ge: np.ndarray
+    mean: np.ndarray
+    lower: np.ndarray
+    upper: np.ndarray
+    band_lower: np.ndarray
+    band_upper: np.ndarray
+
+
+def resample_ge(measurement: Measurement, resample: int, n_traces: List[int], attack_mode: str,
+                engine: str, chunk_size: int, seed: int) -> np.ndarray:
+    """
+    Attack a random subset of max( n_traces ) traces and return the guessing entropy after each
+    number of traces in ( sorted ) n_traces. The subset of a resample depends only on seed and resample.
+    """
+    rng = np.random.default_rng([seed, resample])
+    subset = rng.choice(measurement.cnt, n_traces[-1], replace=False)
+    texts = measurement.ciphertexts if attack_mode == "lrnd" else measurement.plaintexts
+    byte_indices = list(range(measurement.key_length))
+    searched_key = attacked_key(measurement, attack_mode)
+    accumulator = new_accumulator(engine, attack_mode, byte_indices, measurement.trace_length)
+    ge = np.zeros(len(n_traces))
+    done = 0
+    for i, checkpoint in enumerate(n_traces):
+        for start in range(done, checkpoint, chunk_size):
+            # the order of the traces within a chunk does not change the sums, sorted rows are read faster
+            rows = np.sort(subset[start:min(start + chunk_size, checkpoint)])
+            if isinstance(accumulator, PartitionedAccumulator):
+                accumulator.update(texts[rows], measurement.traces[rows])
+            else:
+                accumulator.update(leakage.hypotheses(texts[rows], attack_mode, byte_indices),
+                                   measurement.traces[rows])
+        done = checkpoint
+        ge[i] = accumulator.result(searched_key).ge
+    return ge
+
+
+def bootstrap_ge(measurement: Measurement, n_traces: List[int], n_resamples: int = 50,
+                 attack_mode: str = "lrnd", engine: str = "partitioned", workers: int = 1,
+                 confidence: float = 0.95, chunk_size: int = 1024, seed: int = 0,
+                 timer: bool = False) -> BootstrapGE:
+    """
+    Estimate the guessing entropy curve over n_resamples random subsets of the traces.
+    :param list n_traces: numbers of traces of the curve, at most the number of traces of the measurement
+    :param int n_resamples: number of random subsets ( attacks )
+    :param str attack_mode: lrnd for last round attack, frnd for first round attack
+    :param str engine: direct or partitioned correlation ( see find_key_sweep )
+    :param int workers: number of processes running the resamples
+    :param float confidence: level of the confidence interval and the percentile band
+    :param int seed: seed of the random subsets
+    """
+    if measurement.encryption_key is None:
+        raise ValueError("The encryption key of the measurement is needed for the guessing entropy.")
+    if attack_mode not in leakage.ATTACK_MODES:
+        raise ValueError("Unknown attack mode.")
+    if engine not in ENGINES:
+        raise ValueError("Unknown CPA engine.")
+    n_traces = sorted(set(min(n, measurement.cnt) for n in n_traces))
+    if timer == True: start_time = time()
+
+    arguments = (repeat(measurement), range(n_resamples), repeat(n_traces), repeat(attack_mode),
+                 repeat(engine), repeat(chunk_size), repeat(seed))
+    if workers <= 1:
+        ge = np.array(list(map(resample_ge, *arguments)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            ge = np.array(list(pool.map(resample_ge, *arguments)))
+
+    mean = np.mean(ge, axis=0)
+    # normal approximation of the distribution of the mean
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    half_width = z * np.std(ge, axis=0, ddof=1) / np.sqrt(n_resamples) if n_resamples > 1 else np.zeros_like(mean)
+    tail = (1 - confidence) / 2 * 100
+    band_lower, band_upper = np.percentile(ge, [tail, 100 - tail], axis=0)
+    if timer == True:
+        print(f"Bootstrap of {n_resamples} attacks took: {time() - start_time:0.0f} seconds")
+    return BootstrapGE(np.array(n_traces), ge, mean, np.maximum(mean - half_width, 0), mean + half_width,
+                       band_lower, band_upper)
+
+
+def print_bootstrap_ge(bootstrap: BootstrapGE):
+    print(f"{'n_traces':>9} {'mean GE':>9} {'CI low':>9} {'CI high':>9} {'band low':>9} {'band high':>9}")
+    for row in zip(bootstrap.n_traces, bootstrap.mean, bootstrap.lower, bootstrap.upper,
+                   bootstrap.band_lower, bootstrap.band_upper):
+        print(f"{row[0]:>9} " + " ".join(f"{value:>9.2f}" for value in row[1:]))
+
+
+def plot_bootstrap_ge(bootstrap: BootstrapGE):
+    import matplotlib.pyplot as plt
+    plt.fill_between(bootstrap.n_traces, bootstrap.band_lower, bootstrap.band_upper, color='red', alpha=0.15,
+                     label="single attack")
+    plt.fill_between(bootstrap.n_traces, bootstrap.lower, bootstrap.upper, color='red', alpha=0.4,
+                     label="confidence interval of the mean")
+    plt.plot(bootstrap.n_traces, bootstrap.mean, color='red', linewidth=1, label="mean")
+    plt.xlabel("Number of traces")
+    plt.ylabel("Guessing entropy")
+    plt.title(f"Guessing entropy vs number of traces ({bootstrap.ge.shape[0]} resamples)")
+    plt.legend()
+    plt.grid(True)
+    plt.show()
+
+
+def main():
+    if len(sys.argv) < 5:
+        print("Not enough arguments: python3 bootstrap.py plaintexts.txt ciphertexts.txt traces.bin key_hex "
+              "[lrnd|frnd] [n_resamples] [workers] [step]")
+        exit()
+    measurement = Measurement(plaintext=sys.argv[1], ciphertext=sys.argv[2], trace=sys.argv[3],
+                              encryption_key=list(bytes.fromhex(sys.argv[4])))
+    attack_mode = sys.argv[5] if len(sys.argv) >= 6 else "lrnd"
+    n_resamples = int(sys.argv[6]) if len(sys.argv) >= 7 else 50
+    workers = int(sys.argv[7]) if len(sys.argv) >= 8 else 1
+    step = int(sys.argv[8]) if len(sys.argv) >= 9 else 500
+    bootstrap = bootstrap_ge(measurement, range(step, measurement.cnt + 1, step), n_resamples,
+                             attack_mode, workers=workers, timer=True)
+    print_bootstrap_ge(bootstrap)
+    plot_bootstrap_ge(bootstrap)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Batch runner of attack campaigns over many captures.
+
+A campaign file is JSON:
+
+    {
+        "store": "results/store",
+        "workers": 4,
+        "report": "campaign_report.jsonl",
+        "defaults": { "modes": [ "lrnd" ], "n_traces": [ 0 ], "models": [], "engine": "partitioned",
+                      "backend": "numpy", "threads": 0 },
+        "datasets": [
+            { "path": "../traces/test150k_pt02", "key": "7D266AECB153B4D5D6B171A58136605B",
+              "n_traces": [ 10000, 50000, 150000 ], "models": [ "lrnd_state9", "lrnd_ct_distance" ] },
+            { "path": "../traces/test570k_mixpt.cpa", "modes": [ "lrnd", "frnd" ] }
+        ]
+    }
+
+Every dataset is a capture directory or a dataset file, its keys override the defaults,
+n_traces 0 is all traces of the dataset, backend and threads select the correlation kernel of the
+direct engine and its number of threads ( see kernel.py ). The jobs of a dataset are the plain attack of
+each attack mode and the attack with each leakage model, a model named like one of the modes is its plain
+attack. All jobs of a dataset run in a single sweep over its n_traces ( see store.stored_sweeps ), so the traces
+are read once and every number of traces reuses the accumulators of the previous one.
+The datasets are spread over a pool of workers, the workers left over when there are fewer datasets
+than workers split the key bytes of every dataset. Results are written to the result store
+( see store.py ), so an interrupted campaign resumes where it stopped, and a line with the result
+and the timing of every job is appended to the report.
+"""
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+from typing import List
+
+from cpa import ENGINES
+from dataset import open_measurement
+from store import ResultStore, stored_sweeps
+import kernel
+import leakage
+
+DEFAULTS = { "modes": [ "lrnd" ], "n_traces": [ 0 ], "models": [], "engine": "partitioned", "key": None,
+             "backend": "numpy", "threads": 0 }
+
+
+def load_campaign(path: str) -> dict:
+    """ Returns the campaign of a campaign file with the defaults applied to every dataset, after checking it. """
+    with open(path) as file:
+        campaign = json.load(file)
+    defaults = { **DEFAULTS, **campaign.get("defaults", {}) }
+    campaign["datasets"] = [ { **defaults, **dataset } for dataset in campaign["datasets"] ]
+    for dataset in campaign["datasets"]:
+        if "path" not in dataset:
+            raise ValueError("A dataset of the campaign has no path.")
+        for attack_mode in dataset["modes"]:
+            if attack_mode not in leakage.ATTACK_MODES:
+                raise ValueError("Unknown attack mode.")
+        for model in dataset["models"]:
+            if model not in leakage.LEAKAGE_MODELS:
+                raise ValueError(f"Unknown leakage model '{model}'.")
+        # a model named like a mode is the plain attack of the mode
+        dataset["models"] = [ model for model in dict.fromkeys(dataset["models"]) if model not in dataset["modes"] ]
+        if dataset["engine"] not in ENGINES:
+            raise ValueError("Unknown CPA engine.")
+        if dataset["backend"] not in kernel.BACKENDS:
+            raise ValueError("Unknown correlation backend.")
+    campaign.setdefault("store", "results/store")
+    campaign.setdefault("workers", 1)
+    campaign.setdefault("report", os.path.splitext(path)[0] + "_report.jsonl")
+    return campaign
+
+
+def job_record(dataset: dict, fingerprint: str, attack_mode: str, model: str, results: list, seconds: float) -> dict:
+    """ Report line of a job: the result at its largest number of traces and the time it took. """
+    result = results[-1]
+    return { "dataset": dataset["path"], "fingerprint": fingerprint, "mode": attack_mode, "model": model,
+             "n_traces": [ r.n_traces for r in results ], "ge": [ r.ge for r in results ],
+             "key": bytes(result.key).hex().upper(),
+             "log2_key_rank": result.key_rank[1] if result.key_rank is not None else None,
+             "seconds": seconds, "traces_per_second": result.n_traces / seconds if seconds > 0 else None }
+
+
+def run_dataset(dataset: dict, store_root: str, chunk_size: int = 1024, workers: int = 1) -> List[dict]:
+    """
+    Run all jobs of a dataset in a single sweep on one opened measurement and return their report lines,
+    every line reports the time of the whole sweep.
+    :param int workers: number of processes the key bytes of the dataset are split over
+    """
+    encryption_key = list(bytes.fromhex(dataset["key"])) if dataset["key"] else None
+    measurement = open_measurement(dataset["path"], encryption_key)
+    store = ResultStore(store_root)
+    fingerprint = store.register(measurement)
+    checkpoints = [ n if n > 0 else measurement.cnt for n in dataset["n_traces"] ]
+    start_time = time()
+    all_results = stored_sweeps(measurement, store, checkpoints, dataset["modes"], dataset["models"],
+                                dataset["engine"], chunk_size, backend=dataset["backend"],
+                                n_threads=dataset["threads"], workers=workers)
+    seconds = time() - start_time
+    return [ job_record(dataset, fingerprint, leakage.LEAKAGE_MODELS[model].attack_mode, model, results, seconds)
+             for model, results in all_results.items() ]
+
+
+def print_record(record: dict):
+    ge = f"{record['ge'][-1]:7.2f}" if record["ge"][-1] is not None else f"{'-':>7}"
+    print(f"{record['dataset']:<40} {record['model']:<18} {record['n_traces'][-1]:>8} {ge} "
+          f"{record['seconds']:>8.1f} s  {record['key']}")
+
+
+def run_campaign(campaign: dict, chunk_size: int = 1024) -> List[dict]:
+    """
+    Run the jobs of all datasets of a campaign on campaign["workers"] processes, appending the report line
+    of every job to campaign["report"] as soon as its dataset is done. The datasets run on a pool of at most
+    one process per dataset, the workers left over are given to the sweeps of every dataset.
+    """
+    dataset_workers = max(min(campaign["workers"], len(campaign["datasets"])), 1)
+    sweep_workers = max(campaign["workers"] // dataset_workers, 1)
+    records = []
+    with open(campaign["report"], 'a') as report:
+        def write(dataset_records: List[dict]):
+            for record in dataset_records:
+                report.write(json.dumps(record) + "\n")
+                print_record(record)
+            report.flush()
+            records.extend(dataset_records)
+
+        if dataset_workers == 1:
+            for dataset in campaign["datasets"]:
+                try:
+                    write(run_dataset(dataset, campaign["store"], chunk_size, sweep_workers))
+                except Exception as error:
+                    print(f"Dataset {dataset['path']} failed: {error}")
+        else:
+            with ProcessPoolExecutor(max_workers=dataset_workers) as pool:
+                futures = { pool.submit(run_dataset, dataset, campaign["store"], chunk_size, sweep_workers): dataset
+                            for dataset in campaign["datasets"] }
+                for future in as_completed(futures):
+                    try:
+                        write(future.result())
+                    except Exception as error:
+                        # a broken dataset does not stop the rest of the campaign
+                        print(f"Dataset {futures[future]['path']} failed: {error}")
+    return records
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Not enough arguments: python3 campaign.py campaign.json [workers]")
+        exit()
+    campaign = load_campaign(sys.argv[1])
+    if len(sys.argv) >= 3:
+        campaign["workers"] = int(sys.argv[2])
+    start_time = time()
+    records = run_campaign(campaign)
+    print(f"Campaign of {len(records)} jobs took: {time() - start_time:0.0f} seconds, report in {campaign['report']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from time import time
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import os
 
 import numpy as np
@@ -8,51 +10,20 @@ from colorama import Fore, Style
 from aeskeyschedule import reverse_key_schedule, key_schedule
 
 from measurement import Measurement
+from accumulator import CPAAccumulator, CPAResult, PartitionedAccumulator, concat_results, split_result
+from leakage import SBox, ShiftRowInverse, HammingWeight
+import kernel
+import leakage
+from poi import find_poi
+from instrumentation import stage
+from enumeration import search_key
+
+ENGINES = [ "direct", "partitioned" ]
 
 def hex_to_int(hex_str: str) -> int:
     return int(hex_str, 16)
 
 
-SBox = np.array([
-    0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67, 0x2B, 0xFE, 0xD7, 0xAB, 0x76,
-    0xCA, 0x82, 0xC9, 0x7D, 0xFA, 0x59, 0x47, 0xF0, 0xAD, 0xD4, 0xA2, 0xAF, 0x9C, 0xA4, 0x72, 0xC0,
-    0xB7, 0xFD, 0x93, 0x26, 0x36, 0x3F, 0xF7, 0xCC, 0x34, 0xA5, 0xE5, 0xF1, 0x71, 0xD8, 0x31, 0x15,
-    0x04, 0xC7, 0x23, 0xC3, 0x18, 0x96, 0x05, 0x9A, 0x07, 0x12, 0x80, 0xE2, 0xEB, 0x27, 0xB2, 0x75,
-    0x09, 0x83, 0x2C, 0x1A, 0x1B, 0x6E, 0x5A, 0xA0, 0x52, 0x3B, 0xD6, 0xB3, 0x29, 0xE3, 0x2F, 0x84,
-    0x53, 0xD1, 0x00, 0xED, 0x20, 0xFC, 0xB1, 0x5B, 0x6A, 0xCB, 0xBE, 0x39, 0x4A, 0x4C, 0x58, 0xCF,
-    0xD0, 0xEF, 0xAA, 0xFB, 0x43, 0x4D, 0x33, 0x85, 0x45, 0xF9, 0x02, 0x7F, 0x50, 0x3C, 0x9F, 0xA8,
-    0x51, 0xA3, 0x40, 0x8F, 0x92, 0x9D, 0x38, 0xF5, 0xBC, 0xB6, 0xDA, 0x21, 0x10, 0xFF, 0xF3, 0xD2,
-    0xCD, 0x0C, 0x13, 0xEC, 0x5F, 0x97, 0x44, 0x17, 0xC4, 0xA7, 0x7E, 0x3D, 0x64, 0x5D, 0x19, 0x73,
-    0x60, 0x81, 0x4F, 0xDC, 0x22, 0x2A, 0x90, 0x88, 0x46, 0xEE, 0xB8, 0x14, 0xDE, 0x5E, 0x0B, 0xDB,
-    0xE0, 0x32, 0x3A, 0x0A, 0x49, 0x06, 0x24, 0x5C, 0xC2, 0xD3, 0xAC, 0x62, 0x91, 0x95, 0xE4, 0x79,
-    0xE7, 0xC8, 0x37, 0x6D, 0x8D, 0xD5, 0x4E, 0xA9, 0x6C, 0x56, 0xF4, 0xEA, 0x65, 0x7A, 0xAE, 0x08,
-    0xBA, 0x78, 0x25, 0x2E, 0x1C, 0xA6, 0xB4, 0xC6, 0xE8, 0xDD, 0x74, 0x1F, 0x4B, 0xBD, 0x8B, 0x8A,
-    0x70, 0x3E, 0xB5, 0x66, 0x48, 0x03, 0xF6, 0x0E, 0x61, 0x35, 0x57, 0xB9, 0x86, 0xC1, 0x1D, 0x9E,
-    0xE1, 0xF8, 0x98, 0x11, 0x69, 0xD9, 0x8E, 0x94, 0x9B, 0x1E, 0x87, 0xE9, 0xCE, 0x55, 0x28, 0xDF,
-    0x8C, 0xA1, 0x89, 0x0D, 0xBF, 0xE6, 0x42, 0x68, 0x41, 0x99, 0x2D, 0x0F, 0xB0, 0x54, 0xBB, 0x16
-    ], dtype='uint8')
-
-
-ShiftRowInverse = np.array([ 0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11 ], dtype=np.uint8)
-SBoxInverse = np.array(
-            [0x52 ,0x09 ,0x6A ,0xD5 ,0x30 ,0x36 ,0xA5 ,0x38 ,0xBF ,0x40 ,0xA3 ,0x9E ,0x81 ,0xF3 ,0xD7 ,0xFB
-            ,0x7C ,0xE3 ,0x39 ,0x82 ,0x9B ,0x2F ,0xFF ,0x87 ,0x34 ,0x8E ,0x43 ,0x44 ,0xC4 ,0xDE ,0xE9 ,0xCB
-            ,0x54 ,0x7B ,0x94 ,0x32 ,0xA6 ,0xC2 ,0x23 ,0x3D ,0xEE ,0x4C ,0x95 ,0x0B ,0x42 ,0xFA ,0xC3 ,0x4E
-            ,0x08 ,0x2E ,0xA1 ,0x66 ,0x28 ,0xD9 ,0x24 ,0xB2 ,0x76 ,0x5B ,0xA2 ,0x49 ,0x6D ,0x8B ,0xD1 ,0x25
-            ,0x72 ,0xF8 ,0xF6 ,0x64 ,0x86 ,0x68 ,0x98 ,0x16 ,0xD4 ,0xA4 ,0x5C ,0xCC ,0x5D ,0x65 ,0xB6 ,0x92
-            ,0x6C ,0x70 ,0x48 ,0x50 ,0xFD ,0xED ,0xB9 ,0xDA ,0x5E ,0x15 ,0x46 ,0x57 ,0xA7 ,0x8D ,0x9D ,0x84
-            ,0x90 ,0xD8 ,0xAB ,0x00 ,0x8C ,0xBC ,0xD3 ,0x0A ,0xF7 ,0xE4 ,0x58 ,0x05 ,0xB8 ,0xB3 ,0x45 ,0x06
-            ,0xD0 ,0x2C ,0x1E ,0x8F ,0xCA ,0x3F ,0x0F ,0x02 ,0xC1 ,0xAF ,0xBD ,0x03 ,0x01 ,0x13 ,0x8A ,0x6B
-            ,0x3A ,0x91 ,0x11 ,0x41 ,0x4F ,0x67 ,0xDC ,0xEA ,0x97 ,0xF2 ,0xCF ,0xCE ,0xF0 ,0xB4 ,0xE6 ,0x73
-            ,0x96 ,0xAC ,0x74 ,0x22 ,0xE7 ,0xAD ,0x35 ,0x85 ,0xE2 ,0xF9 ,0x37 ,0xE8 ,0x1C ,0x75 ,0xDF ,0x6E
-            ,0x47 ,0xF1 ,0x1A ,0x71 ,0x1D ,0x29 ,0xC5 ,0x89 ,0x6F ,0xB7 ,0x62 ,0x0E ,0xAA ,0x18 ,0xBE ,0x1B
-            ,0xFC ,0x56 ,0x3E ,0x4B ,0xC6 ,0xD2 ,0x79 ,0x20 ,0x9A ,0xDB ,0xC0 ,0xFE ,0x78 ,0xCD ,0x5A ,0xF4
-            ,0x1F ,0xDD ,0xA8 ,0x33 ,0x88 ,0x07 ,0xC7 ,0x31 ,0xB1 ,0x12 ,0x10 ,0x59 ,0x27 ,0x80 ,0xEC ,0x5F
-            ,0x60 ,0x51 ,0x7F ,0xA9 ,0x19 ,0xB5 ,0x4A ,0x0D ,0x2D ,0xE5 ,0x7A ,0x9F ,0x93 ,0xC9 ,0x9C ,0xEF
-            ,0xA0 ,0xE0 ,0x3B ,0x4D ,0xAE ,0x2A ,0xF5 ,0xB0 ,0xC8 ,0xEB ,0xBB ,0x3C ,0x83 ,0x53 ,0x99 ,0x61
-            ,0x17 ,0x2B ,0x04 ,0x7E ,0xBA ,0x77 ,0xD6 ,0x26 ,0xE1 ,0x69 ,0x14 ,0x63 ,0x55 ,0x21 ,0x0C ,0x7D],
-            dtype=np.uint8)
-
 def build_hypothesis(measurement: Measurement, byte_idx: int, n_traces: int = 0) -> np.ndarray:
     """
     Build a hypothesis matrix for a single byte of the key by reversing the last round of AES and
@@ -61,14 +32,15 @@ def build_hypothesis(measurement: Measurement, byte_idx: int, n_traces: int = 0)
     k[j] = j-th possible key byte
     H[i,j] = sbox[ p[i] xor k[j] ]
     """
-    # Load plaintext column
-    pt_col = np.loadtxt(measurement.plaintext_path, usecols=byte_idx, converters=hex_to_int, dtype=np.uint8)
-    if n_traces != 0:
-        pt_col = pt_col[:n_traces]
-    # Generate hypothesis matrix
-    key_guess = np.arange(256, dtype=np.uint8)
-    pt_xor = pt_col[:, np.newaxis] ^ key_guess
-    hypothesis_matrix = SBox[pt_xor]
+    with stage("build_hypothesis", key_byte=byte_idx):
+        # Load plaintext column
+        pt_col = measurement.plaintexts[:, byte_idx]
+        if n_traces != 0:
+            pt_col = pt_col[:n_traces]
+        # Generate hypothesis matrix
+        key_guess = np.arange(256, dtype=np.uint8)
+        pt_xor = pt_col[:, np.newaxis] ^ key_guess
+        hypothesis_matrix = SBox[pt_xor]
 
     return hypothesis_matrix
 
@@ -76,38 +48,22 @@ def build_hamming_weight_mtx(hypothesis_matrix: np.ndarray) -> np.ndarray:
     """
     Build a hamming weight matrix for a hypothesis matrix.
     """
-    hamming_weight_matrix = np.zeros(hypothesis_matrix.shape, dtype=np.uint8)
-    for i in range(hypothesis_matrix.shape[0]):
-        for j in range(hypothesis_matrix.shape[1]):
-            hamming_weight_matrix[i, j] = bin(hypothesis_matrix[i, j]).count("1")
-    return hamming_weight_matrix
-
-def hamm_weight(hex_num : int) -> int:
-    """ Calculate the hamming weight of a number """
-    return bin(hex_num).count("1")
-
-def hamm_distance(ciphertext_row: np.array, byte_idx: int, keyguess: int):
-    byte_idx_shifted = ShiftRowInverse[byte_idx]
-    state10 = ciphertext_row[byte_idx_shifted]
-
-    AddRoundKeyByte = keyguess ^ ciphertext_row[byte_idx]
-    state9 = SBoxInverse[AddRoundKeyByte]
-    # hamming_weight of xorred values is their hamming distance
-    return hamm_weight(state9 ^ state10)
+    with stage("build_hamming_weight_mtx", hypothesis_matrix.nbytes):
+        return HammingWeight[hypothesis_matrix]
 
 def build_hamm_distance_mtx(ct, n_traces: int, byte_idx: int):
     """
     Since bytes will be rearranged within rows, the entire row of ciphertext must be read
     """
-    mtx = np.zeros((n_traces, 256))
-    # ct_row = ct[trace, :] 
-    for trace in range(n_traces):
-        for keyguess in range(256):
-            mtx[trace, keyguess] = hamm_distance(ct[trace, :], byte_idx, keyguess)
-    return mtx
+    with stage("build_hamm_distance_mtx", key_byte=byte_idx):
+        ct_rows = ct[:n_traces, :]
+        ct_xor = ct_rows[:, byte_idx, np.newaxis] ^ leakage.KEY_GUESSES
+        state10 = ct_rows[:, ShiftRowInverse[byte_idx], np.newaxis]
+        return leakage.InvSBoxHammingDistance[ct_xor, state10].astype(np.float64)
 
 
-def correlate(hamming_mtx: np.ndarray, std_traces_mtx: np.ndarray) -> np.ndarray:
+def correlate(hamming_mtx: np.ndarray, std_traces_mtx: np.ndarray, chunk_size: int = 0,
+              backend: str = "numpy") -> np.ndarray:
     """
     Build a correlation matrix from a hamming weight matrix (a,b) and a standardized traces matrix.
     
@@ -120,122 +76,337 @@ def correlate(hamming_mtx: np.ndarray, std_traces_mtx: np.ndarray) -> np.ndarray
     Standardization partially calculates the correlation matrix ( subtracts the mean and divides by the standard deviation ),
     so speeds up the calculation.
     The second matrix is the traces matrix, which is going to be reused for all key bytes, therefore it is standardized beforehand.
+    With a non-zero chunk_size the product is accumulated over row chunks, so the traces matrix can be a memory map.
+    backend selects the kernel of the product ( see kernel.py ).
     """
-    hamming = ((hamming_mtx - np.mean(hamming_mtx, axis=0)) # standardize hamming matrix
-                            / np.std(hamming_mtx, axis=0))
-    correlation_matrix = ( hamming.T @ std_traces_mtx ) / hamming.shape[0] # complete the correlation calculation
-    correlation_matrix = np.abs(correlation_matrix)
+    with stage("correlate", hamming_mtx.nbytes + std_traces_mtx.nbytes):
+        hamming = ((hamming_mtx - np.mean(hamming_mtx, axis=0)) # standardize hamming matrix
+                                / np.std(hamming_mtx, axis=0)).astype(std_traces_mtx.dtype)
+        if chunk_size == 0:
+            chunk_size = hamming.shape[0]
+        correlation_matrix = np.zeros((hamming.shape[1], std_traces_mtx.shape[1]))
+        for start in range(0, hamming.shape[0], chunk_size):
+            stop = start + chunk_size
+            correlation_matrix += kernel.products(hamming[np.newaxis, start:stop], std_traces_mtx[start:stop], backend)[0]
+        correlation_matrix /= hamming.shape[0] # complete the correlation calculation
+        correlation_matrix = np.abs(correlation_matrix)
     return correlation_matrix
 
 
 def find_max(correlation_matrix: np.ndarray):
     """ Returns key byte and trace sample (time of leakage) with the maximum correlation."""
-    max_in_flattened = np.argmax(correlation_matrix)
-    max_indices = np.unravel_index(max_in_flattened, correlation_matrix.shape)
+    with stage("find_max", correlation_matrix.nbytes):
+        max_in_flattened = np.argmax(correlation_matrix)
+        max_indices = np.unravel_index(max_in_flattened, correlation_matrix.shape)
     return max_indices
 
 
-def build_traces_mtx(measurement: Measurement) -> np.ndarray:
-    traces_matrix = (np.fromfile(measurement.trace_path, dtype=np.uint8). # load traces
-                     reshape(-1, measurement.trace_length))
+def trace_stats(traces: np.ndarray, chunk_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the mean and standard deviation of each trace sample, computed in two passes over
+    row chunks, so only one chunk of the traces is held in memory as floats at a time.
+    """
+    n_traces = traces.shape[0]
+    total = np.zeros(traces.shape[1])
+    for start in range(0, n_traces, chunk_size):
+        total += np.sum(traces[start:start+chunk_size], axis=0, dtype=np.float64)
+    mean = total / n_traces
+    squared_deviations = np.zeros(traces.shape[1])
+    for start in range(0, n_traces, chunk_size):
+        deviation = traces[start:start+chunk_size] - mean
+        squared_deviations += np.sum(deviation * deviation, axis=0)
+    return mean, np.sqrt(squared_deviations / n_traces)
+
+def build_traces_mtx(measurement: Measurement, n_traces: int = 0, dtype=np.float64,
+                     chunk_size: int = 65536) -> np.ndarray:
+    """
+    Standardize the first n_traces traces ( all if 0 ) using their own statistics.
+    The traces are streamed from the memory mapped trace file in row chunks.
+    """
+    traces_matrix = measurement.traces
+    if n_traces != 0:
+        traces_matrix = traces_matrix[:n_traces, :]
     # slice traces matrix to the relevant part
     # traces_matrix = traces_matrix[:, 64:110]
-    standardized_traces = ((traces_matrix - np.mean(traces_matrix, axis=0)) # standardize traces to save time
-                           / np.std(traces_matrix, axis=0))
+    with stage("build_traces_mtx", traces_matrix.nbytes):
+        mean, std = trace_stats(traces_matrix, chunk_size)
+        standardized_traces = np.empty(traces_matrix.shape, dtype=dtype)
+        for start in range(0, traces_matrix.shape[0], chunk_size): # standardize traces to save time
+            stop = start + chunk_size
+            standardized_traces[start:stop] = (traces_matrix[start:stop] - mean) / std
     print(f"Full traces mtx shape: {standardized_traces.shape}")
     return standardized_traces
 
-def find_idx_in_arr ( arr, key ):
-    for i, element in enumerate(arr):
-        if element[0] == key:
-            return i
-
-def guessing_entropy(correlation_matrix, processed_byte_idx, correct_key):
-        """
-        In each row of the correlation matrix (each of the key estimates), the maximum
-        and the index of the row where the maximum is located (key estimate) are found.
-        These maximum correlations are sorted in descending order, and it is determined
-        which one in the sequence is the real key, in terms of the computed correlation.
-        """
-        # array containing key guess and its correlation
-        key_corr_arr = []
-        # for each row of correlation matrix find the maximum value and its index
-        for (key_guess, row) in enumerate(correlation_matrix):
-            # whole row index is a key guess, index of max value
-            # within the row is the moment of the leakage
-            max_corr_of_guess = np.max(row)
-            key_corr_arr.append([key_guess, max_corr_of_guess])
-        # sort by correlations, descending
-        key_corr_arr.sort(key=lambda x: x[1], reverse=True)
-        place_of_correct_key = find_idx_in_arr(key_corr_arr, correct_key[processed_byte_idx])
-        print(f"Byte guessing entropy: {place_of_correct_key}/{correlation_matrix.shape[0]}")
-        return place_of_correct_key
-        
+def attacked_key(measurement: Measurement, attack_mode: str) -> np.ndarray:
+    """
+    Returns the key the attack is searching for: the encryption key for the first round attack,
+    the last round key for the last round attack, None if the encryption key is unknown.
+    """
+    return searched_key(measurement.encryption_key, attack_mode)
 
-def find_key(measurement: Measurement, key_length_in_bytes, n_traces: int = 0,
-              attack_mode: str = "lrnd", timer: bool = False ) -> Tuple[np.ndarray, str, int]:
+def searched_key(encryption_key, attack_mode: str) -> np.ndarray:
+    """ Returns the key an attack with attack_mode searches for under an encryption key, see attacked_key. """
+    if encryption_key is None:
+        return None
+    if attack_mode == "lrnd":
+        byte_array = key_schedule(bytes(encryption_key))[10]
+        return np.array([int(byte) for byte in byte_array], dtype=np.uint8)
+    return np.array(encryption_key, dtype=np.uint8)
+
+def new_accumulator(engine: str, attack_mode: str, byte_indices: List[int], trace_length: int,
+                    dtype=np.float64, backend: str = "numpy", n_threads: int = 0) -> CPAAccumulator:
+    """ Returns an empty accumulator of the engine for the key bytes in byte_indices. """
+    if engine == "partitioned":
+        return PartitionedAccumulator(attack_mode, byte_indices, trace_length)
+    return CPAAccumulator(len(byte_indices), trace_length, dtype=dtype, backend=backend, n_threads=n_threads)
+
+def accumulate_traces(accumulator: CPAAccumulator, measurement: Measurement, attack_mode: str,
+                      byte_indices: List[int], start: int, stop: int, chunk_size: int,
+                      poi: np.ndarray = None):
     """
-    Return the key and its guessing entropy based on the maximum correlation for each byte of the key.
+    Add the traces start to stop of the measurement to the accumulator in chunks of chunk_size rows.
+    If poi is given, only these trace samples are added.
+    """
+    traces = measurement.traces
+    texts = measurement.ciphertexts if attack_mode == "lrnd" else measurement.plaintexts
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        traces_chunk = traces[chunk_start:chunk_stop] if poi is None else traces[chunk_start:chunk_stop][:, poi]
+        if isinstance(accumulator, PartitionedAccumulator):
+            accumulator.update(texts[chunk_start:chunk_stop], traces_chunk)
+        else:
+            accumulator.update(leakage.hypotheses(texts[chunk_start:chunk_stop], attack_mode, byte_indices),
+                               traces_chunk)
+
+def sweep_key_bytes(measurement: Measurement, byte_indices: List[int], checkpoints: List[int],
+                    attack_mode: str, chunk_size: int, dtype, engine: str = "direct",
+                    poi: np.ndarray = None, backend: str = "numpy", n_threads: int = 0) -> List[CPAResult]:
+    """
+    Attack the key bytes in byte_indices in a single pass over the traces and return
+    the result after each number of traces in ( sorted ) checkpoints.
+    If poi is given, only these trace samples are correlated.
+    """
+    searched_key = attacked_key(measurement, attack_mode)
+    if searched_key is not None:
+        searched_key = searched_key[byte_indices]
+
+    trace_length = measurement.trace_length if poi is None else len(poi)
+    accumulator = new_accumulator(engine, attack_mode, byte_indices, trace_length, dtype, backend, n_threads)
+    results = []
+    done = 0
+    for checkpoint in checkpoints:
+        accumulate_traces(accumulator, measurement, attack_mode, byte_indices, done, checkpoint, chunk_size, poi)
+        done = max(done, checkpoint)
+        result = accumulator.result(searched_key)
+        if poi is not None:
+            # report samples of the full traces
+            result = result._replace(samples=poi[result.samples], poi=poi)
+        results.append(result)
+    return results
+
+def find_key_sweep(measurement: Measurement, key_length_in_bytes, checkpoints: List[int],
+                   attack_mode: str = "lrnd", timer: bool = False,
+                   chunk_size: int = 1024, dtype=np.float64, workers: int = 1,
+                   engine: str = "direct", poi: np.ndarray = None, n_poi: int = 0,
+                   backend: str = "numpy", n_threads: int = 0) -> List[CPAResult]:
+    """
+    Run the attack in a single pass over the traces and return its result after each
+    number of traces in checkpoints.
+    The traces are streamed from the memory mapped trace file in chunks of chunk_size rows,
+    so the peak memory is set by the chunk size, not by the file size.
+    dtype selects the precision of the per-chunk intermediates ( float32 or float64 ).
+    With workers > 1 the key bytes are split into groups attacked by a process pool,
+    every worker memory maps the same files, so the traces are shared through the page cache.
+    engine "direct" correlates the hypotheses with the traces of every chunk, engine "partitioned"
+    only sums the traces per plaintext ( ciphertext ) byte value, which makes the cost of
+    the correlation independent of the number of traces ( see PartitionedAccumulator ).
+    poi restricts the attack to the given trace samples, with n_poi > 0 the n_poi samples with
+    the highest SNR over the attacked traces are selected automatically.
+    backend selects the kernel of the direct engine ( see kernel.py ), "auto" benchmarks the available ones,
+    n_threads is the number of threads of the kernel in every process ( all cores if 0 ).
     """
-    if attack_mode not in [ "lrnd", "frnd" ]:
+    if attack_mode not in leakage.ATTACK_MODES:
         raise ValueError("Unknown attack mode.")
-    
+    if engine not in ENGINES:
+        raise ValueError("Unknown CPA engine.")
+
     if timer == True: start_time = time()
 
-    standardized_traces = build_traces_mtx(measurement)
-    if n_traces != 0:
-        standardized_traces = standardized_traces[:n_traces, :]
-    key_arr = np.zeros(key_length_in_bytes, dtype=np.uint8)
+    checkpoints = sorted(set(min(n, measurement.cnt) for n in checkpoints))
+    if poi is None and n_poi > 0:
+        poi = find_poi(measurement, attack_mode, n_poi, n_traces=checkpoints[-1])
+    byte_groups = [ list(group) for group in np.array_split(np.arange(key_length_in_bytes),
+                                                            min(max(workers, 1), key_length_in_bytes)) ]
+    if len(byte_groups) == 1:
+        results = sweep_key_bytes(measurement, byte_groups[0], checkpoints, attack_mode, chunk_size, dtype,
+                                  engine, poi, backend, n_threads)
+    else:
+        with ProcessPoolExecutor(max_workers=len(byte_groups)) as pool:
+            group_results = list(pool.map(sweep_key_bytes, repeat(measurement), byte_groups, repeat(checkpoints),
+                                          repeat(attack_mode), repeat(chunk_size), repeat(dtype), repeat(engine),
+                                          repeat(poi), repeat(backend), repeat(n_threads)))
+        # results of all byte groups at each checkpoint, in the order of the key bytes
+        searched_key = attacked_key(measurement, attack_mode)
+        results = [ concat_results(parts, searched_key) for parts in zip(*group_results) ]
 
-    searched_key = measurement.encryption_key
-    if attack_mode == "lrnd":
-        ct_mtx = np.loadtxt(measurement.ciphertext_path,
-                            converters=hex_to_int, dtype=np.uint8)
-        if n_traces != 0:
-            ct_mtx = ct_mtx[:n_traces, :]
-        
-        byte_array = key_schedule(bytes(measurement.encryption_key))[10]
-        int_list = [int(byte) for byte in byte_array]
-        searched_key = np.array(int_list, dtype=np.uint8)                
-
-    # guessing entropies of each subkey byte
-    byte_guessing_entropies = []
-
-    for i in range(key_length_in_bytes):
-        if attack_mode == "lrnd":
-            if n_traces == 0:
-                n_traces = measurement.cnt
-            hamm_mtx = build_hamm_distance_mtx(ct_mtx, n_traces, i)
-        elif attack_mode == "frnd":
-            hamm_mtx = build_hamming_weight_mtx(build_hypothesis(measurement, i, n_traces))
-
-        correlation_matrix = correlate(hamm_mtx, standardized_traces)
-        key_byte, tracesample_with_max_corr = find_max(correlation_matrix)
-        
-        # If the real encryption key is known, calculate the guessing entropy
-        if measurement.encryption_key is not None:
-            byte_guessing_entropies.append(guessing_entropy(correlation_matrix, i, searched_key))
-        
-        print(f"key[{i}]: 0x{key_byte:02X}, sample: {tracesample_with_max_corr}")
-        key_arr[i] = key_byte
-    
     if timer == True:
         end_time = time()
         print(f"CPA took: {end_time - start_time:0.0f} seconds")
-    
-    # If the real encryption key is known, calculate the guessing entropy
-    GE = None
-    if measurement.encryption_key is not None:
-        GE = np.mean(byte_guessing_entropies)
+    return results
+
+def find_key(measurement: Measurement, key_length_in_bytes, n_traces: int = 0,
+              attack_mode: str = "lrnd", timer: bool = False,
+              chunk_size: int = 1024, dtype=np.float64, workers: int = 1,
+              engine: str = "direct", poi: np.ndarray = None, n_poi: int = 0,
+              backend: str = "numpy", n_threads: int = 0, models: List[str] = None ) -> Tuple[np.ndarray, str, int]:
+    """
+    Return the key and its guessing entropy based on the maximum correlation for each byte of the key.
+    If leakage models are given, all of them are attacked in a single pass instead of attack_mode
+    ( see find_key_models ), the results of all models are printed and the key of the model
+    with the highest mean maximum correlation is returned.
+    """
+    if n_traces == 0:
+        n_traces = measurement.cnt
+    if models:
+        if engine != "direct":
+            raise ValueError("Leakage models are attacked with the direct engine only.")
+        results = find_key_models(measurement, models, n_traces, timer, chunk_size, dtype, poi, backend, n_threads,
+                                  workers, key_length_in_bytes, n_poi)
+        print_model_results(results)
+        best_model = max(results, key=lambda model: np.mean(np.max(results[model].max_corr, axis=1)))
+        print(f"Best leakage model: {best_model}")
+        return print_result(results[best_model])
+    result = find_key_sweep(measurement, key_length_in_bytes, [n_traces],
+                            attack_mode=attack_mode, timer=timer,
+                            chunk_size=chunk_size, dtype=dtype, workers=workers, engine=engine,
+                            poi=poi, n_poi=n_poi, backend=backend, n_threads=n_threads)[-1]
+    return print_result(result)
+
+def accumulate_models(accumulator: CPAAccumulator, measurement: Measurement, models: List[str],
+                      start: int, stop: int, chunk_size: int, poi: np.ndarray = None, byte_indices: List[int] = None):
+    """
+    Add the traces start to stop of the measurement to an accumulator of the stacked hypotheses of
+    the key bytes in byte_indices ( all if not given ) of several leakage models, in chunks of chunk_size rows.
+    """
+    if byte_indices is None:
+        byte_indices = list(range(measurement.key_length))
+    attack_modes = [ leakage.LEAKAGE_MODELS[model].attack_mode for model in models ]
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        texts = { "frnd": measurement.plaintexts[chunk_start:chunk_stop],
+                  "lrnd": measurement.ciphertexts[chunk_start:chunk_stop] }
+        hypotheses = np.concatenate([ leakage.model_hypotheses(model, texts[attack_mode], byte_indices)
+                                      for model, attack_mode in zip(models, attack_modes) ])
+        traces_chunk = measurement.traces[chunk_start:chunk_stop]
+        if poi is not None:
+            traces_chunk = traces_chunk[:, poi]
+        accumulator.update(hypotheses, traces_chunk)
+
+def sweep_model_bytes(measurement: Measurement, models: List[str], byte_indices: List[int], n_traces: int,
+                      chunk_size: int, dtype, poi: np.ndarray = None, backend: str = "numpy",
+                      n_threads: int = 0) -> List[CPAResult]:
+    """
+    Attack the key bytes in byte_indices with several leakage models in a single pass over the first n_traces
+    traces and return the result of each model.
+    """
+    attack_modes = [ leakage.LEAKAGE_MODELS[model].attack_mode for model in models ]
+    trace_length = measurement.trace_length if poi is None else len(poi)
+    accumulator = CPAAccumulator(len(models) * len(byte_indices), trace_length, dtype=dtype, backend=backend,
+                                 n_threads=n_threads)
+    accumulate_models(accumulator, measurement, models, 0, n_traces, chunk_size, poi, byte_indices)
+    result = accumulator.result()
+    if poi is not None:
+        result = result._replace(samples=poi[result.samples], poi=poi)
+    searched_keys = [ attacked_key(measurement, attack_mode) for attack_mode in attack_modes ]
+    return split_result(result, len(models), [ key[byte_indices] if key is not None else None
+                                               for key in searched_keys ])
+
+def find_key_models(measurement: Measurement, models: List[str], n_traces: int = 0, timer: bool = False,
+                    chunk_size: int = 1024, dtype=np.float64, poi: np.ndarray = None,
+                    backend: str = "numpy", n_threads: int = 0, workers: int = 1,
+                    key_length_in_bytes: int = 0, n_poi: int = 0) -> Dict[str, CPAResult]:
+    """
+    Attack with several leakage models ( see leakage.LEAKAGE_MODELS ) in a single pass over the traces
+    and return the result of each model.
+    The hypotheses of all models are stacked into one ( n_models * key_length, chunk, 256 ) matrix,
+    so every chunk of traces is read and converted once and correlated with all models in one matmul
+    per block of accumulator.HYPOTHESES_BLOCK_BYTES of hypotheses.
+    With workers > 1 the key bytes are split into groups attacked by a process pool like in find_key_sweep,
+    with n_poi > 0 the attack is restricted to the n_poi samples with the highest SNR of every attack mode
+    of the models. key_length_in_bytes 0 attacks all key bytes.
+    """
+    for model in models:
+        if model not in leakage.LEAKAGE_MODELS:
+            raise ValueError(f"Unknown leakage model '{model}'.")
+    if n_traces == 0:
+        n_traces = measurement.cnt
+    if key_length_in_bytes == 0:
+        key_length_in_bytes = measurement.key_length
+    if timer == True: start_time = time()
+
+    attack_modes = [ leakage.LEAKAGE_MODELS[model].attack_mode for model in models ]
+    if poi is None and n_poi > 0:
+        poi = np.unique(np.concatenate([ find_poi(measurement, attack_mode, n_poi, n_traces=n_traces)
+                                         for attack_mode in dict.fromkeys(attack_modes) ]))
+    byte_groups = [ list(group) for group in np.array_split(np.arange(key_length_in_bytes),
+                                                            min(max(workers, 1), key_length_in_bytes)) ]
+    if len(byte_groups) == 1:
+        group_results = [ sweep_model_bytes(measurement, models, byte_groups[0], n_traces, chunk_size, dtype, poi,
+                                            backend, n_threads) ]
+    else:
+        with ProcessPoolExecutor(max_workers=len(byte_groups)) as pool:
+            group_results = list(pool.map(sweep_model_bytes, repeat(measurement), repeat(models), byte_groups,
+                                          repeat(n_traces), repeat(chunk_size), repeat(dtype), repeat(poi),
+                                          repeat(backend), repeat(n_threads)))
+    results = {}
+    for i, (model, attack_mode) in enumerate(zip(models, attack_modes)):
+        parts = [ group[i] for group in group_results ]
+        searched_key = attacked_key(measurement, attack_mode)
+        if len(parts) == 1 and key_length_in_bytes == measurement.key_length:
+            results[model] = parts[0]
+        else:
+            results[model] = concat_results(parts, searched_key[:key_length_in_bytes]
+                                            if searched_key is not None else None)
+
+    if timer == True:
+        print(f"CPA of {len(models)} models took: {time() - start_time:0.0f} seconds")
+    return results
+
+def print_model_results(results: Dict[str, CPAResult]):
+    """ Print the best key of every leakage model, its guessing entropy and estimated key rank if known. """
+    print(f"{'model':<18} {'key':<48} {'GE':>7} {'rank':>7} {'max corr':>9}")
+    for model, result in results.items():
+        key_hex_str = ' '.join(f"{byte:02X}" for byte in result.key)
+        ge = f"{result.ge:7.2f}" if result.ge is not None else f"{'-':>7}"
+        rank = f"2^{result.key_rank[1]:<5.1f}" if result.key_rank is not None else f"{'-':>7}"
+        print(f"{model:<18} {key_hex_str:<48} {ge} {rank} {np.mean(np.max(result.max_corr, axis=1)):>9.4f}")
+
+def print_result(result: CPAResult) -> Tuple[np.ndarray, str, int]:
+    """
+    Print the key bytes, their samples and guessing entropies of a result and
+    return the key, its hex string and the guessing entropy.
+    """
+    for i in range(result.key.shape[0]):
+        # If the real encryption key is known, print the guessing entropy
+        if result.ranks is not None:
+            print(f"Byte guessing entropy: {result.ranks[i]}/{result.max_corr.shape[1]}")
+        print(f"key[{i}]: 0x{result.key[i]:02X}, sample: {result.samples[i]}")
+
+    GE = result.ge
+    if GE is not None:
         print(f"Guessing entropy: {GE:.2f}")
-    
-    key_hex_str = ' '.join([hex(i)[2:].zfill(2).upper() for i in key_arr])
-    return key_arr, key_hex_str, GE
+        lower, estimate, upper = result.key_rank
+        print(f"Estimated key rank: 2^{estimate:.1f} (2^{lower:.1f} - 2^{upper:.1f})")
 
-def verify_key ( measurement: Measurement, key: np.ndarray ) -> bool:
+    key_hex_str = ' '.join([hex(i)[2:].zfill(2).upper() for i in result.key])
+    return result.key, key_hex_str, GE
+
+def verify_key ( measurement: Measurement, key: np.ndarray, n_pairs: int = 16 ) -> bool:
+    """ Check the key on the first n_pairs plaintext/ciphertext pairs ( all if 0 ). """
     key_bytes = bytes(key)
-    pt = np.loadtxt(measurement.plaintext_path, converters=hex_to_int, dtype=np.uint8)
-    ct = np.loadtxt(measurement.ciphertext_path, converters=hex_to_int, dtype=np.uint8)
+    n_pairs = n_pairs if n_pairs != 0 else measurement.cnt
+    pt = measurement.plaintexts[:n_pairs]
+    ct = measurement.ciphertexts[:n_pairs]
     pt_bytes = bytes(pt)
     ct_bytes = bytes(ct)
 
@@ -270,11 +441,18 @@ def enc_key_from_last_round_key ( key_arr: np.array ) -> np.array:
     encryption_key = reverse_key_schedule(bytes(key_arr), 10)
     return np.frombuffer(encryption_key, dtype=np.uint8)
 
-def cpa(measurement: Measurement, n_traces: int = 0, attack_mode: str = "lrnd", timer: bool = False) -> bool:
+def cpa(measurement: Measurement, n_traces: int = 0, attack_mode: str = "lrnd", timer: bool = False,
+        workers: int = 1, engine: str = "direct", max_candidates: int = 0, backend: str = "numpy",
+        n_threads: int = 0) -> bool:
     """
     Perform correlation power analysis on given measurement.
     :param Measurement measurement: Traces, PTs, CTs
     :param str attack_mode: lrnd for last round attack, frnd for first round attack
+    :param int workers: number of processes attacking the key bytes in parallel
+    :param str engine: direct or partitioned ( per byte-value class sums ) correlation
+    :param int max_candidates: if the found key is wrong, enumerate up to this many next most likely keys
+    :param str backend: correlation kernel of the direct engine, see kernel.py
+    :param int n_threads: number of threads of the correlation kernel, all cores if 0
     """
     if n_traces == 0:
         n_traces = measurement.cnt
@@ -282,11 +460,15 @@ def cpa(measurement: Measurement, n_traces: int = 0, attack_mode: str = "lrnd",
     match attack_mode:
         case "lrnd":
             print(f"\nPerforming last round CPA using {n_traces} measurements.")
-            last_round_key_arr, key_hex, ge = find_key(measurement, measurement.key_length, n_traces=n_traces, timer=True, attack_mode="lrnd")
+            result = find_key_sweep(measurement, measurement.key_length, [n_traces], timer=True, attack_mode="lrnd",
+                                    workers=workers, engine=engine, backend=backend, n_threads=n_threads)[-1]
+            last_round_key_arr, key_hex, ge = print_result(result)
             key_arr = enc_key_from_last_round_key(last_round_key_arr)
         case "frnd":
             print(f"\nPerforming first round CPA using {n_traces} measurements.")
-            key_arr, key_hex, ge = find_key(measurement, measurement.key_length, n_traces=n_traces, timer=True, attack_mode="frnd")
+            result = find_key_sweep(measurement, measurement.key_length, [n_traces], timer=True, attack_mode="frnd",
+                                    workers=workers, engine=engine, backend=backend, n_threads=n_threads)[-1]
+            key_arr, key_hex, ge = print_result(result)
         case _:
             raise ValueError("Unknown attack mode.")
 
@@ -297,6 +479,12 @@ def cpa(measurement: Measurement, n_traces: int = 0, attack_mode: str = "lrnd",
     if success == False and attack_mode == "lrnd":
         print("Full last round key wasn't found, even its correct subkeys weren't reversed into correct encryption key subkeys.")
         print("Found last round key: ", " ".join([hex(byte)[2:].upper() for byte in last_round_key_arr]))
+    if success == False and max_candidates > 0:
+        enumerated_key = search_key(measurement, result, attack_mode, max_candidates=max_candidates, workers=workers)
+        if enumerated_key is not None:
+            key_arr = enumerated_key
+            print_key(key_arr, measurement.encryption_key)
+            success = verify_key(measurement, key_arr)
     print(f"Attack success: { Fore.GREEN + str(success) if success == True else Fore.RED + str(success) }")
     print(Style.RESET_ALL, end='')
     
@@ -341,18 +529,21 @@ def main():
     cpa(unknown_key_measurement, timer=True, attack_mode="frnd")
     cpa(known_key_measurement, timer=True, attack_mode="frnd")
     
-    trace_cnt_and_ge = []
     trace_increment_step = 500
     measurement = rds_40k
     trace_cnt = 20000
     attack_mode = "lrnd"
 
-    for i in range(trace_increment_step, trace_cnt+trace_increment_step, trace_increment_step):
-        _, ge = cpa(measurement, n_traces=i, timer=True, attack_mode=attack_mode)
-        trace_cnt_and_ge.append( (i, ge) )
-        print(trace_cnt_and_ge)
-    
+    # a single pass over the traces, reporting the guessing entropy after every step,
+    # every step is stored, so an interrupted sweep resumes where it stopped
+    from store import ResultStore, stored_sweep
+    results = stored_sweep(measurement, ResultStore("results/store"),
+                           range(trace_increment_step, trace_cnt+trace_increment_step, trace_increment_step),
+                           attack_mode=attack_mode)
+    trace_cnt_and_ge = [ (result.n_traces, result.ge) for result in results ]
+
     print("Array of results with n_traces and guessing entropy:")
+    print(trace_cnt_and_ge)
     plot_ge_vs_ntraces(trace_cnt_and_ge, trace_cnt, trace_increment_step)
 
 if __name__ == "__main__":
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Single file container of a measurement.
+
+Layout of a dataset file:
+
+    prefix   : magic "CPADSET1", uint64 count, uint64 capacity, uint32 header length ( little endian )
+    header   : JSON with the format version, trace length, sample type, block size, encryption key,
+               capture metadata and the offsets of the sections
+    sections : plaintexts ( capacity, 16 ), ciphertexts ( capacity, 16 ), traces ( capacity, trace_length ),
+               each contiguous and aligned to ALIGNMENT bytes
+
+The first count rows of the sections are valid. Opening a dataset reads only the prefix and the
+header and memory maps the sections, so it takes constant time and nothing is copied.
+Traces are appended into the free capacity and the count is written last, so a reader never sees
+an incomplete record. When the capacity is exhausted the file is rewritten with twice the capacity.
+"""
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+from numpy import array
+
+from measurement import ConcatenatedMeasurement, Measurement, open_capture
+from simulate import DEFAULT_CIPHERTEXT_NAME, DEFAULT_PLAINTEXT_NAME, DEFAULT_TRACES_NAME, write_hex_lines
+
+MAGIC = b"CPADSET1"
+VERSION = 1
+# magic, count, capacity, header length
+PREFIX = struct.Struct("<8sQQI")
+ALIGNMENT = 4096
+BLOCK_SIZE = 16
+# space reserved for the JSON header, so the count and metadata can be rewritten in place
+HEADER_SIZE = ALIGNMENT - PREFIX.size
+
+
+def align_up(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def section_offsets(capacity: int, trace_length: int, trace_dtype: np.dtype) -> dict:
+    """ Offsets of the plaintext, ciphertext and trace sections of a file with the given capacity. """
+    plaintexts = ALIGNMENT
+    ciphertexts = align_up(plaintexts + capacity * BLOCK_SIZE)
+    traces = align_up(ciphertexts + capacity * BLOCK_SIZE)
+    end = traces + capacity * trace_length * np.dtype(trace_dtype).itemsize
+    return { "plaintexts": plaintexts, "ciphertexts": ciphertexts, "traces": traces, "end": end }
+
+
+def read_header(path: str) -> dict:
+    """ Returns the header of a dataset file with its count and capacity, after checking it against the file size. """
+    with open(path, 'rb') as file:
+        magic, count, capacity, header_length = PREFIX.unpack(file.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"'{path}' is not a dataset file.")
+        header = json.loads(file.read(header_length))
+    if header["version"] != VERSION:
+        raise ValueError(f"Unsupported dataset version {header['version']} of '{path}'.")
+    if count > capacity or os.path.getsize(path) < header["offsets"]["end"]:
+        raise ValueError(f"The dataset '{path}' is truncated or corrupted.")
+    header["count"] = count
+    header["capacity"] = capacity
+    return header
+
+
+def write_header(file, header: dict):
+    """ Write the prefix and the JSON header at the start of an open dataset file. """
+    header_json = json.dumps({ key: value for key, value in header.items() if key not in ("count", "capacity") })
+    header_bytes = header_json.encode()
+    if len(header_bytes) > HEADER_SIZE:
+        raise ValueError("The metadata of the dataset do not fit in its header.")
+    file.seek(0)
+    file.write(PREFIX.pack(MAGIC, header["count"], header["capacity"], len(header_bytes)))
+    file.write(header_bytes.ljust(HEADER_SIZE, b"\0"))
+
+
+def create_dataset(path: str, trace_length: int, encryption_key: array = None, metadata: dict = None,
+                   capacity: int = 1024, trace_dtype = np.uint8) -> dict:
+    """
+    Create an empty dataset file and return its header.
+    :param int trace_length: number of samples in a trace
+    :param np.array encryption_key: master key, None if unknown
+    :param dict metadata: capture metadata stored in the header ( JSON serializable )
+    :param int capacity: number of traces the file is allocated for
+    """
+    header = { "version": VERSION, "count": 0, "capacity": capacity, "trace_length": trace_length,
+               "dtype": np.dtype(trace_dtype).str, "block_size": BLOCK_SIZE,
+               "encryption_key": bytes(bytearray(encryption_key)).hex() if encryption_key is not None else None,
+               "metadata": metadata or {},
+               "offsets": section_offsets(capacity, trace_length, trace_dtype) }
+    with open(path, 'wb') as file:
+        write_header(file, header)
+        file.truncate(header["offsets"]["end"])
+    return header
+
+
+def sections(path: str, header: dict, mode: str = 'r', rows: int = None):
+    """ Memory maps of the first rows ( count if not given ) plaintexts, ciphertexts and traces. """
+    rows = header["count"] if rows is None else rows
+    if rows == 0:
+        return ( np.empty((0, BLOCK_SIZE), dtype=np.uint8), np.empty((0, BLOCK_SIZE), dtype=np.uint8),
+                 np.empty((0, header["trace_length"]), dtype=np.dtype(header["dtype"])) )
+    offsets = header["offsets"]
+    return ( np.memmap(path, dtype=np.uint8, mode=mode, offset=offsets["plaintexts"], shape=(rows, BLOCK_SIZE)),
+             np.memmap(path, dtype=np.uint8, mode=mode, offset=offsets["ciphertexts"], shape=(rows, BLOCK_SIZE)),
+             np.memmap(path, dtype=np.dtype(header["dtype"]), mode=mode, offset=offsets["traces"],
+                       shape=(rows, header["trace_length"])) )
+
+
+def grow(path: str, header: dict, capacity: int, chunk_size: int = 65536) -> dict:
+    """ Rewrite a dataset file with a larger capacity and return its new header. """
+    new_header = dict(header, capacity=capacity,
+                      offsets=section_offsets(capacity, header["trace_length"], header["dtype"]))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        write_header(file, new_header)
+        file.truncate(new_header["offsets"]["end"])
+    if header["count"] > 0:
+        old, new = sections(path, header), sections(tmp_path, new_header, 'r+')
+        for start in range(0, header["count"], chunk_size):
+            for old_section, new_section in zip(old, new):
+                new_section[start:start+chunk_size] = old_section[start:start+chunk_size]
+        for new_section in new:
+            new_section.flush()
+        del old, new
+    os.replace(tmp_path, path)
+    return new_header
+
+
+def append(path: str, plaintexts: np.ndarray, ciphertexts: np.ndarray, traces: np.ndarray):
+    """
+    Append encryptions to a dataset file.
+
+    Sizes:
+    Plaintexts  : ( n, 16 )
+    Ciphertexts : ( n, 16 )
+    Traces      : ( n, trace_length )
+    """
+    header = read_header(path)
+    n = traces.shape[0]
+    if plaintexts.shape != (n, BLOCK_SIZE) or ciphertexts.shape != (n, BLOCK_SIZE) \
+            or traces.shape[1] != header["trace_length"]:
+        raise ValueError("The appended plaintexts, ciphertexts and traces do not match the dataset.")
+    if header["count"] + n > header["capacity"]:
+        header = grow(path, header, max(2 * header["capacity"], header["count"] + n))
+    count = header["count"]
+    offsets = header["offsets"]
+    columns = (("plaintexts", np.ascontiguousarray(plaintexts, dtype=np.uint8)),
+               ("ciphertexts", np.ascontiguousarray(ciphertexts, dtype=np.uint8)),
+               ("traces", np.ascontiguousarray(traces, dtype=np.dtype(header["dtype"]))))
+    with open(path, 'r+b') as file:
+        for name, data in columns:
+            file.seek(offsets[name] + count * data.shape[1] * data.itemsize)
+            file.write(data.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+        # the records are complete before they are counted
+        header["count"] = count + n
+        write_header(file, header)
+
+
+class DatasetMeasurement(Measurement):
+    """
+    Measurement memory mapped from a dataset file, see the module documentation.
+    The encryption key and metadata are read from the header, a given key overrides the stored one.
+    """
+    def __init__(self, path: str, encryption_key: array = None):
+        # the dataset describes itself, nothing is inferred from file sizes
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"The file '{path}' was not found.")
+        self.header = read_header(path)
+        if encryption_key is None and self.header["encryption_key"] is not None:
+            encryption_key = list(bytes.fromhex(self.header["encryption_key"]))
+        if encryption_key is None:
+            print(f"Warning: encryption key not provided for {path}.")
+        self.path = path
+        self.plaintext_path = None
+        self.ciphertext_path = None
+        self.trace_path = path
+        self._plaintexts = None
+        self._ciphertexts = None
+        self._traces = None
+        self.trace_dtype = np.dtype(self.header["dtype"])
+        self.cnt = self.header["count"]
+        self.trace_length = self.header["trace_length"]
+        self.encryption_key = encryption_key
+        self.key_length = self.header["block_size"]
+        self.metadata = self.header["metadata"]
+
+    def _map_sections(self):
+        self._plaintexts, self._ciphertexts, self._traces = sections(self.path, self.header)
+
+    @property
+    def plaintexts(self) -> np.ndarray:
+        if self._plaintexts is None:
+            self._map_sections()
+        return self._plaintexts
+
+    @property
+    def ciphertexts(self) -> np.ndarray:
+        if self._ciphertexts is None:
+            self._map_sections()
+        return self._ciphertexts
+
+    @property
+    def traces(self) -> np.memmap:
+        if self._traces is None:
+            self._map_sections()
+        return self._traces
+
+
+def convert(measurement: Measurement, path: str, metadata: dict = None, chunk_size: int = 65536) -> DatasetMeasurement:
+    """ Write a measurement ( e.g. a capture directory, see open_capture ) to a dataset file, losslessly. """
+    header = create_dataset(path, measurement.trace_length, measurement.encryption_key, metadata,
+                            max(measurement.cnt, 1), measurement.trace_dtype)
+    plaintexts, ciphertexts, traces = sections(path, header, 'r+', measurement.cnt)
+    for start in range(0, measurement.cnt, chunk_size):
+        stop = min(start + chunk_size, measurement.cnt)
+        plaintexts[start:stop] = measurement.plaintexts[start:stop]
+        ciphertexts[start:stop] = measurement.ciphertexts[start:stop]
+        traces[start:stop] = measurement.traces[start:stop]
+    for section in (plaintexts, ciphertexts, traces):
+        if isinstance(section, np.memmap):
+            section.flush()
+    del plaintexts, ciphertexts, traces
+    header["count"] = measurement.cnt
+    with open(path, 'r+b') as file:
+        write_header(file, header)
+    return DatasetMeasurement(path, measurement.encryption_key)
+
+
+def export(measurement: Measurement, out_dir: str, chunk_size: int = 65536):
+    """ Write a measurement as plaintexts.txt, ciphertexts.txt and traces.bin to out_dir. """
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, DEFAULT_PLAINTEXT_NAME), 'wb') as pt_file, \
+         open(os.path.join(out_dir, DEFAULT_CIPHERTEXT_NAME), 'wb') as ct_file, \
+         open(os.path.join(out_dir, DEFAULT_TRACES_NAME), 'wb') as trace_file:
+        for start in range(0, measurement.cnt, chunk_size):
+            stop = min(start + chunk_size, measurement.cnt)
+            write_hex_lines(pt_file, measurement.plaintexts[start:stop])
+            write_hex_lines(ct_file, measurement.ciphertexts[start:stop])
+            trace_file.write(np.ascontiguousarray(measurement.traces[start:stop]).tobytes())
+
+
+def open_measurement(path: str, encryption_key: array = None) -> Measurement:
+    """ Open a dataset file or a capture directory. """
+    if os.path.isdir(path):
+        return open_capture(path, encryption_key)
+    return DatasetMeasurement(path, encryption_key)
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("convert", "export", "info"):
+        print("Wrong arguments: python3 dataset.py convert /path/to/capture_dir [/path/to/capture_dir ...] out.cpa\n"
+              "                 python3 dataset.py export dataset.cpa /path/to/out_dir\n"
+              "                 python3 dataset.py info dataset.cpa")
+        exit()
+    match sys.argv[1]:
+        case "convert":
+            captures = [ open_capture(capture_dir) for capture_dir in sys.argv[2:-1] ]
+            measurement = captures[0] if len(captures) == 1 else ConcatenatedMeasurement(captures)
+            convert(measurement, sys.argv[-1], { "sources": [ os.path.abspath(path) for path in sys.argv[2:-1] ] })
+        case "export":
+            export(DatasetMeasurement(sys.argv[2]), sys.argv[3])
+        case "info":
+            header = read_header(sys.argv[2])
+            print(json.dumps(header, indent=1))
+
+
+if __name__ == "__main__":
+    main()
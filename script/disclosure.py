@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Search for the minimum number of traces to disclosure of a known key.
+
+Instead of attacking every prefix of the traces in fixed steps, the number of traces is doubled
+until the attack succeeds ( the guessing entropy is at most max_ge, 0 means every correct key byte
+is ranked first ), then the last failing and the first succeeding prefix are bisected down to
+a resolution. Only O( log n ) prefixes are evaluated. The accumulators are incremental, so
+the doubling phase is a single pass over the traces, and every bisection step continues from
+a copy of the accumulator of the last failing prefix.
+The search assumes that once the attack succeeds it keeps succeeding with more traces,
+so every result is confirmed on a few longer prefixes.
+"""
+import copy
+import sys
+from time import perf_counter
+from typing import List, NamedTuple
+
+import numpy as np
+
+import leakage
+from accumulator import CPAResult
+from cpa import ENGINES, accumulate_traces, attacked_key, new_accumulator
+from measurement import Measurement
+
+
+class Disclosure(NamedTuple):
+    """
+    n_traces: minimum number of traces to disclosure, None if the attack never succeeded
+    result: result of the attack on n_traces ( on all traces if it never succeeded )
+    evaluated: numbers of traces of all evaluated prefixes, in evaluation order
+    traces_processed: number of traces added to an accumulator during the search
+    seconds: wall time of the search
+    """
+    n_traces: int
+    result: CPAResult
+    evaluated: List[int]
+    traces_processed: int
+    seconds: float
+
+
+class PrefixAttack:
+    """ Attack on growing prefixes of the traces of a measurement. """
+    def __init__(self, measurement: Measurement, attack_mode: str, engine: str, chunk_size: int, dtype):
+        self.measurement = measurement
+        self.attack_mode = attack_mode
+        self.chunk_size = chunk_size
+        self.byte_indices = list(range(measurement.key_length))
+        self.searched_key = attacked_key(measurement, attack_mode)
+        self.accumulator = new_accumulator(engine, attack_mode, self.byte_indices, measurement.trace_length, dtype)
+        self.evaluated = []
+        self.traces_processed = 0
+
+    def advance(self, accumulator, n_traces: int) -> CPAResult:
+        """ Add the traces up to n_traces to the accumulator and return its result. """
+        self.traces_processed += max(n_traces - accumulator.n, 0)
+        accumulate_traces(accumulator, self.measurement, self.attack_mode, self.byte_indices,
+                          accumulator.n, n_traces, self.chunk_size)
+        self.evaluated.append(n_traces)
+        return accumulator.result(self.searched_key)
+
+
+def traces_to_disclosure(measurement: Measurement, attack_mode: str = "lrnd", max_ge: float = 0.0,
+                         start: int = 100, resolution: int = 50, confirm: int = 2,
+                         engine: str = "partitioned", chunk_size: int = 1024, dtype=np.float64) -> Disclosure:
+    """
+    Find the smallest number of traces for which the guessing entropy of the attack is at most max_ge.
+    :param str attack_mode: lrnd for last round attack, frnd for first round attack
+    :param float max_ge: highest guessing entropy counted as success, 0 for the correct key at rank 1
+    :param int start: number of traces of the first evaluated prefix
+    :param int resolution: the bisection stops when the bounds are closer than this many traces
+    :param int confirm: the success must hold for this many longer prefixes, each resolution traces apart
+    :param str engine: direct or partitioned correlation ( see find_key_sweep )
+    """
+    if measurement.encryption_key is None:
+        raise ValueError("The encryption key of the measurement is needed to find the traces to disclosure.")
+    if attack_mode not in leakage.ATTACK_MODES:
+        raise ValueError("Unknown attack mode.")
+    if engine not in ENGINES:
+        raise ValueError("Unknown CPA engine.")
+    start_time = perf_counter()
+    attack = PrefixAttack(measurement, attack_mode, engine, chunk_size, dtype)
+
+    def succeeded(result: CPAResult) -> bool:
+        return result.ge <= max_ge
+
+    # the accumulator of the last failing prefix is kept for the bisection
+    failed_accumulator = copy.deepcopy(attack.accumulator)
+    accumulator = attack.accumulator
+    n_traces = min(start, measurement.cnt)
+    while True:
+        # doubling
+        while True:
+            result = attack.advance(accumulator, n_traces)
+            if succeeded(result) or n_traces == measurement.cnt:
+                break
+            failed_accumulator = copy.deepcopy(accumulator)
+            n_traces = min(2 * n_traces, measurement.cnt)
+        if not succeeded(result):
+            return Disclosure(None, result, attack.evaluated, attack.traces_processed, perf_counter() - start_time)
+        success, success_result = n_traces, result
+
+        # bisection between the last failing and the first succeeding prefix
+        while success - failed_accumulator.n > resolution:
+            middle = (failed_accumulator.n + success) // 2
+            accumulator = copy.deepcopy(failed_accumulator)
+            result = attack.advance(accumulator, middle)
+            if succeeded(result):
+                success, success_result = middle, result
+            else:
+                failed_accumulator = accumulator
+
+        # confirmation, a failing longer prefix restarts the doubling above it
+        accumulator = copy.deepcopy(failed_accumulator)
+        confirmed = True
+        for n_confirm in range(success + resolution, min(success + confirm * resolution, measurement.cnt) + 1,
+                               resolution):
+            if not succeeded(attack.advance(accumulator, n_confirm)):
+                confirmed = False
+                break
+        if confirmed:
+            return Disclosure(success, success_result, attack.evaluated, attack.traces_processed,
+                              perf_counter() - start_time)
+        failed_accumulator = copy.deepcopy(accumulator)
+        n_traces = min(2 * accumulator.n, measurement.cnt)
+
+
+def print_disclosure(disclosure: Disclosure, step: int = 50):
+    """
+    Print the traces to disclosure and the budget of the search compared to a linear sweep
+    in steps of step traces ( the resolution of the search ).
+    """
+    if disclosure.n_traces is None:
+        print(f"The key was not disclosed with all {disclosure.result.n_traces} traces "
+              f"(GE {disclosure.result.ge:.2f}).")
+    else:
+        print(f"Traces to disclosure: {disclosure.n_traces} (GE {disclosure.result.ge:.2f})")
+    n_linear = -(-(disclosure.n_traces or disclosure.result.n_traces) // step)
+    print(f"Evaluated {len(disclosure.evaluated)} prefixes ({n_linear} in a linear sweep with step {step}), "
+          f"processed {disclosure.traces_processed} traces in {disclosure.seconds:.2f} s")
+
+
+def main():
+    if len(sys.argv) < 5:
+        print("Not enough arguments: python3 disclosure.py plaintexts.txt ciphertexts.txt traces.bin key_hex "
+              "[lrnd|frnd] [max_ge]")
+        exit()
+    measurement = Measurement(plaintext=sys.argv[1], ciphertext=sys.argv[2], trace=sys.argv[3],
+                              encryption_key=list(bytes.fromhex(sys.argv[4])))
+    attack_mode = sys.argv[5] if len(sys.argv) >= 6 else "lrnd"
+    max_ge = float(sys.argv[6]) if len(sys.argv) >= 7 else 0.0
+    print_disclosure(traces_to_disclosure(measurement, attack_mode, max_ge))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Score guided key enumeration.
+
+When the best key of a CPA is wrong, the correct key is usually among the next most likely
+ones. Candidate keys are enumerated in descending order of their total score ( sum of the
+per byte scores, see ranking.correlation_scores ) by a best-first search over the per byte
+sorted key guesses, and checked in batches against a few cached plaintext/ciphertext pairs,
+optionally on a process pool.
+The search runs in the main process and costs about 15 us per candidate, the pool only takes over
+the AES checks, so 2^20 candidates take tens of seconds whatever the number of workers. The heap of
+the search is cut back to the best candidates that can still be yielded, so it holds at most about
+2 * max_candidates keys of about 150 bytes each.
+"""
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import numpy as np
+from Crypto.Cipher import AES
+
+import leakage
+from accumulator import CPAResult
+from measurement import Measurement
+from ranking import correlation_scores
+
+RCON = np.array([ 0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1B, 0x36 ], dtype=np.uint8)
+
+
+def enumerate_keys(scores: np.ndarray, max_candidates: int = 0) -> Iterator[np.ndarray]:
+    """
+    Yields the first max_candidates keys ( all if 0 ) in descending order of the sum of their
+    per byte scores ( n_bytes, 256 ).
+    A key is a vector of indices into the per byte guesses sorted by score, kept as bytes in the heap.
+    Successors of a key increment one index at or after the last incremented one, so every key is
+    generated once. Every pop pushes up to n_bytes successors, so once the heap holds twice as many
+    keys as are left to yield it is cut back to the best of them, the others can never be reached.
+    """
+    n_bytes = scores.shape[0]
+    order = np.argsort(-scores, axis=1, kind="stable")
+    sorted_scores = np.take_along_axis(scores, order, axis=1)
+    # score lost by moving the guess of a byte from index i to i + 1
+    steps = (sorted_scores[:, :-1] - sorted_scores[:, 1:]).tolist()
+    last_index = scores.shape[1] - 1
+    rows = np.arange(n_bytes)
+    heap = [ (-float(np.sum(sorted_scores[:, 0])), bytes(n_bytes), 0) ]
+    remaining = max_candidates if max_candidates > 0 else -1
+    while heap and remaining != 0:
+        negative_score, indices, last = heapq.heappop(heap)
+        remaining -= 1
+        yield order[rows, np.frombuffer(indices, dtype=np.uint8)].astype(np.uint8)
+        for position in range(last, n_bytes):
+            index = indices[position]
+            if index < last_index:
+                successor = indices[:position] + bytes((index + 1,)) + indices[position+1:]
+                heapq.heappush(heap, (negative_score + steps[position][index], successor, position))
+        if 0 < remaining and len(heap) > 2 * remaining:
+            heap = heapq.nsmallest(remaining, heap)
+
+
+def candidate_batches(scores: np.ndarray, batch_size: int, max_candidates: int) -> Iterator[np.ndarray]:
+    """ Yields the first max_candidates keys of enumerate_keys in ( batch_size, n_bytes ) batches. """
+    batch = []
+    for key in enumerate_keys(scores, max_candidates):
+        batch.append(key)
+        if len(batch) == batch_size:
+            yield np.array(batch)
+            batch = []
+    if batch:
+        yield np.array(batch)
+
+
+def reverse_key_schedule_batch(last_round_keys: np.ndarray) -> np.ndarray:
+    """
+    Invert the AES-128 key schedule of a batch of last round keys ( batch, 16 ), word by word:
+    w[i-4] = w[i] xor T( w[i-1] ), where T is SubWord( RotWord( . ) ) xor Rcon for every fourth word.
+    """
+    words = [ None ] * 44
+    for i in range(4):
+        words[40 + i] = last_round_keys[:, 4*i:4*i+4]
+    for i in range(43, 3, -1):
+        temp = words[i - 1]
+        if i % 4 == 0:
+            temp = leakage.SBox[np.roll(temp, -1, axis=1)]
+            temp[:, 0] ^= RCON[i // 4 - 1]
+        words[i - 4] = words[i] ^ temp
+    return np.concatenate(words[:4], axis=1)
+
+
+def check_batch(candidates: np.ndarray, plaintexts: bytes, ciphertexts: bytes, last_round: bool) -> np.ndarray:
+    """
+    Returns the encryption key of the first candidate encrypting the plaintext blocks to the
+    ciphertext blocks, None if there is none. Last round key candidates are inverted first.
+    """
+    if len(plaintexts) == 0 or len(plaintexts) % 16 != 0 or len(plaintexts) != len(ciphertexts):
+        # without a pair every key would pass
+        raise ValueError("The key check needs at least one plaintext/ciphertext block pair.")
+    first_plaintext, first_ciphertext = plaintexts[:16], ciphertexts[:16]
+    keys = reverse_key_schedule_batch(candidates) if last_round else candidates
+    for key in keys:
+        key = key.tobytes()
+        cipher = AES.new(key, AES.MODE_ECB)
+        # a single block rejects a wrong key, all cached pairs confirm the right one
+        if cipher.encrypt(first_plaintext) == first_ciphertext and cipher.encrypt(plaintexts) == ciphertexts:
+            return np.frombuffer(key, dtype=np.uint8)
+    return None
+
+
+def search_key(measurement: Measurement, result: CPAResult, attack_mode: str,
+               max_candidates: int = 1 << 20, batch_size: int = 4096, workers: int = 1,
+               n_pairs: int = 4) -> np.ndarray:
+    """
+    Enumerate up to max_candidates keys in descending score order of a CPA result and return
+    the encryption key verified on n_pairs plaintext/ciphertext pairs, None if it was not found.
+    """
+    last_round = attack_mode == "lrnd"
+    plaintexts = np.ascontiguousarray(measurement.plaintexts[:n_pairs]).tobytes()
+    ciphertexts = np.ascontiguousarray(measurement.ciphertexts[:n_pairs]).tobytes()
+    batches = candidate_batches(correlation_scores(result.max_corr, result.n_traces), batch_size, max_candidates)
+    checked = 0
+    if workers <= 1:
+        for batch in batches:
+            key = check_batch(batch, plaintexts, ciphertexts, last_round)
+            checked += batch.shape[0]
+            if key is not None:
+                break
+    else:
+        key = None
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # batches are checked in order, a bounded number of them in flight
+            pending = deque()
+            for batch in batches:
+                pending.append((batch.shape[0], pool.submit(check_batch, batch, plaintexts, ciphertexts, last_round)))
+                if len(pending) >= 2 * workers:
+                    size, future = pending.popleft()
+                    checked += size
+                    key = future.result()
+                    if key is not None:
+                        break
+            while key is None and pending:
+                size, future = pending.popleft()
+                checked += size
+                key = future.result()
+            for _, future in pending:
+                future.cancel()
+    print(f"Key enumeration checked {checked} candidates: {'found' if key is not None else 'not found'}")
+    return key
@@ -0,0 +1,132 @@
+"""
+Lightweight per-stage instrumentation of the attack.
+
+Stages of the pipeline are wrapped in `with stage("name", bytes_processed, key_byte):`.
+While instrumentation is disabled ( the default ) stage() returns a shared no-op context,
+so the overhead is a single function call. When enabled, every stage records its wall time,
+CPU time, number of processed bytes and the peak resident memory of the process so far,
+optionally streamed to a JSON lines file, and summary() prints a table per stage.
+
+Setting the environment variable CPA_PROFILE enables the instrumentation at import,
+its value is the path of the JSON lines file ( "-" for none ), the summary is printed at exit.
+Stages running in worker processes are not recorded: a forked child starts with the instrumentation
+disabled and no records, and a spawned child does not enable it from CPA_PROFILE.
+"""
+import atexit
+import json
+import multiprocessing
+import os
+import resource
+import sys
+from contextlib import nullcontext
+from time import perf_counter, process_time
+from typing import List
+
+_enabled = False
+_records = []
+_output = None
+_NO_OP = nullcontext()
+
+
+class _Stage:
+    """ Context manager recording a single execution of a stage. """
+    __slots__ = ("name", "bytes_processed", "key_byte", "wall", "cpu")
+
+    def __init__(self, name: str, bytes_processed: int, key_byte: int):
+        self.name = name
+        self.bytes_processed = bytes_processed
+        self.key_byte = key_byte
+
+    def __enter__(self):
+        self.wall = perf_counter()
+        self.cpu = process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record = { "stage": self.name,
+                   "key_byte": self.key_byte,
+                   "wall_s": perf_counter() - self.wall,
+                   "cpu_s": process_time() - self.cpu,
+                   "bytes": int(self.bytes_processed),
+                   # ru_maxrss is in KiB on Linux
+                   "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 }
+        _records.append(record)
+        if _output is not None:
+            _output.write(json.dumps(record) + "\n")
+        return False
+
+
+def stage(name: str, bytes_processed: int = 0, key_byte: int = None):
+    """ Returns a context manager measuring a stage, a no-op if instrumentation is disabled. """
+    if not _enabled:
+        return _NO_OP
+    return _Stage(name, bytes_processed, key_byte)
+
+
+def enable(jsonl_path: str = None):
+    """ Start recording stages, optionally appending every record to a JSON lines file. """
+    global _enabled, _output
+    _enabled = True
+    if jsonl_path is not None:
+        _output = open(jsonl_path, "a", buffering=1)
+
+
+def disable():
+    """ Stop recording stages and close the JSON lines file. """
+    global _enabled, _output
+    _enabled = False
+    if _output is not None:
+        _output.close()
+        _output = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def records() -> List[dict]:
+    """ Returns all recorded stages. """
+    return list(_records)
+
+
+def reset():
+    """ Forget all recorded stages. """
+    _records.clear()
+
+
+def _disable_in_child():
+    # the child shares the file of the parent, it neither writes to it nor closes it
+    global _enabled, _output
+    _enabled = False
+    _output = None
+    _records.clear()
+
+
+def summary(by_key_byte: bool = False, file=sys.stdout):
+    """
+    Print the total wall time, CPU time, processed bytes and peak resident memory of each stage,
+    with by_key_byte=True separately for each key byte.
+    """
+    totals = {}
+    for record in _records:
+        key = (record["stage"], record["key_byte"] if by_key_byte else None)
+        total = totals.setdefault(key, { "calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "bytes": 0, "peak_rss_mib": 0.0 })
+        total["calls"] += 1
+        total["wall_s"] += record["wall_s"]
+        total["cpu_s"] += record["cpu_s"]
+        total["bytes"] += record["bytes"]
+        total["peak_rss_mib"] = max(total["peak_rss_mib"], record["peak_rss_mib"])
+    print(f"{'stage':<24} {'byte':>4} {'calls':>7} {'wall [s]':>10} {'cpu [s]':>10} "
+          f"{'MiB':>10} {'MiB/s':>10} {'peak RSS':>10}", file=file)
+    for (name, key_byte), total in sorted(totals.items(), key=lambda item: -item[1]["wall_s"]):
+        mib = total["bytes"] / 2**20
+        throughput = mib / total["wall_s"] if total["wall_s"] > 0 else 0.0
+        print(f"{name:<24} {'' if key_byte is None else key_byte:>4} {total['calls']:>7} "
+              f"{total['wall_s']:>10.3f} {total['cpu_s']:>10.3f} {mib:>10.1f} {throughput:>10.1f} "
+              f"{total['peak_rss_mib']:>10.1f}", file=file)
+
+
+os.register_at_fork(after_in_child=_disable_in_child)
+if os.environ.get("CPA_PROFILE") and multiprocessing.parent_process() is None:
+    enable(None if os.environ["CPA_PROFILE"] == "-" else os.environ["CPA_PROFILE"])
+    atexit.register(summary)
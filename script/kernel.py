@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Correlation kernels: the products sum(h*t) of the hypotheses of every key guess with the traces.
+
+This product is the only part of the direct CPA whose cost grows with both the number of traces
+and the number of samples, every other running sum is a single pass over one of the operands.
+Backends:
+
+    numpy : one batched matmul of the whole chunk on n_threads BLAS threads
+    tiled : the chunk is split into tiles of TILE_SAMPLES samples and as many traces as fit in
+            TILE_BYTES ( at most the whole chunk ), so a tile of the traces and of the products stays
+            in cache, the sample tiles are multiplied on a pool of n_threads threads ( one BLAS thread
+            each ) and the row tiles are reduced into float64
+    numba : a compiled loop over the nonzero hypotheses on n_threads threads, only if numba is installed
+
+n_threads 0 uses all cores. With dtype float32 every tile is multiplied in float32 and added to the
+float64 result, so the rounding error is bounded by the tile, not by the chunk. The "auto" backend
+times every available backend once on the shape of the first chunk and keeps the fastest for that shape.
+The BLAS threads are limited with threadpoolctl ( see requirements.txt ). Without it the number of
+BLAS threads cannot be changed at run time, so n_threads is ignored by the numpy backend and the
+tiled backend multiplies its tiles in a single thread, leaving the threads to BLAS.
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from time import perf_counter
+
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = [ "numpy", "tiled", "numba", "auto" ]
+TILE_SAMPLES = 512
+# bytes of a tile of the traces
+TILE_BYTES = 1 << 20
+
+# fastest backend by ( n_bytes, n_guesses, trace_length, dtype ), see select_backend
+_selected = {}
+_numba_products = None
+
+
+def blas_threads(n_threads: int):
+    """ Returns a context limiting the BLAS threads to n_threads ( all if 0 ), a no-op without threadpoolctl. """
+    if threadpool_limits is None or n_threads <= 0:
+        return nullcontext()
+    return threadpool_limits(limits=n_threads, user_api="blas")
+
+
+def available_backends() -> list:
+    return [ backend for backend in BACKENDS if backend != "auto" and (backend != "numba" or numba is not None) ]
+
+
+def products_numpy(hypotheses: np.ndarray, traces: np.ndarray, n_threads: int = 0) -> np.ndarray:
+    with blas_threads(n_threads):
+        return np.matmul(hypotheses.transpose(0, 2, 1), traces)
+
+
+def products_tiled(hypotheses: np.ndarray, traces: np.ndarray, n_threads: int = 0, tile_rows: int = 0,
+                   tile_samples: int = TILE_SAMPLES) -> np.ndarray:
+    n_bytes, chunk_len, n_guesses = hypotheses.shape
+    if tile_rows == 0:
+        tile_rows = max(TILE_BYTES // (tile_samples * traces.dtype.itemsize), 1)
+    tile_rows = min(tile_rows, chunk_len)
+    if threadpool_limits is None:
+        # the tile threads would each run a BLAS with all threads
+        n_threads = 1
+    n_threads = n_threads or os.cpu_count() or 1
+    products = np.zeros((n_bytes, n_guesses, traces.shape[1]))
+    transposed = hypotheses.transpose(0, 2, 1)
+
+    def multiply(sample_start: int):
+        # every thread owns a range of samples of the products, so no two threads write the same memory
+        sample_stop = min(sample_start + tile_samples, traces.shape[1])
+        for row_start in range(0, chunk_len, tile_rows):
+            row_stop = min(row_start + tile_rows, chunk_len)
+            products[:, :, sample_start:sample_stop] += np.matmul(transposed[:, :, row_start:row_stop],
+                                                                  traces[row_start:row_stop, sample_start:sample_stop])
+
+    sample_starts = range(0, traces.shape[1], tile_samples)
+    if n_threads == 1 or len(sample_starts) == 1:
+        for sample_start in sample_starts:
+            multiply(sample_start)
+        return products
+    # numpy releases the GIL in matmul, a single BLAS thread per tile avoids oversubscription.
+    # The pool lives for a single call, a pool kept in the module would be inherited without
+    # its threads by forked worker processes and block them.
+    with ThreadPoolExecutor(max_workers=n_threads) as pool, blas_threads(1):
+        list(pool.map(multiply, sample_starts))
+    return products
+
+
+def products_numba(hypotheses: np.ndarray, traces: np.ndarray, n_threads: int = 0) -> np.ndarray:
+    global _numba_products
+    if _numba_products is None:
+        @numba.njit(parallel=True, cache=True)
+        def compiled(hypotheses, traces, products):
+            n_bytes, chunk_len, n_guesses = hypotheses.shape
+            for byte in numba.prange(n_bytes):
+                for row in range(chunk_len):
+                    for guess in range(n_guesses):
+                        h = hypotheses[byte, row, guess]
+                        # hamming weight and distance hypotheses are often zero
+                        if h != 0:
+                            for sample in range(traces.shape[1]):
+                                products[byte, guess, sample] += h * traces[row, sample]
+        _numba_products = compiled
+    numba.set_num_threads(n_threads or numba.config.NUMBA_NUM_THREADS)
+    products = np.zeros((hypotheses.shape[0], hypotheses.shape[2], traces.shape[1]), dtype=traces.dtype)
+    _numba_products(np.ascontiguousarray(hypotheses), np.ascontiguousarray(traces), products)
+    return products
+
+
+def select_backend(shape: tuple, dtype=np.float64, n_threads: int = 0, repeat: int = 2) -> str:
+    """
+    Returns the fastest available backend for hypotheses of shape ( n_bytes, chunk_len, n_guesses )
+    and traces of trace_length samples, timed on random data of the shape of the first chunk
+    of every number of key bytes, guesses, samples and threads.
+    :param tuple shape: ( n_bytes, chunk_len, n_guesses, trace_length )
+    """
+    n_bytes, chunk_len, n_guesses, trace_length = shape
+    key = (n_bytes, n_guesses, trace_length, np.dtype(dtype).str, n_threads)
+    if key not in _selected:
+        rng = np.random.default_rng(0)
+        hypotheses = rng.integers(0, 9, (n_bytes, chunk_len, n_guesses)).astype(dtype)
+        traces = rng.integers(0, 256, (chunk_len, trace_length)).astype(dtype)
+        timings = {}
+        for backend in available_backends():
+            # the first call compiles or warms up the backend
+            products(hypotheses, traces, backend, n_threads)
+            start = perf_counter()
+            for _ in range(repeat):
+                products(hypotheses, traces, backend, n_threads)
+            timings[backend] = perf_counter() - start
+        _selected[key] = min(timings, key=timings.get)
+    return _selected[key]
+
+
+def products(hypotheses: np.ndarray, traces: np.ndarray, backend: str = "numpy", n_threads: int = 0) -> np.ndarray:
+    """
+    Returns sum(h*t) of every key byte, key guess and sample over a chunk of traces, computed on n_threads
+    threads ( all cores if 0 ). Hypotheses and traces are multiplied in their own dtype, the tiled backend
+    reduces the tiles in float64.
+
+    Sizes:
+    Hypotheses : ( n_bytes, chunk_len, n_guesses )
+    Traces     : ( chunk_len, trace_length )
+    Products   : ( n_bytes, n_guesses, trace_length )
+    """
+    if backend == "auto":
+        backend = select_backend((*hypotheses.shape, traces.shape[1]), traces.dtype, n_threads)
+    match backend:
+        case "numpy":
+            return products_numpy(hypotheses, traces, n_threads)
+        case "tiled":
+            return products_tiled(hypotheses, traces, n_threads)
+        case "numba":
+            if numba is None:
+                raise ValueError("The numba backend needs numba to be installed.")
+            return products_numba(hypotheses, traces, n_threads)
+        case _:
+            raise ValueError("Unknown correlation backend.")
+
+
+def main():
+    n_bytes, chunk_len, trace_length = 16, 1024, 5000
+    if len(sys.argv) >= 2:
+        chunk_len = int(sys.argv[1])
+    if len(sys.argv) >= 3:
+        trace_length = int(sys.argv[2])
+    rng = np.random.default_rng(0)
+    for dtype in (np.float64, np.float32):
+        hypotheses = rng.integers(0, 9, (n_bytes, chunk_len, 256)).astype(dtype)
+        traces = rng.integers(0, 256, (chunk_len, trace_length)).astype(dtype)
+        reference = products_numpy(hypotheses.astype(np.float64), traces.astype(np.float64))
+        for backend in available_backends():
+            products(hypotheses, traces, backend)
+            start = perf_counter()
+            result = products(hypotheses, traces, backend)
+            seconds = perf_counter() - start
+            error = np.max(np.abs(result - reference)) / np.max(np.abs(reference))
+            print(f"{backend:<6} {np.dtype(dtype).name:<8} {seconds * 1000:8.1f} ms "
+                  f"{chunk_len / seconds:10.0f} traces/s  relative error {error:.1e}")
+        print(f"auto selects: {select_backend((n_bytes, chunk_len, 256, trace_length), dtype)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Table driven leakage models of the attacked AES implementation.
+
+All per-element work is replaced by 256 entry lookup tables, so hypotheses of all key bytes
+and all key guesses are produced by a single batched NumPy indexing operation.
+Besides the two models of the attack modes, further models are kept in a registry by name
+( see register_model ) and can be attacked together in one pass over the traces.
+"""
+from typing import Callable, Dict, NamedTuple, Sequence
+
+import numpy as np
+
+from instrumentation import stage
+
+SBox = np.array([
+    0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67, 0x2B, 0xFE, 0xD7, 0xAB, 0x76,
+    0xCA, 0x82, 0xC9, 0x7D, 0xFA, 0x59, 0x47, 0xF0, 0xAD, 0xD4, 0xA2, 0xAF, 0x9C, 0xA4, 0x72, 0xC0,
+    0xB7, 0xFD, 0x93, 0x26, 0x36, 0x3F, 0xF7, 0xCC, 0x34, 0xA5, 0xE5, 0xF1, 0x71, 0xD8, 0x31, 0x15,
+    0x04, 0xC7, 0x23, 0xC3, 0x18, 0x96, 0x05, 0x9A, 0x07, 0x12, 0x80, 0xE2, 0xEB, 0x27, 0xB2, 0x75,
+    0x09, 0x83, 0x2C, 0x1A, 0x1B, 0x6E, 0x5A, 0xA0, 0x52, 0x3B, 0xD6, 0xB3, 0x29, 0xE3, 0x2F, 0x84,
+    0x53, 0xD1, 0x00, 0xED, 0x20, 0xFC, 0xB1, 0x5B, 0x6A, 0xCB, 0xBE, 0x39, 0x4A, 0x4C, 0x58, 0xCF,
+    0xD0, 0xEF, 0xAA, 0xFB, 0x43, 0x4D, 0x33, 0x85, 0x45, 0xF9, 0x02, 0x7F, 0x50, 0x3C, 0x9F, 0xA8,
+    0x51, 0xA3, 0x40, 0x8F, 0x92, 0x9D, 0x38, 0xF5, 0xBC, 0xB6, 0xDA, 0x21, 0x10, 0xFF, 0xF3, 0xD2,
+    0xCD, 0x0C, 0x13, 0xEC, 0x5F, 0x97, 0x44, 0x17, 0xC4, 0xA7, 0x7E, 0x3D, 0x64, 0x5D, 0x19, 0x73,
+    0x60, 0x81, 0x4F, 0xDC, 0x22, 0x2A, 0x90, 0x88, 0x46, 0xEE, 0xB8, 0x14, 0xDE, 0x5E, 0x0B, 0xDB,
+    0xE0, 0x32, 0x3A, 0x0A, 0x49, 0x06, 0x24, 0x5C, 0xC2, 0xD3, 0xAC, 0x62, 0x91, 0x95, 0xE4, 0x79,
+    0xE7, 0xC8, 0x37, 0x6D, 0x8D, 0xD5, 0x4E, 0xA9, 0x6C, 0x56, 0xF4, 0xEA, 0x65, 0x7A, 0xAE, 0x08,
+    0xBA, 0x78, 0x25, 0x2E, 0x1C, 0xA6, 0xB4, 0xC6, 0xE8, 0xDD, 0x74, 0x1F, 0x4B, 0xBD, 0x8B, 0x8A,
+    0x70, 0x3E, 0xB5, 0x66, 0x48, 0x03, 0xF6, 0x0E, 0x61, 0x35, 0x57, 0xB9, 0x86, 0xC1, 0x1D, 0x9E,
+    0xE1, 0xF8, 0x98, 0x11, 0x69, 0xD9, 0x8E, 0x94, 0x9B, 0x1E, 0x87, 0xE9, 0xCE, 0x55, 0x28, 0xDF,
+    0x8C, 0xA1, 0x89, 0x0D, 0xBF, 0xE6, 0x42, 0x68, 0x41, 0x99, 0x2D, 0x0F, 0xB0, 0x54, 0xBB, 0x16
+    ], dtype='uint8')
+
+
+ShiftRowInverse = np.array([ 0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11 ], dtype=np.uint8)
+SBoxInverse = np.array(
+            [0x52 ,0x09 ,0x6A ,0xD5 ,0x30 ,0x36 ,0xA5 ,0x38 ,0xBF ,0x40 ,0xA3 ,0x9E ,0x81 ,0xF3 ,0xD7 ,0xFB
+            ,0x7C ,0xE3 ,0x39 ,0x82 ,0x9B ,0x2F ,0xFF ,0x87 ,0x34 ,0x8E ,0x43 ,0x44 ,0xC4 ,0xDE ,0xE9 ,0xCB
+            ,0x54 ,0x7B ,0x94 ,0x32 ,0xA6 ,0xC2 ,0x23 ,0x3D ,0xEE ,0x4C ,0x95 ,0x0B ,0x42 ,0xFA ,0xC3 ,0x4E
+            ,0x08 ,0x2E ,0xA1 ,0x66 ,0x28 ,0xD9 ,0x24 ,0xB2 ,0x76 ,0x5B ,0xA2 ,0x49 ,0x6D ,0x8B ,0xD1 ,0x25
+            ,0x72 ,0xF8 ,0xF6 ,0x64 ,0x86 ,0x68 ,0x98 ,0x16 ,0xD4 ,0xA4 ,0x5C ,0xCC ,0x5D ,0x65 ,0xB6 ,0x92
+            ,0x6C ,0x70 ,0x48 ,0x50 ,0xFD ,0xED ,0xB9 ,0xDA ,0x5E ,0x15 ,0x46 ,0x57 ,0xA7 ,0x8D ,0x9D ,0x84
+            ,0x90 ,0xD8 ,0xAB ,0x00 ,0x8C ,0xBC ,0xD3 ,0x0A ,0xF7 ,0xE4 ,0x58 ,0x05 ,0xB8 ,0xB3 ,0x45 ,0x06
+            ,0xD0 ,0x2C ,0x1E ,0x8F ,0xCA ,0x3F ,0x0F ,0x02 ,0xC1 ,0xAF ,0xBD ,0x03 ,0x01 ,0x13 ,0x8A ,0x6B
+            ,0x3A ,0x91 ,0x11 ,0x41 ,0x4F ,0x67 ,0xDC ,0xEA ,0x97 ,0xF2 ,0xCF ,0xCE ,0xF0 ,0xB4 ,0xE6 ,0x73
+            ,0x96 ,0xAC ,0x74 ,0x22 ,0xE7 ,0xAD ,0x35 ,0x85 ,0xE2 ,0xF9 ,0x37 ,0xE8 ,0x1C ,0x75 ,0xDF ,0x6E
+            ,0x47 ,0xF1 ,0x1A ,0x71 ,0x1D ,0x29 ,0xC5 ,0x89 ,0x6F ,0xB7 ,0x62 ,0x0E ,0xAA ,0x18 ,0xBE ,0x1B
+            ,0xFC ,0x56 ,0x3E ,0x4B ,0xC6 ,0xD2 ,0x79 ,0x20 ,0x9A ,0xDB ,0xC0 ,0xFE ,0x78 ,0xCD ,0x5A ,0xF4
+            ,0x1F ,0xDD ,0xA8 ,0x33 ,0x88 ,0x07 ,0xC7 ,0x31 ,0xB1 ,0x12 ,0x10 ,0x59 ,0x27 ,0x80 ,0xEC ,0x5F
+            ,0x60 ,0x51 ,0x7F ,0xA9 ,0x19 ,0xB5 ,0x4A ,0x0D ,0x2D ,0xE5 ,0x7A ,0x9F ,0x93 ,0xC9 ,0x9C ,0xEF
+            ,0xA0 ,0xE0 ,0x3B ,0x4D ,0xAE ,0x2A ,0xF5 ,0xB0 ,0xC8 ,0xEB ,0xBB ,0x3C ,0x83 ,0x53 ,0x99 ,0x61
+            ,0x17 ,0x2B ,0x04 ,0x7E ,0xBA ,0x77 ,0xD6 ,0x26 ,0xE1 ,0x69 ,0x14 ,0x63 ,0x55 ,0x21 ,0x0C ,0x7D],
+            dtype=np.uint8)
+
+KEY_GUESSES = np.arange(256, dtype=np.uint8)
+
+# HammingWeight[x] = number of set bits in x
+HammingWeight = np.array([bin(x).count("1") for x in range(256)], dtype=np.uint8)
+
+# SBoxHammingWeight[p ^ k] = hamming weight of the first round SBox output
+SBoxHammingWeight = HammingWeight[SBox]
+
+# InvSBoxHammingDistance[c ^ k, s] = hamming distance between the state before the last round
+# SBox ( SBoxInverse[c ^ k] ) and the ciphertext byte s it is shifted onto
+InvSBoxHammingDistance = HammingWeight[SBoxInverse[:, np.newaxis] ^ np.arange(256, dtype=np.uint8)]
+
+ATTACK_MODES = [ "lrnd", "frnd" ]
+
+
+def hamming_weight_hypotheses(plaintexts: np.ndarray, byte_indices: Sequence[int] = range(16)) -> np.ndarray:
+    """
+    Hamming weight of the first round SBox output for each key byte, trace and key guess.
+    H[b, i, k] = HW( sbox[ p[i, b] xor k ] )
+
+    Sizes:
+    Plaintexts : ( n_traces, 16 )
+    Hypotheses : ( len(byte_indices), n_traces, 256 )
+    """
+    byte_indices = np.asarray(byte_indices)
+    pt_xor = plaintexts[:, byte_indices].T[:, :, np.newaxis] ^ KEY_GUESSES
+    return SBoxHammingWeight[pt_xor]
+
+
+def hamming_distance_hypotheses(ciphertexts: np.ndarray, byte_indices: Sequence[int] = range(16)) -> np.ndarray:
+    """
+    Hamming distance between the last round SBox input ( state9 ) and the ciphertext byte
+    it ends up in after ShiftRows ( state10 ) for each key byte, trace and key guess.
+    H[b, i, k] = HW( sboxinv[ c[i, b] xor k ] xor c[i, shiftrowinv[b]] )
+
+    Sizes:
+    Ciphertexts : ( n_traces, 16 )
+    Hypotheses  : ( len(byte_indices), n_traces, 256 )
+    """
+    byte_indices = np.asarray(byte_indices)
+    ct_xor = ciphertexts[:, byte_indices].T[:, :, np.newaxis] ^ KEY_GUESSES
+    state10 = ciphertexts[:, ShiftRowInverse[byte_indices]].T[:, :, np.newaxis]
+    return InvSBoxHammingDistance[ct_xor, state10]
+
+
+def hypotheses(texts: np.ndarray, attack_mode: str, byte_indices: Sequence[int] = range(16)) -> np.ndarray:
+    """
+    Hypotheses of the given attack mode for the key bytes in byte_indices,
+    plaintexts for frnd and ciphertexts for lrnd.
+    """
+    with stage("hypotheses", texts.nbytes):
+        match attack_mode:
+            case "lrnd":
+                return hamming_distance_hypotheses(texts, byte_indices)
+            case "frnd":
+                return hamming_weight_hypotheses(texts, byte_indices)
+            case _:
+                raise ValueError("Unknown attack mode.")
+
+
+class LeakageModel(NamedTuple):
+    """
+    A leakage model of a single key byte.
+    :param str name: name of the model in the registry
+    :param str attack_mode: frnd for models of the first round ( plaintexts, encryption key ),
+                            lrnd for models of the last round ( ciphertexts, last round key )
+    :param function: returns the hypotheses ( len(byte_indices), n_traces, 256 ) of texts ( n_traces, 16 )
+    """
+    name: str
+    attack_mode: str
+    function: Callable[[np.ndarray, Sequence[int]], np.ndarray]
+
+
+# all known leakage models by name, see register_model
+LEAKAGE_MODELS: Dict[str, LeakageModel] = {}
+
+
+def register_model(name: str, attack_mode: str, function: Callable[[np.ndarray, Sequence[int]], np.ndarray]):
+    """ Make a leakage model available by name, e.g. to find_key_models. """
+    if attack_mode not in ATTACK_MODES:
+        raise ValueError("Unknown attack mode.")
+    LEAKAGE_MODELS[name] = LeakageModel(name, attack_mode, function)
+
+
+def table_model(table: np.ndarray) -> Callable[[np.ndarray, Sequence[int]], np.ndarray]:
+    """ Model H[b, i, k] = table[ text[i, b] xor k ] of a 256 entry table. """
+    def function(texts: np.ndarray, byte_indices: Sequence[int] = range(16)) -> np.ndarray:
+        byte_indices = np.asarray(byte_indices)
+        return table[texts[:, byte_indices].T[:, :, np.newaxis] ^ KEY_GUESSES]
+    return function
+
+
+def model_hypotheses(model: str, texts: np.ndarray, byte_indices: Sequence[int] = range(16)) -> np.ndarray:
+    """ Hypotheses of a registered leakage model, plaintexts for frnd models and ciphertexts for lrnd models. """
+    if model not in LEAKAGE_MODELS:
+        raise ValueError(f"Unknown leakage model '{model}'.")
+    with stage("hypotheses", texts.nbytes):
+        return LEAKAGE_MODELS[model].function(texts, byte_indices)
+
+
+def state9_ciphertext_distance_hypotheses(ciphertexts: np.ndarray, byte_indices: Sequence[int] = range(16)) -> np.ndarray:
+    """ H[b, i, k] = HW( sboxinv[ c[i, b] xor k ] xor c[i, b] ), the distance to the ciphertext byte itself. """
+    byte_indices = np.asarray(byte_indices)
+    ct = ciphertexts[:, byte_indices].T[:, :, np.newaxis]
+    return InvSBoxHammingDistance[ct ^ KEY_GUESSES, ct]
+
+
+register_model("frnd", "frnd", hamming_weight_hypotheses)
+register_model("lrnd", "lrnd", hamming_distance_hypotheses)
+# hamming weight of the first round SBox input
+register_model("frnd_sbox_in", "frnd", table_model(HammingWeight))
+# single bits of the first round SBox output
+for bit in range(8):
+    register_model(f"frnd_bit{bit}", "frnd", table_model((SBox >> bit) & 1))
+# hamming weight of the last round SBox input
+register_model("lrnd_state9", "lrnd", table_model(HammingWeight[SBoxInverse]))
+register_model("lrnd_ct_distance", "lrnd", state9_ciphertext_distance_hypotheses)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Correlation power analysis of a capture that is still running.
+
+The plaintext, ciphertext and trace files of a capture directory are followed as the
+acquisition appends to them. Only complete records are consumed ( whole lines of the text files,
+whole traces of traces.bin ), the rest is read again on the next poll. Every encryption
+present in all three files is added to a PartitionedAccumulator, whose correlation does not
+depend on the number of accumulated traces, so the current best key can be reported often.
+After every report_every traces the best key, its guessing entropy and estimated rank
+( if the key is known ) are printed, and the key is checked on the first plaintext/ciphertext
+pairs, so the capture can be stopped as soon as the key is found.
+"""
+import os
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+from aeskeyschedule import key_schedule
+
+import leakage
+from accumulator import CPAResult, PartitionedAccumulator
+from enumeration import check_batch
+from measurement import parse_hex_bytes
+from simulate import DEFAULT_CIPHERTEXT_NAME, DEFAULT_PLAINTEXT_NAME, DEFAULT_TRACES_NAME
+
+AES_BLOCK_SIZE = 16
+
+
+class FileTail:
+    """
+    Reads the complete records appended to a growing file since the last read.
+    :param str path: followed file, it does not have to exist yet
+    :param int record_size: size of a binary record in bytes, None for lines of text
+    """
+    def __init__(self, path: str, record_size: int = None):
+        self.path = path
+        self.record_size = record_size
+        self.offset = 0
+
+    def read(self) -> bytes:
+        """ Returns the complete records appended since the last call. """
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(self.offset)
+                data = file.read()
+        except FileNotFoundError:
+            return b""
+        if self.record_size is None:
+            complete = data.rfind(b"\n") + 1
+        else:
+            complete = len(data) - len(data) % self.record_size
+        self.offset += complete
+        return data[:complete]
+
+
+class CaptureFollower:
+    """
+    Follows the plaintexts, ciphertexts and traces of a capture directory and returns the
+    encryptions that are complete in all three files.
+    """
+    def __init__(self, capture_dir: str, trace_length: int,
+                 plaintext_name: str = DEFAULT_PLAINTEXT_NAME,
+                 ciphertext_name: str = DEFAULT_CIPHERTEXT_NAME,
+                 traces_name: str = DEFAULT_TRACES_NAME):
+        self.trace_length = trace_length
+        self.tails = [ FileTail(os.path.join(capture_dir, plaintext_name)),
+                       FileTail(os.path.join(capture_dir, ciphertext_name)),
+                       FileTail(os.path.join(capture_dir, traces_name), trace_length) ]
+        # records read from one file, but not yet from all of them
+        self.pending = [ np.empty((0, AES_BLOCK_SIZE), dtype=np.uint8),
+                         np.empty((0, AES_BLOCK_SIZE), dtype=np.uint8),
+                         np.empty((0, trace_length), dtype=np.uint8) ]
+
+    def poll(self):
+        """ Returns the plaintexts, ciphertexts and traces of the newly completed encryptions. """
+        for i, tail in enumerate(self.tails):
+            data = tail.read()
+            if not data:
+                continue
+            if tail.record_size is None:
+                rows = parse_hex_bytes(np.frombuffer(data, dtype=np.uint8))
+                if rows is None:
+                    # nothing but blank lines
+                    if not data.strip():
+                        continue
+                    raise ValueError(f"'{tail.path}' is not a file of space separated hex bytes.")
+            else:
+                rows = np.frombuffer(data, dtype=np.uint8).reshape(-1, self.trace_length)
+            self.pending[i] = np.concatenate((self.pending[i], rows))
+        n = min(rows.shape[0] for rows in self.pending)
+        complete = [ rows[:n] for rows in self.pending ]
+        self.pending = [ rows[n:] for rows in self.pending ]
+        return complete
+
+
+def print_status(result: CPAResult, found: bool):
+    key_hex_str = ' '.join(f"{byte:02X}" for byte in result.key)
+    status = f"{result.n_traces:>9} traces: {key_hex_str}"
+    if result.ge is not None:
+        lower, estimate, upper = result.key_rank
+        status += f"  GE {result.ge:6.2f}  rank 2^{estimate:.1f} (2^{lower:.1f} - 2^{upper:.1f})"
+    if found:
+        status += "  verified"
+    print(status, flush=True)
+
+
+def follow(capture_dir: str, trace_length: int, attack_mode: str = "lrnd", encryption_key: np.ndarray = None,
+           report_every: int = 1000, poll_interval: float = 0.5, idle_timeout: float = 30.0,
+           stop_when_found: bool = True, n_pairs: int = 4,
+           on_result: Callable[[CPAResult, bool], None] = print_status) -> CPAResult:
+    """
+    Attack a capture while it is written and return the last result.
+    :param str capture_dir: directory with plaintexts.txt, ciphertexts.txt and traces.bin
+    :param int trace_length: number of uint8 samples in a trace
+    :param str attack_mode: lrnd for last round attack, frnd for first round attack
+    :param np.array encryption_key: if known, the guessing entropy and key rank are reported
+    :param int report_every: number of traces between reports
+    :param float poll_interval: seconds between polls of the files
+    :param float idle_timeout: stop after the files did not grow for this many seconds
+    :param bool stop_when_found: stop as soon as the best key encrypts the first n_pairs plaintexts correctly
+    :param on_result: called with every reported result and whether its key was verified
+    """
+    if attack_mode not in leakage.ATTACK_MODES:
+        raise ValueError("Unknown attack mode.")
+    correct_key = None
+    if encryption_key is not None:
+        correct_key = np.array(encryption_key, dtype=np.uint8)
+        if attack_mode == "lrnd":
+            correct_key = np.frombuffer(key_schedule(bytes(correct_key))[10], dtype=np.uint8)
+    follower = CaptureFollower(capture_dir, trace_length)
+    accumulator = PartitionedAccumulator(attack_mode, range(AES_BLOCK_SIZE), trace_length)
+    pairs = [ np.empty((0, AES_BLOCK_SIZE), dtype=np.uint8), np.empty((0, AES_BLOCK_SIZE), dtype=np.uint8) ]
+    result = None
+    next_report = report_every
+    last_growth = time.monotonic()
+
+    while True:
+        plaintexts, ciphertexts, traces = follower.poll()
+        if traces.shape[0] > 0:
+            last_growth = time.monotonic()
+            if pairs[0].shape[0] < n_pairs:
+                pairs = [ np.concatenate((pairs[0], plaintexts))[:n_pairs],
+                          np.concatenate((pairs[1], ciphertexts))[:n_pairs] ]
+            accumulator.update(ciphertexts if attack_mode == "lrnd" else plaintexts, traces)
+        idle = time.monotonic() - last_growth > idle_timeout
+        # the traces after the last report are reported once the capture stopped
+        unreported = accumulator.n > (result.n_traces if result is not None else 0)
+        if accumulator.n >= next_report or (idle and unreported):
+            next_report = (accumulator.n // report_every + 1) * report_every
+            result = accumulator.result(correct_key)
+            found = check_batch(result.key[np.newaxis], pairs[0].tobytes(), pairs[1].tobytes(),
+                                attack_mode == "lrnd") is not None
+            on_result(result, found)
+            if found and stop_when_found:
+                return result
+        if idle:
+            return result
+        if traces.shape[0] == 0:
+            time.sleep(poll_interval)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Not enough arguments: python3 live_cpa.py /path/to/capture_dir trace_length [lrnd|frnd] "
+              "[report_every] [key_hex]")
+        exit()
+    capture_dir = sys.argv[1]
+    trace_length = int(sys.argv[2])
+    attack_mode = sys.argv[3] if len(sys.argv) >= 4 else "lrnd"
+    report_every = int(sys.argv[4]) if len(sys.argv) >= 5 else 1000
+    encryption_key = list(bytes.fromhex(sys.argv[5])) if len(sys.argv) >= 6 else None
+    result = follow(capture_dir, trace_length, attack_mode, encryption_key, report_every)
+    if result is None:
+        print("No complete traces were captured.")
+
+
+if __name__ == "__main__":
+    main()
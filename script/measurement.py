@@ -1,6 +1,87 @@
+import glob
 import os
+import numpy as np
 from numpy import array
 
+from instrumentation import stage
+
+# value of each ASCII hex digit, -1 for whitespace, -2 for any other character
+HEX_DIGIT_VALUES = np.full(256, -2, dtype=np.int16)
+HEX_DIGIT_VALUES[[ord(c) for c in " \t\r\n"]] = -1
+for digit in "0123456789abcdefABCDEF":
+    HEX_DIGIT_VALUES[ord(digit)] = int(digit, 16)
+
+def parse_hex_bytes(data: np.ndarray) -> np.ndarray:
+    """
+    Parse ASCII text ( uint8 array ) with whitespace separated two digit hex bytes, one row
+    per line ( blank lines are skipped ), into a ( lines, bytes_per_line ) uint8 matrix.
+    All characters are decoded at once with a lookup table.
+    Returns None if the text is in any other format.
+    """
+    values = HEX_DIGIT_VALUES[data]
+    is_digit = values >= 0
+    token_starts = is_digit & ~np.concatenate(([False], is_digit[:-1]))
+    token_ends = is_digit & ~np.concatenate((is_digit[1:], [False]))
+    digits = values[is_digit].astype(np.uint8)
+    line_of_token = np.cumsum(data == ord('\n'))[token_starts]
+    _, tokens_per_line = np.unique(line_of_token, return_counts=True)
+    # every token is exactly two digits: its last digit directly follows its first one
+    if (np.any(values == -2) or np.any(np.flatnonzero(token_ends) - np.flatnonzero(token_starts) != 1)
+            or tokens_per_line.size == 0 or np.any(tokens_per_line != tokens_per_line[0])):
+        return None
+    return ((digits[0::2] << 4) | digits[1::2]).reshape(tokens_per_line.size, -1)
+
+def parse_hex_text(file_path: str) -> np.ndarray:
+    """
+    Parse a text file with whitespace separated two digit hex bytes, one row per line,
+    into a ( lines, bytes_per_line ) uint8 matrix, see parse_hex_bytes. np.loadtxt is only
+    used as a fallback for files in any other format.
+    """
+    parsed = parse_hex_bytes(np.fromfile(file_path, dtype=np.uint8))
+    if parsed is None:
+        return np.loadtxt(file_path, converters=lambda x: int(x, 16), dtype=np.uint8, ndmin=2)
+    return parsed
+
+def sidecar_path(file_path: str) -> str:
+    """
+    Path of the binary cache of a text file. The size and modification time of the text
+    file are part of the name, so a changed text file never matches a stale cache.
+    """
+    stat = os.stat(file_path)
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f".{name}.{stat.st_size}-{stat.st_mtime_ns}.npy")
+
+def load_hex_text(file_path: str) -> np.ndarray:
+    """
+    Returns the bytes of a hex text file as a read-only memory mapped uint8 matrix.
+    The text is parsed only once and kept in a .npy sidecar next to it, later calls
+    open the sidecar in constant time.
+    """
+    cache_path = sidecar_path(file_path)
+    if os.path.isfile(cache_path):
+        with stage("load text cache"):
+            return np.load(cache_path, mmap_mode='r')
+    with stage("parse text", os.path.getsize(file_path)):
+        parsed = parse_hex_text(file_path)
+    directory, name = os.path.split(file_path)
+    try:
+        for stale_cache in glob.glob(os.path.join(glob.escape(directory), f".{glob.escape(name)}.*.npy")):
+            # another process may be writing the same cache or removing the stale ones
+            if stale_cache == cache_path:
+                continue
+            try:
+                os.remove(stale_cache)
+            except FileNotFoundError:
+                pass
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.save(file, parsed)
+        os.replace(tmp_path, cache_path)
+        return np.load(cache_path, mmap_mode='r')
+    except OSError as e:
+        print(f"Warning: could not write cache of '{file_path}': {e}")
+        return parsed
+
 class Measurement:
     """
     Class encapsulating a side-channel trace measurement, it's corresponding plaintexts
@@ -10,10 +91,11 @@ class Measurement:
     :param str trace: path to trace file binary uint8_t samples
     :param np.array encryption_key: master key before any key scheduling occurs
     :param int key_length: key length in bytes
+    :param trace_dtype: type of the trace samples, uint8 for captured traces
     """
     def __init__(self, plaintext: str, ciphertext: str,
                   trace: str, encryption_key: array = None,
-                  key_length: int = 16):
+                  key_length: int = 16, trace_dtype = np.uint8):
         if not os.path.isfile(plaintext):
             raise FileNotFoundError(f"The file '{plaintext}' was not found.")
         if not os.path.isfile(ciphertext):
@@ -26,31 +108,61 @@ class Measurement:
         self.plaintext_path = plaintext
         self.ciphertext_path = ciphertext
         self.trace_path = trace
+        self._plaintexts = None
+        self._ciphertexts = None
+        self._traces = None
+        self.trace_dtype = np.dtype(trace_dtype)
+        self.cnt = self.plaintexts.shape[0] # number of total measurements
         self.trace_length = self.get_trace_length()
-        self.cnt = self.get_line_count(self.plaintext_path) # number of total measurements
         self.encryption_key = encryption_key
         self.key_length = key_length
 
+    def __getstate__(self):
+        # memory maps are reopened lazily after unpickling ( e.g. in a worker process ), so the
+        # workers share the page cache of the files instead of receiving copies of the data
+        state = self.__dict__.copy()
+        state['_plaintexts'] = None
+        state['_ciphertexts'] = None
+        state['_traces'] = None
+        return state
+
+    @property
+    def plaintexts(self) -> np.ndarray:
+        """ Read-only ( cnt, 16 ) uint8 matrix of the plaintexts. """
+        if self._plaintexts is None:
+            self._plaintexts = load_hex_text(self.plaintext_path)
+        return self._plaintexts
+
+    @property
+    def ciphertexts(self) -> np.ndarray:
+        """ Read-only ( cnt, 16 ) uint8 matrix of the ciphertexts. """
+        if self._ciphertexts is None:
+            self._ciphertexts = load_hex_text(self.ciphertext_path)
+        return self._ciphertexts
+
+    @property
+    def traces(self) -> np.memmap:
+        """
+        Read-only memory map of the traces, ( cnt, trace_length ) samples of trace_dtype.
+        Only the rows that are actually accessed are read from the disk.
+        """
+        if self._traces is None:
+            self._traces = np.memmap(self.trace_path, dtype=self.trace_dtype, mode='r',
+                                     shape=(self.cnt, self.trace_length))
+        return self._traces
+
     def get_trace_length(self) -> int:
         """
         Returns length of each trace by dividing the size of the binary file
         by the amount of measurements.
         """
-        trace_size = self.get_file_size(self.trace_path)
-        pt_line_count = self.get_line_count(self.plaintext_path)
+        trace_size = self.get_file_size(self.trace_path) // self.trace_dtype.itemsize
+        pt_line_count = self.cnt
         if trace_size % pt_line_count != 0:
             print(f"Trace size: {trace_size}\nPT line count: {pt_line_count}")
             raise ValueError("Binary data size is not a multiple of PT line count")
         return trace_size // pt_line_count
 
-    def get_line_count(self, file_path: str) -> int:
-        """
-        Returns the amount of non-blank lines in a file.
-        """
-        with open(file_path, 'r') as file:
-            line_count = sum(1 for line in file if line.strip())
-        return line_count
-
     def get_file_size(self, file_path: str) -> int:
         try:
             size = os.path.getsize(file_path)
@@ -59,3 +171,110 @@ class Measurement:
             print(f"The file '{file_path}' was not found.")
         except Exception as e:
             print(f"An error occurred: {e}")
+
+def open_capture(capture_dir: str, encryption_key: array = None, trace_dtype = np.uint8) -> Measurement:
+    """ Open the plaintexts.txt, ciphertexts.txt and traces.bin of a capture directory. """
+    return Measurement(plaintext=os.path.join(capture_dir, "plaintexts.txt"),
+                       ciphertext=os.path.join(capture_dir, "ciphertexts.txt"),
+                       trace=os.path.join(capture_dir, "traces.bin"),
+                       encryption_key=encryption_key, trace_dtype=trace_dtype)
+
+class ConcatenatedTraces:
+    """
+    Read-only view of the traces of several measurements as a single ( cnt, trace_length ) matrix.
+    Indexing with a slice or an array of rows reads only the requested rows of each part
+    and returns them as a new array, the files are never copied into one. np.asarray reads all rows.
+    """
+    def __init__(self, parts: list):
+        self.parts = parts
+        # first row of each part, and the total number of rows
+        self.offsets = np.cumsum([0] + [part.shape[0] for part in parts])
+        self.shape = (int(self.offsets[-1]), parts[0].shape[1])
+        self.dtype = parts[0].dtype
+        self.ndim = 2
+        self.nbytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        traces = self[:]
+        return traces if dtype is None else traces.astype(dtype)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            if isinstance(index[0], (int, np.integer)):
+                # a single row is one dimensional
+                return self[index[0]][index[1:]]
+            return self[index[0]][(slice(None),) + index[1:]]
+        if isinstance(index, (int, np.integer)):
+            return self[np.array([index])][0]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.shape[0])
+            if step == 1:
+                rows = []
+                for part, offset in zip(self.parts, self.offsets[:-1]):
+                    part_start, part_stop = max(start - offset, 0), min(stop - offset, part.shape[0])
+                    if part_start < part_stop:
+                        rows.append(part[part_start:part_stop])
+                if not rows:
+                    return np.empty((0, self.shape[1]), dtype=self.dtype)
+                return np.concatenate(rows)
+            index = np.arange(start, stop, step)
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = np.where(index < 0, index + self.shape[0], index)
+        result = np.empty((index.shape[0], self.shape[1]), dtype=self.dtype)
+        part_of_row = np.searchsorted(self.offsets, index, side='right') - 1
+        for i in np.unique(part_of_row):
+            selected = part_of_row == i
+            result[selected] = self.parts[i][index[selected] - self.offsets[i]]
+        return result
+
+class ConcatenatedMeasurement(Measurement):
+    """
+    Several measurements of the same key attacked as one, without copying their traces.
+    The plaintexts and ciphertexts are concatenated in memory ( 32 bytes per trace ),
+    the traces are read from the files of the parts ( see ConcatenatedTraces ).
+    :param list parts: measurements with the same trace length and sample type
+    :param np.array encryption_key: master key, the key of the first part if not given
+    """
+    def __init__(self, parts: list, encryption_key: array = None):
+        # the parts are opened already, so the files are not checked again
+        if len(parts) == 0:
+            raise ValueError("No measurements to concatenate.")
+        if len({ part.trace_length for part in parts }) != 1 or len({ part.trace_dtype for part in parts }) != 1:
+            raise ValueError("The concatenated measurements must have the same trace length and sample type.")
+        if encryption_key is None:
+            encryption_key = parts[0].encryption_key
+        self.parts = parts
+        self.plaintext_path = None
+        self.ciphertext_path = None
+        self.trace_path = None
+        self._plaintexts = None
+        self._ciphertexts = None
+        self._traces = None
+        self.trace_dtype = parts[0].trace_dtype
+        self.cnt = sum(part.cnt for part in parts)
+        self.trace_length = parts[0].trace_length
+        self.encryption_key = encryption_key
+        self.key_length = parts[0].key_length
+
+    @property
+    def plaintexts(self) -> np.ndarray:
+        if self._plaintexts is None:
+            self._plaintexts = np.concatenate([ part.plaintexts for part in self.parts ])
+        return self._plaintexts
+
+    @property
+    def ciphertexts(self) -> np.ndarray:
+        if self._ciphertexts is None:
+            self._ciphertexts = np.concatenate([ part.ciphertexts for part in self.parts ])
+        return self._ciphertexts
+
+    @property
+    def traces(self) -> ConcatenatedTraces:
+        if self._traces is None:
+            self._traces = ConcatenatedTraces([ part.traces for part in self.parts ])
+        return self._traces
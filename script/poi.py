@@ -0,0 +1,115 @@
+"""
+Automatic selection of points of interest ( trace samples ) before correlation.
+
+The leakage window is estimated in a single streaming pass over the traces, either by
+the signal-to-noise ratio of the samples with the traces partitioned by the value of each
+plaintext/ciphertext byte ( snr ), or by the maximum absolute correlation of the attack's
+leakage model over all key bytes and key guesses ( corr ). Only the chosen samples are then
+handed to the attack.
+"""
+import numpy as np
+
+import leakage
+from accumulator import CPAAccumulator, class_sums
+from measurement import Measurement
+
+POI_METHODS = [ "snr", "corr" ]
+
+
+class SNRAccumulator:
+    """
+    Per class sums of the traces and of their squares, the traces of each key byte
+    are partitioned by the value of the corresponding text byte.
+    :param int n_bytes: number of text bytes
+    :param int trace_length: number of samples in a trace
+    :param int n_classes: number of values of the text bytes ( e.g. 9 for hamming weights )
+    """
+    def __init__(self, n_bytes: int, trace_length: int, n_classes: int = 256):
+        self.n = 0
+        self.n_classes = n_classes
+        self.counts = np.zeros((n_bytes, n_classes))
+        self.sums = np.zeros((n_bytes, n_classes, trace_length))
+        self.squared_sums = np.zeros((n_bytes, n_classes, trace_length))
+
+    def update(self, texts: np.ndarray, traces: np.ndarray):
+        """
+        Sizes:
+        Texts  : ( chunk_len, 16 )
+        Traces : ( chunk_len, trace_length )
+        """
+        t = traces.astype(np.float64)
+        self.n += t.shape[0]
+        for i in range(self.counts.shape[0]):
+            self.counts[i] += np.bincount(texts[:, i], minlength=self.n_classes)
+            self.sums[i] += class_sums(texts[:, i], t, self.n_classes)
+            self.squared_sums[i] += class_sums(texts[:, i], t * t, self.n_classes)
+
+    def snr(self) -> np.ndarray:
+        """
+        Returns the signal-to-noise ratio of each text byte and sample, ( n_bytes, trace_length ):
+        variance of the class means divided by the mean variance within the classes.
+        """
+        counts = self.counts[:, :, np.newaxis]
+        occupied = counts > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            class_means = np.where(occupied, self.sums / counts, 0.0)
+            mean = np.sum(self.sums, axis=1, keepdims=True) / self.n
+            signal = np.sum(np.where(occupied, counts * (class_means - mean) ** 2, 0.0), axis=1) / self.n
+            noise = np.sum(self.squared_sums - np.where(occupied, self.sums * class_means, 0.0), axis=1) / self.n
+            return np.where(noise > 0, signal / noise, 0.0)
+
+
+def poi_scores(measurement: Measurement, attack_mode: str, method: str = "snr",
+               n_traces: int = 0, chunk_size: int = 1024) -> np.ndarray:
+    """
+    Returns a leakage score of each trace sample computed over the first n_traces traces ( all if 0 ),
+    the maximum over all key bytes ( and key guesses for corr ).
+    """
+    if attack_mode not in leakage.ATTACK_MODES:
+        raise ValueError("Unknown attack mode.")
+    if method not in POI_METHODS:
+        raise ValueError("Unknown point of interest method.")
+    if n_traces == 0:
+        n_traces = measurement.cnt
+    texts = measurement.ciphertexts if attack_mode == "lrnd" else measurement.plaintexts
+    traces = measurement.traces
+    n_bytes = measurement.key_length
+
+    if method == "snr":
+        accumulator = SNRAccumulator(n_bytes, measurement.trace_length)
+    else:
+        accumulator = CPAAccumulator(n_bytes, measurement.trace_length)
+    for start in range(0, n_traces, chunk_size):
+        stop = min(start + chunk_size, n_traces)
+        if method == "snr":
+            accumulator.update(texts[start:stop], traces[start:stop])
+        else:
+            accumulator.update(leakage.hypotheses(texts[start:stop], attack_mode, range(n_bytes)),
+                               traces[start:stop])
+
+    if method == "snr":
+        return np.max(accumulator.snr(), axis=0)
+    return np.max([ np.max(accumulator.correlation(i), axis=0) for i in range(n_bytes) ], axis=0)
+
+
+def select_poi(scores: np.ndarray, n_poi: int, window: bool = False) -> np.ndarray:
+    """
+    Returns the sorted indices of the n_poi samples with the highest scores, or with window=True
+    the contiguous window of n_poi samples with the highest sum of scores.
+    """
+    n_poi = min(n_poi, scores.shape[0])
+    if window:
+        window_sums = np.convolve(scores, np.ones(n_poi), mode="valid")
+        start = int(np.argmax(window_sums))
+        return np.arange(start, start + n_poi)
+    return np.sort(np.argsort(-scores, kind="stable")[:n_poi])
+
+
+def find_poi(measurement: Measurement, attack_mode: str, n_poi: int, method: str = "snr",
+             window: bool = False, n_traces: int = 0) -> np.ndarray:
+    """
+    Returns the points of interest of a measurement for the given attack mode.
+    """
+    poi = select_poi(poi_scores(measurement, attack_mode, method, n_traces), n_poi, window)
+    print(f"Points of interest ({method}): {poi[0]}-{poi[-1]}, {poi.shape[0]} samples")
+    return poi
@@ -0,0 +1,69 @@
+"""
+Ranking of key guesses and estimation of the rank of the full key.
+
+Per key byte ranks of all key bytes are computed with a single argsort over the
+( n_bytes, 256 ) matrix of maximum correlations. The rank of the full 128-bit key is
+estimated by histogram convolution: the per byte scores are binned with a common bin width,
+the histograms of all key bytes are convolved, and the keys in the bins above the bin of the
+correct key are counted. Because of the binning the estimate is returned with bounds.
+"""
+from typing import Tuple
+
+import numpy as np
+
+
+def key_ranks(max_corr: np.ndarray, correct_key: np.ndarray) -> np.ndarray:
+    """
+    Returns the place of the correct key byte among all key guesses sorted by their
+    maximum correlation ( descending ), for each key byte. Ties keep the order of key guesses.
+    """
+    order = np.argsort(-max_corr, axis=1, kind="stable")
+    correct = np.asarray(correct_key, dtype=np.int64)[:max_corr.shape[0], np.newaxis]
+    return np.argmax(order == correct, axis=1)
+
+
+def correlation_scores(max_corr: np.ndarray, n_traces: int) -> np.ndarray:
+    """
+    Convert maximum absolute correlations to additive log-likelihood scores.
+    The Fisher z-transform of a correlation is approximately normal with variance 1 / ( n - 3 ),
+    so the log-likelihood ratio of a key guess against the no correlation hypothesis
+    is ( n - 3 ) * atanh( rho )^2 / 2. Scores of independent key bytes add up.
+    """
+    rho = np.clip(max_corr, 0.0, 1.0 - 1e-12)
+    return max(n_traces - 3, 1) * np.arctanh(rho) ** 2 / 2
+
+
+def rank_estimate(scores: np.ndarray, correct_key: np.ndarray, n_bins: int = 512) -> Tuple[float, float, float]:
+    """
+    Estimate the rank of the full key from per byte scores ( n_bytes, 256 ), higher is better.
+    Returns log2 of the lower bound, estimate and upper bound of the rank, rank 1 ( 0 ) is the key found.
+    """
+    n_bytes = scores.shape[0]
+    low = np.min(scores, axis=1, keepdims=True)
+    width = np.max(np.max(scores, axis=1, keepdims=True) - low) / (n_bins - 1)
+    if width == 0:
+        # all guesses of all bytes are equally likely
+        return 0.0, n_bytes * 4.0, n_bytes * 8.0
+    bins = np.floor((scores - low) / width).astype(np.int64)
+    correct_bin = int(np.sum(bins[np.arange(n_bytes), np.asarray(correct_key[:n_bytes], dtype=np.int64)]))
+
+    # number of full keys in each bin of the sum of the per byte bins
+    histogram = np.ones(1)
+    for byte_bins in bins:
+        histogram = np.convolve(histogram, np.bincount(byte_bins, minlength=n_bins).astype(np.float64))
+    keys_from = np.cumsum(histogram[::-1])[::-1]  # keys_from[b] = number of keys in bins >= b
+
+    def keys_in_bins_from(first_bin: int) -> float:
+        first_bin = max(first_bin, 0)
+        return keys_from[first_bin] if first_bin < keys_from.shape[0] else 0.0
+
+    # every byte is rounded by less than one bin, so the sum by less than n_bytes bins
+    lower = keys_in_bins_from(correct_bin + n_bytes) + 1
+    estimate = keys_in_bins_from(correct_bin)
+    upper = keys_in_bins_from(correct_bin - n_bytes)
+    return float(np.log2(lower)), float(np.log2(max(estimate, lower))), float(np.log2(max(upper, lower)))
+
+
+def full_key_rank(max_corr: np.ndarray, n_traces: int, correct_key: np.ndarray) -> Tuple[float, float, float]:
+    """ log2 bounds and estimate of the rank of the full key from maximum correlations of a CPA. """
+    return rank_estimate(correlation_scores(max_corr, n_traces), correct_key)
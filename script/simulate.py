@@ -0,0 +1,179 @@
+"""
+Synthetic side-channel measurements of a real AES-128 encryption.
+
+Writes plaintexts, ciphertexts and traces in the same format as standardize_rds_output.py,
+so the result can be opened as a Measurement and attacked without any captured data.
+simulate_live() writes them slowly, as a stand-in for a running acquisition ( see live_cpa.py ).
+"""
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from Crypto.Cipher import AES
+from aeskeyschedule import key_schedule
+
+import leakage
+from measurement import Measurement
+from standardize_rds_output import HEX_TOKENS
+
+DEFAULT_PLAINTEXT_NAME = "plaintexts.txt"
+DEFAULT_CIPHERTEXT_NAME = "ciphertexts.txt"
+DEFAULT_TRACES_NAME = "traces.bin"
+
+
+def write_hex_lines(file, data: np.ndarray):
+    """ Write the rows of a uint8 matrix as lines of space separated hex bytes. """
+    lines = np.empty((data.shape[0], 3 * data.shape[1] + 1), dtype=np.uint8)
+    lines[:, :-1] = HEX_TOKENS[data].reshape(data.shape[0], -1)
+    lines[:, -1] = ord('\n')
+    file.write(lines.tobytes())
+
+
+def model_leakage(plaintexts: np.ndarray, ciphertexts: np.ndarray, key: np.ndarray,
+                  leakage_model: str) -> np.ndarray:
+    """
+    Returns the leakage of each trace summed over all 16 state bytes ( a round based implementation ):
+    frnd: hamming weight of the first round SBox output
+    lrnd: hamming distance between the last round SBox input and the ciphertext
+    """
+    if leakage_model == "frnd":
+        return np.sum(leakage.SBoxHammingWeight[plaintexts ^ key], axis=1)
+    if leakage_model == "lrnd":
+        last_round_key = np.frombuffer(key_schedule(bytes(key))[10], dtype=np.uint8)
+        state9 = leakage.SBoxInverse[ciphertexts ^ last_round_key]
+        return np.sum(leakage.HammingWeight[state9 ^ ciphertexts[:, leakage.ShiftRowInverse]], axis=1)
+    raise ValueError("Unknown leakage model.")
+
+
+def check_leak_sample(trace_length: int, jitter: int, leak_sample: int):
+    if leak_sample - jitter < 0 or leak_sample + jitter >= trace_length:
+        raise ValueError("The leaking sample with jitter does not fit in the trace.")
+
+
+def waveform(trace_length: int, pattern_amplitude: float) -> np.ndarray:
+    """ A chirp, the same in every trace, which makes the jitter of the traces visible to an alignment. """
+    samples = np.arange(trace_length)
+    return pattern_amplitude * np.sin(np.pi * samples * samples / trace_length)
+
+
+def generate_chunks(rng: np.random.Generator, key: np.ndarray, n_traces: int, trace_length: int,
+                    leakage_model: str, noise: float, jitter: int, leak_sample: int, amplitude: float,
+                    offset: float, chunk_size: int, pattern_amplitude: float = 0.0):
+    """ Yields the plaintexts, ciphertexts and uint8 traces of at most chunk_size encryptions at a time. """
+    cipher = AES.new(bytes(key), AES.MODE_ECB)
+    for start in range(0, n_traces, chunk_size):
+        rows = min(chunk_size, n_traces - start)
+        plaintexts = rng.integers(0, 256, (rows, 16), dtype=np.uint8)
+        ciphertexts = np.frombuffer(cipher.encrypt(plaintexts.tobytes()), dtype=np.uint8).reshape(rows, 16)
+        traces = rng.normal(offset, noise, (rows, trace_length))
+        shifts = rng.integers(-jitter, jitter + 1, rows) if jitter > 0 else np.zeros(rows, dtype=np.int64)
+        traces[np.arange(rows), leak_sample + shifts] += amplitude * model_leakage(plaintexts, ciphertexts,
+                                                                                    key, leakage_model)
+        if pattern_amplitude != 0:
+            # the whole trace is shifted with the leaking sample
+            samples = np.clip(np.arange(trace_length) - shifts[:, np.newaxis], 0, trace_length - 1)
+            traces += waveform(trace_length, pattern_amplitude)[samples]
+        yield plaintexts, ciphertexts, np.clip(np.rint(traces), 0, 255).astype(np.uint8)
+
+
+def simulate(out_dir: str, n_traces: int, trace_length: int = 256, leakage_model: str = "frnd",
+             noise: float = 2.0, jitter: int = 0, key: np.ndarray = None, leak_sample: int = 80,
+             amplitude: float = 1.0, offset: float = 60.0, seed: int = 0,
+             chunk_size: int = 65536, pattern_amplitude: float = 0.0) -> Measurement:
+    """
+    Generate a synthetic measurement in out_dir and return it.
+    :param int n_traces: number of encryptions
+    :param int trace_length: number of uint8 samples in a trace
+    :param str leakage_model: frnd ( HW first round ) or lrnd ( HD last round )
+    :param float noise: standard deviation of the gaussian noise of every sample
+    :param int jitter: the leaking sample is shifted by a uniform random offset in [ -jitter, jitter ]
+    :param np.ndarray key: encryption key, random if not given
+    :param int leak_sample: sample of the leakage without jitter
+    :param float amplitude: leakage of a single bit
+    :param float offset: mean sample value without leakage
+    :param int seed: seed of the random generator
+    :param float pattern_amplitude: amplitude of a waveform shifted with the jitter, see waveform()
+    """
+    check_leak_sample(trace_length, jitter, leak_sample)
+    rng = np.random.default_rng(seed)
+    if key is None:
+        key = rng.integers(0, 256, 16, dtype=np.uint8)
+    key = np.asarray(key, dtype=np.uint8)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with open(os.path.join(out_dir, DEFAULT_PLAINTEXT_NAME), 'wb') as pt_file, \
+         open(os.path.join(out_dir, DEFAULT_CIPHERTEXT_NAME), 'wb') as ct_file, \
+         open(os.path.join(out_dir, DEFAULT_TRACES_NAME), 'wb') as trace_file:
+        for plaintexts, ciphertexts, traces in generate_chunks(rng, key, n_traces, trace_length, leakage_model,
+                                                               noise, jitter, leak_sample, amplitude, offset,
+                                                               chunk_size, pattern_amplitude):
+            write_hex_lines(pt_file, plaintexts)
+            write_hex_lines(ct_file, ciphertexts)
+            trace_file.write(traces.tobytes())
+
+    return Measurement(plaintext=os.path.join(out_dir, DEFAULT_PLAINTEXT_NAME),
+                       ciphertext=os.path.join(out_dir, DEFAULT_CIPHERTEXT_NAME),
+                       trace=os.path.join(out_dir, DEFAULT_TRACES_NAME),
+                       encryption_key=list(key))
+
+
+def simulate_live(out_dir: str, n_traces: int, traces_per_second: float, trace_length: int = 256,
+                  leakage_model: str = "frnd", noise: float = 2.0, jitter: int = 0, key: np.ndarray = None,
+                  leak_sample: int = 80, amplitude: float = 1.0, offset: float = 60.0, seed: int = 0,
+                  chunk_size: int = 100) -> np.ndarray:
+    """
+    Stand-in for a running acquisition: append the encryptions of simulate() to the files in
+    out_dir at about traces_per_second. Every chunk is written in two parts with a pause between
+    them, so a reader following the files also sees incomplete lines and traces.
+    Returns the encryption key.
+    """
+    check_leak_sample(trace_length, jitter, leak_sample)
+    rng = np.random.default_rng(seed)
+    if key is None:
+        key = rng.integers(0, 256, 16, dtype=np.uint8)
+    key = np.asarray(key, dtype=np.uint8)
+    os.makedirs(out_dir, exist_ok=True)
+    pause = chunk_size / traces_per_second / 2
+
+    with open(os.path.join(out_dir, DEFAULT_PLAINTEXT_NAME), 'wb') as pt_file, \
+         open(os.path.join(out_dir, DEFAULT_CIPHERTEXT_NAME), 'wb') as ct_file, \
+         open(os.path.join(out_dir, DEFAULT_TRACES_NAME), 'wb') as trace_file:
+        for plaintexts, ciphertexts, traces in generate_chunks(rng, key, n_traces, trace_length, leakage_model,
+                                                               noise, jitter, leak_sample, amplitude, offset,
+                                                               chunk_size):
+            parts = [ io.BytesIO(), io.BytesIO(), io.BytesIO() ]
+            write_hex_lines(parts[0], plaintexts)
+            write_hex_lines(parts[1], ciphertexts)
+            parts[2].write(traces.tobytes())
+            for half in range(2):
+                for file, part in zip((pt_file, ct_file, trace_file), parts):
+                    data = part.getvalue()
+                    split = len(data) // 2 + 1
+                    file.write(data[:split] if half == 0 else data[split:])
+                    file.flush()
+                time.sleep(pause)
+    return key
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Not enough arguments: python3 simulate.py /path/to/out_dir n_traces [frnd|lrnd] [noise] [jitter] "
+              "[traces_per_second]")
+        exit()
+    out_dir = sys.argv[1]
+    n_traces = int(sys.argv[2])
+    leakage_model = sys.argv[3] if len(sys.argv) >= 4 else "frnd"
+    noise = float(sys.argv[4]) if len(sys.argv) >= 5 else 2.0
+    jitter = int(sys.argv[5]) if len(sys.argv) >= 6 else 0
+    if len(sys.argv) >= 7:
+        key = simulate_live(out_dir, n_traces, float(sys.argv[6]), leakage_model=leakage_model,
+                            noise=noise, jitter=jitter)
+    else:
+        key = simulate(out_dir, n_traces, leakage_model=leakage_model, noise=noise, jitter=jitter).encryption_key
+    print(f"Key: {' '.join(f'{byte:02X}' for byte in key)}")
+
+
+if __name__ == "__main__":
+    main()
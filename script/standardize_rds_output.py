@@ -6,48 +6,163 @@ Outputs:
 - traces as a .bin file with 8-bit unsigned integers
 """
 
-import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import sys
 import os
 
+import numpy as np
+
 DEFAULT_CIPHERTEXT_NAME = "ciphertexts.bin"
 DEFAULT_PLAINTEXT_NAME = "plaintexts.bin"
 DEFAULT_KEY_NAME = "keys.bin"
 DEFAULT_TRACES_PART_OF_NAME = "sensor_traces"
+# lines of the csv converted at once, bytes per line of the plaintext/ciphertext/key files
+CSV_CHUNK_LINES = 16384
+BLOCK_SIZE = 16
+
+# hamming weight of the value of each ASCII hex digit, 0 for any other character
+HEX_DIGIT_HAMMING_WEIGHT = np.zeros(256, dtype=np.uint8)
+IS_HEX_DIGIT = np.zeros(256, dtype=bool)
+for digit in "0123456789abcdefABCDEF":
+    HEX_DIGIT_HAMMING_WEIGHT[ord(digit)] = bin(int(digit, 16)).count("1")
+    IS_HEX_DIGIT[ord(digit)] = True
+# characters allowed in the csv besides the hex digits
+IS_CSV_SEPARATOR = np.zeros(256, dtype=bool)
+IS_CSV_SEPARATOR[[ord(c) for c in ",\r\n"]] = True
+
+# "XX " text of each byte value
+HEX_TOKENS = np.array([list(f"{value:02X} ".encode()) for value in range(256)], dtype=np.uint8)
 
-def hamm_weight(hex_num : str) -> int:
-    """ Calculate the hamming weight of a hexadecimal number """
-    return bin(int(hex_num, 16)).count("1")
+def csv_chunk_to_hamm_weights(lines: bytes) -> bytes:
+    """
+    Returns the hamming weights of all cells of complete, non-blank csv lines as bytes.
+    The hamming weight of a hex number is the sum of the hamming weights of its digits,
+    so every character is looked up in a table and the weights are summed per cell.
+    Raises ValueError for characters other than hex digits, commas and line ends, for empty cells,
+    for weights that do not fit in a byte and for lines with different numbers of cells.
+    """
+    data = np.frombuffer(lines, dtype=np.uint8)
+    is_digit = IS_HEX_DIGIT[data]
+    if not np.all(is_digit | IS_CSV_SEPARATOR[data]):
+        raise ValueError("The csv contains a character that is not a hex digit.")
+    line_ends = data == ord('\n')
+    separators = (data == ord(',')) | line_ends
+    # each separator closes the cell it belongs to
+    cell_of_char = np.cumsum(separators) - separators
+    n_cells = np.count_nonzero(separators)
+    weights = np.bincount(cell_of_char, weights=HEX_DIGIT_HAMMING_WEIGHT[data], minlength=n_cells)
+    if np.any(np.bincount(cell_of_char, weights=is_digit, minlength=n_cells) == 0):
+        raise ValueError("The csv contains an empty cell.")
+    if np.any(weights > 255):
+        raise ValueError("The hamming weight of a csv cell does not fit in a byte.")
+    # every line end closes a line, the cells of a line are the separators up to its end
+    cells_per_line = np.diff(np.concatenate(([0], np.cumsum(separators)[line_ends])))
+    if np.any(cells_per_line != cells_per_line[0]):
+        raise ValueError("The lines of the csv have different numbers of cells.")
+    return weights.astype(np.uint8).tobytes()
 
-def csv_to_bin(infile: str, n_traces: int):
+def read_csv_chunks(ifile, n_traces: int, chunk_lines: int = CSV_CHUNK_LINES):
+    """
+    Yields chunks of at most chunk_lines complete csv lines from the first n_traces rows,
+    blank rows are counted as rows but skipped.
+    """
+    rows_left = n_traces
+    while rows_left > 0:
+        lines = list(islice(ifile, min(chunk_lines, rows_left)))
+        if not lines:
+            return
+        rows_left -= len(lines)
+        if not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        yield b''.join(line for line in lines if line.strip(b'\r\n'))
+
+def csv_to_bin(infile: str, n_traces: int, workers: int = 1):
     """
     Read a csv file with hexadecimal numbers, get their hamming weight, 
     convert the hamming weight to binary and write result to a binary file
+    The csv is converted in chunks of lines, optionally spread over a process pool,
+    and every chunk is written with a single buffered write.
+    Raises ValueError if a cell is not a hex number or the lines have different numbers of cells.
     """
     outfile = os.path.join(os.path.split(infile)[0], "traces.bin")
     print(f"Converting {infile} to {outfile}...")
-    with open(infile, "r") as ifile:
-        reader = csv.reader(ifile, lineterminator="\n")
-        with open(outfile, "wb") as ofile:
-            for i, row in enumerate(reader):
-                if i == n_traces:
-                    break
-                # calculate hamming weight of each number in row and convert it to binary, then write is as a byte
-                for item in row:
-                    ofile.write(bytes([hamm_weight(item)]))
-
-def bin_to_txt(input_file: str, n_traces: int):
+    trace_length = None
+
+    def write(chunk: bytes, weights: bytes):
+        # the cells of the lines of a chunk are checked by csv_chunk_to_hamm_weights, the chunks here
+        nonlocal trace_length
+        chunk_length = len(weights) // chunk.count(b'\n')
+        if trace_length is None:
+            trace_length = chunk_length
+        if chunk_length != trace_length:
+            raise ValueError("The lines of the csv have different numbers of cells.")
+        ofile.write(weights)
+
+    with open(infile, "rb") as ifile, open(outfile, "wb") as ofile:
+        chunks = read_csv_chunks(ifile, n_traces)
+        if workers <= 1:
+            for chunk in chunks:
+                if chunk:
+                    write(chunk, csv_chunk_to_hamm_weights(chunk))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # keep a bounded number of chunks in flight, written in their original order
+            pending = deque()
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                pending.append((chunk, pool.submit(csv_chunk_to_hamm_weights, chunk)))
+                if len(pending) >= 2 * workers:
+                    chunk, future = pending.popleft()
+                    write(chunk, future.result())
+            while pending:
+                chunk, future = pending.popleft()
+                write(chunk, future.result())
+
+def bin_to_txt(input_file: str, n_traces: int, chunk_rows: int = 65536):
+    """
+    Write the first n_traces blocks of 16 bytes of a binary file as lines of space separated hex bytes.
+    Missing bytes ( the binary file is shorter than n_traces blocks ) are written as blanks.
+    """
     output_file = os.path.splitext(input_file)[0]+".txt" 
     print(f"Converting {input_file} to {output_file}...")
-    bin_file = open(input_file, 'rb')
-    text_file = open(output_file, 'w')
-    for i in range(0, n_traces):
-        for j in range(0, 16):
-            text_file.write(str(bin_file.read(1).hex().upper()))
-            text_file.write(' ')
-        text_file.write('\n')
-    text_file.close()
-    bin_file.close()
+    with open(input_file, 'rb') as bin_file, open(output_file, 'wb') as text_file:
+        for start in range(0, n_traces, chunk_rows):
+            rows = min(chunk_rows, n_traces - start)
+            data = np.frombuffer(bin_file.read(rows * BLOCK_SIZE), dtype=np.uint8)
+            full_rows = data.size // BLOCK_SIZE
+            lines = np.empty((full_rows, 3 * BLOCK_SIZE + 1), dtype=np.uint8)
+            lines[:, :-1] = HEX_TOKENS[data[:full_rows * BLOCK_SIZE]].reshape(full_rows, -1)
+            lines[:, -1] = ord('\n')
+            text_file.write(lines.tobytes())
+            if full_rows < rows:
+                partial = data[full_rows * BLOCK_SIZE:]
+                text_file.write(HEX_TOKENS[partial].tobytes() + b' ' * (BLOCK_SIZE - partial.size) + b'\n'
+                                + (b' ' * BLOCK_SIZE + b'\n') * (rows - full_rows - 1))
+
+def count_csv_lines(file_path: str, buffer_size: int = 1 << 24) -> int:
+    """ Returns the number of lines of a file, including a last line without a newline. """
+    line_count = 0
+    last_byte = b'\n'
+    with open(file_path, 'rb') as file:
+        while buffer := file.read(buffer_size):
+            line_count += buffer.count(b'\n')
+            last_byte = buffer[-1:]
+    return line_count + (last_byte != b'\n')
+
+def count_traces(traces_dir: str, trace_file: str) -> int:
+    """
+    Derive the number of traces from the files: the number of csv rows, limited by the number of
+    complete plaintext and ciphertext blocks.
+    """
+    counts = [ count_csv_lines(f"{traces_dir}/{trace_file}"),
+               os.path.getsize(f"{traces_dir}/{DEFAULT_PLAINTEXT_NAME}") // BLOCK_SIZE,
+               os.path.getsize(f"{traces_dir}/{DEFAULT_CIPHERTEXT_NAME}") // BLOCK_SIZE ]
+    if len(set(counts)) != 1:
+        print(f"Warning: trace, plaintext and ciphertext counts differ: {counts}, using {min(counts)}")
+    return min(counts)
 
 
 def find_trace_file ( traces_dir: str ):
@@ -56,8 +171,6 @@ def find_trace_file ( traces_dir: str ):
             return file
     return None
 
-# todo: automatically derive the number of traces from the traces file
-
 def check_files_exist ( traces_dir: str ):
     """
     Check if the necessary files exist in the traces directory
@@ -79,11 +192,12 @@ def check_files_exist ( traces_dir: str ):
     return trace_file_name
 
 def main():
-    if len(sys.argv) != 3:
-        print("Not enough arguments: python3 standardize_rds_output.py /path/to/traces_dir n_traces")
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Wrong arguments: python3 standardize_rds_output.py /path/to/traces_dir [n_traces] [workers]")
         exit()
     traces_dir = sys.argv[1]
-    n_traces = int(sys.argv[2])
+    n_traces = int(sys.argv[2]) if len(sys.argv) >= 3 else 0
+    workers = int(sys.argv[3]) if len(sys.argv) == 4 else 1
     if not os.path.exists(traces_dir):
         print(f"Directory {traces_dir} does not exist")
         exit()
@@ -95,11 +209,14 @@ def main():
     if trace_file is None:
         print(f"Could not find all necessary files in {traces_dir}")
         exit()
+    if n_traces == 0:
+        n_traces = count_traces(traces_dir, trace_file)
+        print(f"Number of traces: {n_traces}")
 
     bin_to_txt(f"{traces_dir}/{DEFAULT_CIPHERTEXT_NAME}", n_traces)
     bin_to_txt(f"{traces_dir}/{DEFAULT_PLAINTEXT_NAME}", n_traces)
     bin_to_txt(f"{traces_dir}/{DEFAULT_KEY_NAME}", n_traces)
-    csv_to_bin(f"{traces_dir}/{trace_file}", n_traces)
+    csv_to_bin(f"{traces_dir}/{trace_file}", n_traces, workers)
     print("Conversion complete.")
     
 
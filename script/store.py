@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Persistent store of attack results and resumable sweeps.
+
+Results are kept in a directory per dataset, named by a fingerprint of the dataset:
+
+    store_dir/<fingerprint>/dataset.json                              : path, number of traces, trace length and
+                                                                        the last encryption key the dataset was
+                                                                        attacked with
+    store_dir/<fingerprint>/<mode>_<model>_<n_traces>.npz             : CPAResult after n_traces traces
+    store_dir/<fingerprint>/<mode>_<model>_<n_traces>_correlation.npy : optional float32 correlation matrices
+    store_dir/<fingerprint>/<mode>_<model>_<engine>_checkpoint.npz    : accumulator of the last finished step
+    store_dir/<fingerprint>/<mode>_<model>_<engine>_bytes<first>-<last>_checkpoint.npz
+                                                                      : the same for a group of key bytes
+
+Every file is written to a temporary file and renamed, so an interrupted run leaves the last
+complete state behind. A sweep skips the steps already in the store and continues from the
+accumulator checkpoint, so an interrupted sweep loses at most one step, and the GE tables and
+plots are read from the store without touching the traces.
+"""
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from accumulator import CPAAccumulator, CPAResult, PartitionedAccumulator, concat_results, rank_result, split_result
+from cpa import (ENGINES, accumulate_models, accumulate_traces, attacked_key, new_accumulator, plot_ge_vs_ntraces,
+                 searched_key)
+from dataset import open_measurement
+from instrumentation import stage
+from measurement import Measurement
+import leakage
+
+# sums of the partitioned accumulator recomputed from its class sums, not stored in checkpoints
+REDUCED_SUMS = [ "sum_h", "sum_h2", "sum_ht", "reduced" ]
+# fields of a result that depend on the correct key, not stored so they are ranked against the current key
+RANK_FIELDS = [ "ranks", "ge", "key_rank" ]
+N_FINGERPRINT_ROWS = 64
+
+
+def dataset_fingerprint(measurement: Measurement) -> str:
+    """
+    Returns a fingerprint of a measurement: a hash of its trace length, sample type and the plaintexts,
+    ciphertexts and traces of its first N_FINGERPRINT_ROWS rows. The number of traces is not hashed,
+    so a capture that grows by appending traces keeps its fingerprint and its stored results,
+    which only depend on the traces they were computed from.
+    """
+    rows = min(measurement.cnt, N_FINGERPRINT_ROWS)
+    digest = hashlib.sha256()
+    digest.update(f"{measurement.trace_length} {np.dtype(measurement.trace_dtype).str}".encode())
+    digest.update(np.ascontiguousarray(measurement.plaintexts[:rows]).tobytes())
+    digest.update(np.ascontiguousarray(measurement.ciphertexts[:rows]).tobytes())
+    digest.update(np.ascontiguousarray(measurement.traces[:rows]).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def save_npz(path: str, arrays: dict):
+    """ Write arrays to an .npz file through a temporary file. """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_path, path)
+
+
+class ResultStore:
+    """
+    Directory of attack results keyed by dataset fingerprint, attack mode, leakage model and number of traces.
+    :param str root: directory of the store, created if it does not exist
+    """
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def dataset_dir(self, fingerprint: str) -> str:
+        return os.path.join(self.root, fingerprint)
+
+    def register(self, measurement: Measurement) -> str:
+        """
+        Returns the fingerprint of a measurement and records it in the store, updating the recorded path and
+        number of traces of a dataset that has grown and the encryption key if the measurement has one.
+        """
+        fingerprint = dataset_fingerprint(measurement)
+        info_path = os.path.join(self.dataset_dir(fingerprint), "dataset.json")
+        key = bytes(measurement.encryption_key).hex().upper() if measurement.encryption_key is not None else None
+        info = { "path": os.path.abspath(str(measurement.trace_path)), "n_traces": measurement.cnt,
+                 "trace_length": measurement.trace_length, "key": key }
+        if os.path.exists(info_path):
+            with open(info_path) as file:
+                stored = json.load(file)
+            if key is None:
+                info["key"] = stored.get("key")
+            if stored["n_traces"] >= measurement.cnt and stored.get("key") == info["key"]:
+                return fingerprint
+            info["n_traces"] = max(stored["n_traces"], measurement.cnt)
+        os.makedirs(self.dataset_dir(fingerprint), exist_ok=True)
+        with open(info_path + ".tmp", 'w') as file:
+            json.dump(info, file)
+        os.replace(info_path + ".tmp", info_path)
+        return fingerprint
+
+    def datasets(self) -> dict:
+        """ Returns the description of every dataset in the store by its fingerprint. """
+        datasets = {}
+        for fingerprint in sorted(os.listdir(self.root)):
+            info_path = os.path.join(self.dataset_dir(fingerprint), "dataset.json")
+            if os.path.exists(info_path):
+                with open(info_path) as file:
+                    datasets[fingerprint] = json.load(file)
+        return datasets
+
+    def result_path(self, fingerprint: str, attack_mode: str, model: str, n_traces: int) -> str:
+        return os.path.join(self.dataset_dir(fingerprint), f"{attack_mode}_{model}_{n_traces}.npz")
+
+    def checkpoint_path(self, fingerprint: str, attack_mode: str, model: str, engine: str, group: str = "") -> str:
+        return os.path.join(self.dataset_dir(fingerprint), f"{attack_mode}_{model}_{engine}{group}_checkpoint.npz")
+
+    def save_result(self, fingerprint: str, attack_mode: str, model: str, result: CPAResult,
+                    correlation: np.ndarray = None):
+        """
+        Store a result and optionally its correlation matrices. The ranks of the correct key are not stored,
+        a result is ranked against the current key when it is used.
+        Sizes:
+        Correlation : ( n_bytes, 256, trace_length ), stored as float32
+        """
+        path = self.result_path(fingerprint, attack_mode, model, result.n_traces)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if correlation is not None:
+            correlation_path = path[:-len(".npz")] + "_correlation.npy"
+            with open(correlation_path + ".tmp", 'wb') as file:
+                np.save(file, correlation.astype(np.float32))
+            os.replace(correlation_path + ".tmp", correlation_path)
+        # fields that are None are left out
+        save_npz(path, { field: np.asarray(value) for field, value in result._asdict().items()
+                         if value is not None and field not in RANK_FIELDS })
+
+    def load_result(self, fingerprint: str, attack_mode: str, model: str, n_traces: int) -> CPAResult:
+        """ Returns a stored result without ranks, None if it is not in the store. """
+        path = self.result_path(fingerprint, attack_mode, model, n_traces)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as arrays:
+            # ranks stored by earlier versions may belong to another key
+            fields = { field: arrays[field] for field in arrays.files if field not in RANK_FIELDS }
+        fields["n_traces"] = int(fields["n_traces"])
+        return CPAResult(**fields)
+
+    def load_correlation(self, fingerprint: str, attack_mode: str, model: str, n_traces: int) -> np.ndarray:
+        """ Returns the memory mapped correlation matrices of a stored result, None if they were not stored. """
+        path = self.result_path(fingerprint, attack_mode, model, n_traces)[:-len(".npz")] + "_correlation.npy"
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    def results(self, fingerprint: str, attack_mode: str, model: str) -> List[CPAResult]:
+        """
+        Returns all stored results of an attack on a dataset, sorted by their number of traces and ranked
+        against the last encryption key the dataset was registered with.
+        """
+        prefix = f"{attack_mode}_{model}_"
+        n_traces = []
+        for name in os.listdir(self.dataset_dir(fingerprint)):
+            count = name[len(prefix):-len(".npz")]
+            if name.startswith(prefix) and name.endswith(".npz") and count.isdigit():
+                n_traces.append(int(count))
+        with open(os.path.join(self.dataset_dir(fingerprint), "dataset.json")) as file:
+            key = json.load(file).get("key")
+        correct_key = searched_key(list(bytes.fromhex(key)), attack_mode) if key else None
+        return [ rank_result(self.load_result(fingerprint, attack_mode, model, n), correct_key)
+                 for n in sorted(n_traces) ]
+
+    def attacks(self, fingerprint: str) -> List[tuple]:
+        """ Returns the ( attack mode, model ) pairs with results stored for a dataset. """
+        attacks = set()
+        for name in os.listdir(self.dataset_dir(fingerprint)):
+            parts = name[:-len(".npz")].split("_")
+            if name.endswith(".npz") and len(parts) >= 3 and parts[-1].isdigit():
+                attacks.add((parts[0], "_".join(parts[1:-1])))
+        return sorted(attacks)
+
+    def save_checkpoint(self, fingerprint: str, attack_mode: str, model: str, engine: str,
+                        accumulator: CPAAccumulator, byte_indices: List[int], group: str = ""):
+        """
+        Store the state of an accumulator, replacing the previous checkpoint of the attack
+        unless the previous one holds more traces, so a sweep that started over does not lose it.
+        :param str group: checkpoint name suffix of a group of key bytes, see byte_group_name
+        """
+        path = self.checkpoint_path(fingerprint, attack_mode, model, engine, group)
+        if os.path.exists(path):
+            with np.load(path) as arrays:
+                if int(arrays["n"]) > accumulator.n:
+                    return
+        partitioned = isinstance(accumulator, PartitionedAccumulator)
+        with stage("save checkpoint"):
+            arrays = { name: value for name, value in vars(accumulator).items()
+                       if isinstance(value, np.ndarray) and not (partitioned and name in REDUCED_SUMS) }
+            arrays.update(n=accumulator.n, byte_indices=np.asarray(byte_indices),
+                          dtype=np.dtype(accumulator.dtype).str)
+            save_npz(path, arrays)
+
+    def load_checkpoint(self, fingerprint: str, attack_mode: str, model: str, engine: str,
+                        trace_length: int, group: str = "") -> CPAAccumulator:
+        """ Returns the accumulator of the last checkpoint of an attack, None if there is none. """
+        path = self.checkpoint_path(fingerprint, attack_mode, model, engine, group)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as arrays:
+            accumulator = new_accumulator(engine, attack_mode, list(arrays["byte_indices"]), trace_length,
+                                          np.dtype(str(arrays["dtype"])).type)
+            accumulator.n = int(arrays["n"])
+            for name in arrays.files:
+                if name not in ("n", "byte_indices", "dtype"):
+                    setattr(accumulator, name, arrays[name])
+        if isinstance(accumulator, PartitionedAccumulator):
+            accumulator.reduced[:] = False
+        return accumulator
+
+
+def byte_group_name(byte_indices: List[int], key_length: int) -> str:
+    """ Suffix of the checkpoints of a group of key bytes, empty for all key bytes. """
+    return "" if len(byte_indices) == key_length else f"_bytes{byte_indices[0]}-{byte_indices[-1]}"
+
+
+def sweep_step(measurement: Measurement, store: ResultStore, fingerprint: str, attack_modes: List[str],
+               models: List[str], byte_indices: List[int], n_traces: int, engine: str, chunk_size: int,
+               save_correlation: bool, backend: str, n_threads: int, accumulators: dict = None) -> Tuple[dict, dict]:
+    """
+    Advance the accumulators of the key bytes in byte_indices of every attack mode and of all models stacked
+    in one accumulator to n_traces traces, checkpoint them and return them with the result and the correlation
+    matrices ( None unless save_correlation ) of every attack mode and model after the step.
+    Every chunk of traces is added to all accumulators in turn while it is in the page cache, so the traces
+    are read once for all attacks. Without accumulators they are loaded from the checkpoints of the byte group,
+    or started over if a checkpoint is past n_traces.
+    """
+    group = byte_group_name(byte_indices, measurement.key_length)
+    # ( attack mode, model, engine ) of every accumulator, the stacked models are checkpointed
+    # under the joined names of the models
+    jobs = [ (attack_mode, attack_mode, engine) for attack_mode in attack_modes ]
+    if models:
+        jobs.append(("models", "+".join(models), "direct"))
+    if accumulators is None:
+        accumulators = {}
+        for attack_mode, model, job_engine in jobs:
+            accumulator = store.load_checkpoint(fingerprint, attack_mode, model, job_engine, measurement.trace_length,
+                                                group)
+            if accumulator is None or accumulator.n > n_traces:
+                # the checkpoint is past the step, the sweep starts over
+                if attack_mode == "models":
+                    accumulator = CPAAccumulator(len(models) * len(byte_indices), measurement.trace_length)
+                else:
+                    accumulator = new_accumulator(job_engine, attack_mode, byte_indices, measurement.trace_length)
+            elif accumulator.n > 0 and not group:
+                # the workers of byte groups reload their checkpoints at every step, they do not report it
+                print(f"Resuming the {model} sweep from {accumulator.n} traces.")
+            accumulator.backend, accumulator.n_threads = backend, n_threads
+            accumulators[attack_mode] = accumulator
+
+    for chunk_start in range(min(accumulator.n for accumulator in accumulators.values()), n_traces, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, n_traces)
+        for attack_mode, accumulator in accumulators.items():
+            # a resumed accumulator may hold some of the chunk already
+            first = max(accumulator.n, chunk_start)
+            if first >= chunk_stop:
+                continue
+            if attack_mode == "models":
+                accumulate_models(accumulator, measurement, models, first, chunk_stop, chunk_size,
+                                  byte_indices=byte_indices)
+            else:
+                accumulate_traces(accumulator, measurement, attack_mode, byte_indices, first, chunk_stop, chunk_size)
+
+    results = {}
+    for attack_mode, model, job_engine in jobs:
+        accumulator = accumulators[attack_mode]
+        if attack_mode == "models":
+            keys = [ group_key(measurement, leakage.LEAKAGE_MODELS[model].attack_mode, byte_indices)
+                     for model in models ]
+            for model, part in zip(models, split_result(accumulator.result(), len(models), keys)):
+                results[model] = (part, None)
+            store.save_checkpoint(fingerprint, attack_mode, "+".join(models), job_engine, accumulator,
+                                  list(range(accumulator.n_bytes)), group)
+        else:
+            correlation = None
+            if save_correlation:
+                correlation = np.stack([ accumulator.correlation(byte) for byte in range(len(byte_indices)) ])
+            results[attack_mode] = (accumulator.result(group_key(measurement, attack_mode, byte_indices)), correlation)
+            store.save_checkpoint(fingerprint, attack_mode, model, job_engine, accumulator, byte_indices, group)
+    return accumulators, results
+
+
+def sweep_group_step(*args) -> dict:
+    """ sweep_step in a worker process, only the results are sent back. """
+    return sweep_step(*args)[1]
+
+
+def group_key(measurement: Measurement, attack_mode: str, byte_indices: List[int]) -> np.ndarray:
+    """ Returns the searched key bytes of a group of key bytes, None if the key is unknown. """
+    searched_key = attacked_key(measurement, attack_mode)
+    return searched_key[byte_indices] if searched_key is not None else None
+
+
+def stored_sweeps(measurement: Measurement, store: ResultStore, checkpoints: List[int], attack_modes: List[str] = (),
+                  models: List[str] = (), engine: str = "direct", chunk_size: int = 1024,
+                  save_correlation: bool = False, backend: str = "numpy", n_threads: int = 0,
+                  workers: int = 1) -> Dict[str, List[CPAResult]]:
+    """
+    Run the plain attack of every attack mode and the attacks with several leakage models in a single pass
+    over the traces and return the results of every attack mode and model after each number of traces
+    in checkpoints ( see cpa.find_key_sweep and cpa.find_key_models ). Results already in the store are not
+    recomputed, an attack with all of its steps stored is left out of the pass and the others continue from
+    their accumulator checkpoints. Every step is stored with the accumulator checkpoints as soon as it is finished.
+    With workers > 1 the key bytes are split into groups swept by a process pool, like in find_key_sweep,
+    every group keeps its own checkpoints.
+    :param list models: leakage models, their hypotheses are stacked in one accumulator of the direct engine,
+                        a model named like one of the attack modes is its plain attack and is run once
+    :param bool save_correlation: store the float32 correlation matrices of every step of the attack modes
+    :param str backend: kernel of the direct engine, see kernel.py
+    :param int n_threads: number of threads of the kernel in every process, all cores if 0
+    """
+    for attack_mode in attack_modes:
+        if attack_mode not in leakage.ATTACK_MODES:
+            raise ValueError("Unknown attack mode.")
+    if engine not in ENGINES:
+        raise ValueError("Unknown CPA engine.")
+    for model in models:
+        if model not in leakage.LEAKAGE_MODELS:
+            raise ValueError(f"Unknown leakage model '{model}'.")
+    attack_modes = list(dict.fromkeys(attack_modes))
+    models = [ model for model in dict.fromkeys(models) if model not in attack_modes ]
+    # the model of the plain attack is the default model of its mode
+    mode_of = { **{ attack_mode: attack_mode for attack_mode in attack_modes },
+                **{ model: leakage.LEAKAGE_MODELS[model].attack_mode for model in models } }
+    fingerprint = store.register(measurement)
+    checkpoints = sorted(set(min(n, measurement.cnt) for n in checkpoints))
+
+    results = { name: [ store.load_result(fingerprint, attack_mode, name, n) for n in checkpoints ]
+                for name, attack_mode in mode_of.items() }
+    # attacks with all steps stored are not run, the stacked models only as a whole
+    missing_modes = [ attack_mode for attack_mode in attack_modes if None in results[attack_mode] ]
+    missing_models = models if any(None in results[model] for model in models) else []
+    missing = [ i for i in range(len(checkpoints))
+                if any(results[name][i] is None for name in missing_modes + missing_models) ]
+    byte_groups = [ list(group) for group in np.array_split(np.arange(measurement.key_length),
+                                                            min(max(workers, 1), measurement.key_length)) ]
+
+    def store_step(i: int, group_results: List[dict]):
+        for name in missing_modes + missing_models:
+            attack_mode = mode_of[name]
+            parts = [ group_result[name] for group_result in group_results ]
+            if len(parts) == 1:
+                result, correlation = parts[0]
+            else:
+                result = concat_results([ part[0] for part in parts ], attacked_key(measurement, attack_mode))
+                correlation = np.concatenate([ part[1] for part in parts ]) if save_correlation else None
+            store.save_result(fingerprint, attack_mode, name, result,
+                              correlation if name in missing_modes else None)
+            results[name][i] = result
+
+    if missing and len(byte_groups) == 1:
+        accumulators = None
+        for i in missing:
+            accumulators, step_results = sweep_step(measurement, store, fingerprint, missing_modes, missing_models,
+                                                    byte_groups[0], checkpoints[i], engine, chunk_size,
+                                                    save_correlation, backend, n_threads, accumulators)
+            store_step(i, [ step_results ])
+    elif missing:
+        with ProcessPoolExecutor(max_workers=len(byte_groups)) as pool:
+            for i in missing:
+                # every worker continues from the checkpoint of its group written by the previous step
+                store_step(i, list(pool.map(sweep_group_step, repeat(measurement), repeat(store), repeat(fingerprint),
+                                            repeat(missing_modes), repeat(missing_models), byte_groups,
+                                            repeat(checkpoints[i]), repeat(engine), repeat(chunk_size),
+                                            repeat(save_correlation), repeat(backend), repeat(n_threads))))
+    # stored results are ranked against the current key, new ones already are
+    return { name: [ rank_result(result, attacked_key(measurement, mode_of[name])) if result.ranks is None else result
+                     for result in results[name] ] for name in mode_of }
+
+
+def stored_sweep(measurement: Measurement, store: ResultStore, checkpoints: List[int], attack_mode: str = "lrnd",
+                 engine: str = "direct", chunk_size: int = 1024, save_correlation: bool = False,
+                 backend: str = "numpy", n_threads: int = 0, workers: int = 1) -> List[CPAResult]:
+    """
+    Run the attack of all key bytes in a single pass over the traces and return its result after each number
+    of traces in checkpoints ( see stored_sweeps ).
+    """
+    return stored_sweeps(measurement, store, checkpoints, [ attack_mode ], [], engine, chunk_size, save_correlation,
+                         backend, n_threads, workers)[attack_mode]
+
+
+def stored_model_sweep(measurement: Measurement, store: ResultStore, models: List[str], checkpoints: List[int],
+                       chunk_size: int = 1024, backend: str = "numpy", n_threads: int = 0,
+                       workers: int = 1) -> Dict[str, List[CPAResult]]:
+    """
+    Attack with several leakage models in a single pass over the traces ( see cpa.find_key_models ) and return
+    the results of every model after each number of traces in checkpoints ( see stored_sweeps ).
+    """
+    return stored_sweeps(measurement, store, checkpoints, [], models, "direct", chunk_size, False, backend, n_threads,
+                         workers)
+
+
+def print_ge_table(results: List[CPAResult]):
+    """ Print the guessing entropy and key rank estimate of every result, CPAResult or template.TemplateResult. """
+    print(f"{'n_traces':>10} {'GE':>8} {'log2 rank':>10}  key")
+    for result in results:
+        ge = f"{result.ge:8.2f}" if result.ge is not None else f"{'-':>8}"
+        rank = f"{result.key_rank[1]:10.1f}" if result.key_rank is not None else f"{'-':>10}"
+        print(f"{result.n_traces:>10} {ge} {rank}  {bytes(result.key).hex().upper()}")
+
+
+def main():
+    usage = ("Wrong arguments: python3 store.py sweep store_dir /path/to/capture step max_traces [lrnd|frnd] "
+             "[direct|partitioned] [key_hex]\n"
+             "                 python3 store.py table store_dir [fingerprint]\n"
+             "                 python3 store.py plot store_dir fingerprint [lrnd|frnd] [model]\n"
+             "The capture is a capture directory or a dataset file.")
+    if len(sys.argv) < 3 or sys.argv[1] not in ("sweep", "table", "plot"):
+        print(usage)
+        exit()
+    store = ResultStore(sys.argv[2])
+    match sys.argv[1]:
+        case "sweep":
+            if len(sys.argv) < 6:
+                print(usage)
+                exit()
+            step, max_traces = int(sys.argv[4]), int(sys.argv[5])
+            attack_mode = sys.argv[6] if len(sys.argv) >= 7 else "lrnd"
+            engine = sys.argv[7] if len(sys.argv) >= 8 else "direct"
+            encryption_key = list(bytes.fromhex(sys.argv[8])) if len(sys.argv) >= 9 else None
+            measurement = open_measurement(sys.argv[3], encryption_key)
+            results = stored_sweep(measurement, store, range(step, max_traces + step, step), attack_mode, engine)
+            print_ge_table(results)
+        case "table":
+            datasets = store.datasets()
+            for fingerprint in sys.argv[3:] or datasets:
+                print(f"{fingerprint}: {datasets[fingerprint]['path']} ({datasets[fingerprint]['n_traces']} traces)")
+                for attack_mode, model in store.attacks(fingerprint):
+                    print(f"{attack_mode} {model}")
+                    print_ge_table(store.results(fingerprint, attack_mode, model))
+        case "plot":
+            if len(sys.argv) < 4:
+                print(usage)
+                exit()
+            attack_mode = sys.argv[4] if len(sys.argv) >= 5 else "lrnd"
+            model = sys.argv[5] if len(sys.argv) >= 6 else attack_mode
+            results = [ (result.n_traces, result.ge) for result in store.results(sys.argv[3], attack_mode, model)
+                        if result.ge is not None ]
+            if not results:
+                print("No ranked results of the attack in the store.")
+                exit()
+            step = results[1][0] - results[0][0] if len(results) > 1 else results[0][0]
+            plot_ge_vs_ntraces(results, results[-1][0], step)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Profiled template attack with a pooled covariance.
+
+Profiling runs on a measurement with a known key ( e.g. the known key twin of a capture ), in two
+streaming passes over its traces:
+
+    1. the signal-to-noise ratio of every sample with the traces partitioned by the class of the
+       intermediate value of each key byte, the n_poi samples with the highest SNR are the
+       points of interest of the byte
+    2. the sum of the points of interest of each class and their scatter matrix over all traces,
+       from which the class means and the covariance pooled over all classes are computed
+
+The intermediate of a key byte is the first round SBox output for frnd and the transition between
+the last round SBox input and the ciphertext byte it is shifted onto for lrnd, its class is the value
+itself ( 256 classes ) or its hamming weight ( 9 classes ).
+With a pooled covariance C the log-likelihood of a trace x in class c is, up to a term common to all
+classes, x C^-1 m_c - m_c C^-1 m_c / 2, so scoring a chunk of attack traces is one matrix product
+( chunk, n_poi ) @ ( n_poi, n_classes ) per key byte, and the score of each key guess is read from the
+class its intermediate falls in. The scores of independent traces add up, so the log-likelihood of
+every key guess is accumulated over the traces in a single pass like the running sums of the CPA.
+"""
+import sys
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+import leakage
+from accumulator import class_sums
+from cpa import attacked_key
+from dataset import open_measurement
+from measurement import Measurement
+from poi import SNRAccumulator, select_poi
+from ranking import key_ranks, rank_estimate
+from store import print_ge_table
+
+CLASSES = [ "hw", "value" ]
+KEY_GUESSES = np.arange(256, dtype=np.uint8)
+
+
+class Templates(NamedTuple):
+    """
+    Templates of every key byte.
+    :param str attack_mode: frnd or lrnd
+    :param str classes: hw or value
+    :param np.ndarray poi: points of interest of each key byte, ( n_bytes, n_poi )
+    :param np.ndarray means: mean of the points of interest of each class, ( n_bytes, n_classes, n_poi )
+    :param np.ndarray covariance: covariance pooled over the classes, ( n_bytes, n_poi, n_poi )
+    :param np.ndarray counts: number of profiling traces of each class, ( n_bytes, n_classes )
+    """
+    attack_mode: str
+    classes: str
+    poi: np.ndarray
+    means: np.ndarray
+    covariance: np.ndarray
+    counts: np.ndarray
+
+
+class TemplateResult(NamedTuple):
+    """
+    State of a template attack after n_traces traces.
+    :param np.ndarray key: best key guess for each key byte
+    :param np.ndarray log_likelihood: log-likelihood of each key guess, ( n_bytes, 256 )
+    :param np.ndarray ranks: rank of the correct key byte for each key byte, None if the key is unknown
+    :param float ge: guessing entropy, None if the key is unknown
+    :param tuple key_rank: log2 of the lower bound, estimate and upper bound of the rank of the full key,
+                           None if the key is unknown
+    """
+    n_traces: int
+    key: np.ndarray
+    log_likelihood: np.ndarray
+    ranks: np.ndarray = None
+    ge: float = None
+    key_rank: Tuple[float, float, float] = None
+
+
+def n_classes(classes: str) -> int:
+    return 9 if classes == "hw" else 256
+
+
+def intermediates(texts: np.ndarray, attack_mode: str, keys: np.ndarray, classes: str) -> np.ndarray:
+    """
+    Returns the class of the intermediate of every key byte and trace under the given key bytes,
+    plaintexts for frnd and ciphertexts for lrnd.
+
+    Sizes:
+    Texts   : ( chunk_len, 16 )
+    Keys    : ( 16, ) a key, or ( 16, 1, n_guesses ) guesses of every key byte
+    Classes : ( chunk_len, 16 ) for a key, ( 16, chunk_len, n_guesses ) for guesses
+    """
+    if keys.ndim == 1:
+        return intermediates(texts, attack_mode, keys[:, np.newaxis, np.newaxis], classes)[:, :, 0].T
+    text_bytes = texts.T[:, :, np.newaxis]
+    match attack_mode:
+        case "frnd":
+            values = leakage.SBox[text_bytes ^ keys]
+        case "lrnd":
+            values = leakage.SBoxInverse[text_bytes ^ keys] ^ texts[:, leakage.ShiftRowInverse].T[:, :, np.newaxis]
+        case _:
+            raise ValueError("Unknown attack mode.")
+    return leakage.HammingWeight[values] if classes == "hw" else values
+
+
+def profile(measurement: Measurement, attack_mode: str = "lrnd", n_poi: int = 8, classes: str = "hw",
+            n_traces: int = 0, chunk_size: int = 8192) -> Templates:
+    """
+    Build the templates of every key byte from the first n_traces traces ( all if 0 ) of a measurement
+    with a known key.
+    :param int n_poi: number of points of interest of every key byte
+    :param str classes: hw ( 9 classes ) or value ( 256 classes, needs far more profiling traces )
+    """
+    if classes not in CLASSES:
+        raise ValueError("Unknown template classes.")
+    key = attacked_key(measurement, attack_mode)
+    if key is None:
+        raise ValueError("Profiling needs a measurement with a known key.")
+    if n_traces == 0 or n_traces > measurement.cnt:
+        n_traces = measurement.cnt
+    texts = measurement.ciphertexts if attack_mode == "lrnd" else measurement.plaintexts
+    n_bytes = measurement.key_length
+
+    snr = SNRAccumulator(n_bytes, measurement.trace_length, n_classes(classes))
+    for start in range(0, n_traces, chunk_size):
+        stop = min(start + chunk_size, n_traces)
+        snr.update(intermediates(texts[start:stop], attack_mode, key, classes), measurement.traces[start:stop])
+    snr_values = snr.snr()
+    poi = np.stack([ select_poi(snr_values[i], n_poi) for i in range(n_bytes) ])
+
+    # sums of the samples of each class and their scatter, shifted by the mean of the first chunk
+    # so the scatter does not lose the covariance to the squares of the means
+    sums = np.zeros((n_bytes, n_classes(classes), poi.shape[1]))
+    counts = np.zeros((n_bytes, n_classes(classes)))
+    scatter = np.zeros((n_bytes, poi.shape[1], poi.shape[1]))
+    shift = np.zeros((n_bytes, poi.shape[1]))
+    for start in range(0, n_traces, chunk_size):
+        stop = min(start + chunk_size, n_traces)
+        labels = intermediates(texts[start:stop], attack_mode, key, classes)
+        traces = np.asarray(measurement.traces[start:stop])
+        for i in range(n_bytes):
+            x = traces[:, poi[i]].astype(np.float64)
+            if start == 0:
+                shift[i] = np.mean(x, axis=0)
+            x -= shift[i]
+            sums[i] += class_sums(labels[:, i], x, n_classes(classes))
+            counts[i] += np.bincount(labels[:, i], minlength=n_classes(classes))
+            scatter[i] += x.T @ x
+
+    occupied = counts > 0
+    if not np.all(occupied):
+        print(f"Warning: {np.sum(~occupied)} classes have no profiling traces, they get the mean of all traces.")
+    means = np.where(occupied[:, :, np.newaxis], sums / np.maximum(counts, 1)[:, :, np.newaxis],
+                     np.sum(sums, axis=1, keepdims=True) / n_traces)
+    # within class scatter: total scatter minus the scatter of the class means
+    within = scatter - np.einsum("bc,bci,bcj->bij", counts, means, means)
+    covariance = within / (n_traces - np.sum(occupied, axis=1))[:, np.newaxis, np.newaxis]
+    return Templates(attack_mode, classes, poi, means + shift[:, np.newaxis, :], covariance, counts)
+
+
+def discriminants(templates: Templates) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the weights C^-1 m_c ( n_bytes, n_poi, n_classes ) and offsets - m_c C^-1 m_c / 2
+    ( n_bytes, n_classes ) of the linear log-likelihood of every class.
+    """
+    precision = np.linalg.pinv(templates.covariance)
+    weights = precision @ templates.means.transpose(0, 2, 1)
+    offsets = -0.5 * np.einsum("bcp,bpc->bc", templates.means, weights)
+    return weights, offsets
+
+
+def rank_template_result(result: TemplateResult, correct_key: np.ndarray = None) -> TemplateResult:
+    if correct_key is None:
+        return result
+    ranks = key_ranks(result.log_likelihood, correct_key)
+    return result._replace(ranks=ranks, ge=float(np.mean(ranks)),
+                           key_rank=rank_estimate(result.log_likelihood, correct_key))
+
+
+def template_attack(templates: Templates, measurement: Measurement, checkpoints: List[int] = None,
+                    chunk_size: int = 8192) -> List[TemplateResult]:
+    """
+    Score all key guesses of every key byte of a measurement with the templates in a single pass
+    over its traces and return the result after each number of traces in checkpoints ( all traces if not given ).
+    """
+    if checkpoints is None:
+        checkpoints = [ measurement.cnt ]
+    checkpoints = sorted(set(min(n, measurement.cnt) for n in checkpoints))
+    texts = measurement.ciphertexts if templates.attack_mode == "lrnd" else measurement.plaintexts
+    weights, offsets = discriminants(templates)
+    n_bytes = templates.poi.shape[0]
+    searched_key = attacked_key(measurement, templates.attack_mode)
+    log_likelihood = np.zeros((n_bytes, 256))
+    bytes_range = np.arange(n_bytes)[:, np.newaxis]
+    results = []
+    done = 0
+    for checkpoint in checkpoints:
+        for start in range(done, checkpoint, chunk_size):
+            stop = min(start + chunk_size, checkpoint)
+            traces = np.asarray(measurement.traces[start:stop])
+            # class of every key byte, trace and key guess
+            labels = intermediates(texts[start:stop], templates.attack_mode,
+                                   KEY_GUESSES[np.newaxis, np.newaxis, :], templates.classes)
+            for i in range(n_bytes):
+                class_scores = traces[:, templates.poi[i]].astype(np.float64) @ weights[i] + offsets[i]
+                log_likelihood[i] += np.sum(np.take_along_axis(class_scores, labels[i].astype(np.int64), axis=1),
+                                            axis=0)
+        done = max(done, checkpoint)
+        key = np.argmax(log_likelihood, axis=1).astype(np.uint8)
+        results.append(rank_template_result(TemplateResult(done, key, log_likelihood.copy()), searched_key))
+    return results
+
+
+def save_templates(templates: Templates, path: str):
+    np.savez(path, **templates._asdict())
+
+
+def load_templates(path: str) -> Templates:
+    with np.load(path) as arrays:
+        fields = { field: arrays[field] for field in arrays.files }
+    fields["attack_mode"] = str(fields["attack_mode"])
+    fields["classes"] = str(fields["classes"])
+    return Templates(**fields)
+
+
+def main():
+    if len(sys.argv) < 4:
+        print("Not enough arguments: python3 template.py /path/to/profiling_capture profiling_key_hex "
+              "/path/to/attacked_capture [lrnd|frnd] [n_poi] [hw|value] [step] [attacked_key_hex]")
+        print("The captures are capture directories or dataset files.")
+        exit()
+    profiling = open_measurement(sys.argv[1], list(bytes.fromhex(sys.argv[2])))
+    attack_mode = sys.argv[4] if len(sys.argv) >= 5 else "lrnd"
+    n_poi = int(sys.argv[5]) if len(sys.argv) >= 6 else 8
+    classes = sys.argv[6] if len(sys.argv) >= 7 else "hw"
+    encryption_key = list(bytes.fromhex(sys.argv[8])) if len(sys.argv) >= 9 else None
+    attacked = open_measurement(sys.argv[3], encryption_key)
+    step = int(sys.argv[7]) if len(sys.argv) >= 8 else attacked.cnt
+    templates = profile(profiling, attack_mode, n_poi, classes)
+    print(f"Profiled {profiling.cnt} traces, points of interest of byte 0: {templates.poi[0]}")
+    print_ge_table(template_attack(templates, attacked, range(step, attacked.cnt + step, step)))
+
+
+if __name__ == "__main__":
+    main()
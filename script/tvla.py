@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Test vector leakage assessment ( TVLA ) of a capture with Welch's t-test.
+
+The traces are split into two groups, either fixed vs. random plaintext ( fixed ), or by the
+value of a leakage model of a key byte under the known key ( model ), and the means of every
+sample in the two groups are compared with Welch's t-test. The second order test compares
+the variances, i.e. the means of the squared centered samples.
+The central moments of both groups are accumulated in a single streaming pass over the traces:
+the moments of every chunk are computed with NumPy and merged into the running moments with
+the pairwise update formulas of Welford / Pebay. The same merge joins the partial moments of
+ranges of the file processed by a process pool, so the memory only depends on the chunk size
+and the trace length. Samples with |t| above the threshold ( 4.5 by convention ) leak.
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import NamedTuple
+
+import numpy as np
+
+import leakage
+from average import group_texts
+from cpa import attacked_key
+from instrumentation import stage
+from measurement import Measurement, open_capture
+
+PARTITIONS = [ "fixed", "model" ]
+T_THRESHOLD = 4.5
+
+
+class MomentAccumulator:
+    """
+    Number of traces, mean and central moment sums M2 ( and M3, M4 for order 2 ) of every sample.
+    :param int trace_length: number of samples in a trace
+    :param int order: 1 keeps the moments of the first order test, 2 also those of the second order test
+    """
+    def __init__(self, trace_length: int, order: int = 1):
+        self.order = order
+        self.n = 0
+        self.mean = np.zeros(trace_length)
+        self.m2 = np.zeros(trace_length)
+        self.m3 = np.zeros(trace_length) if order > 1 else None
+        self.m4 = np.zeros(trace_length) if order > 1 else None
+
+    def update(self, traces: np.ndarray):
+        """ Add a chunk of traces ( chunk_len, trace_length ). """
+        if traces.shape[0] == 0:
+            return
+        chunk = MomentAccumulator(self.mean.shape[0], self.order)
+        t = traces.astype(np.float64)
+        chunk.n = t.shape[0]
+        chunk.mean = np.mean(t, axis=0)
+        deviation = t - chunk.mean
+        squared = deviation * deviation
+        chunk.m2 = np.sum(squared, axis=0)
+        if self.order > 1:
+            chunk.m3 = np.sum(squared * deviation, axis=0)
+            chunk.m4 = np.sum(squared * squared, axis=0)
+        self.merge(chunk)
+
+    def merge(self, other: "MomentAccumulator"):
+        """ Add the moments of another accumulator over a disjoint set of traces. """
+        if other.n == 0:
+            return
+        n_a, n_b = self.n, other.n
+        n = n_a + n_b
+        delta = other.mean - self.mean
+        if self.order > 1:
+            # M3 and M4 need the M2 and M3 of both sides before the update
+            self.m4 = (self.m4 + other.m4 + delta ** 4 * n_a * n_b * (n_a * n_a - n_a * n_b + n_b * n_b) / n ** 3
+                       + 6 * delta ** 2 * (n_a * n_a * other.m2 + n_b * n_b * self.m2) / n ** 2
+                       + 4 * delta * (n_a * other.m3 - n_b * self.m3) / n)
+            self.m3 = (self.m3 + other.m3 + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2
+                       + 3 * delta * (n_a * other.m2 - n_b * self.m2) / n)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * n_a * n_b / n
+        self.mean = self.mean + delta * n_b / n
+        self.n = n
+
+
+class TVLAAccumulator:
+    """ Moments of the two groups of traces of a t-test. """
+    def __init__(self, trace_length: int, order: int = 1):
+        self.groups = [ MomentAccumulator(trace_length, order), MomentAccumulator(trace_length, order) ]
+
+    def update(self, groups: np.ndarray, traces: np.ndarray):
+        """
+        Sizes:
+        Groups : ( chunk_len, ) group 0 or 1 of every trace, -1 for traces in neither group
+        Traces : ( chunk_len, trace_length )
+        """
+        with stage("tvla accumulate", traces.nbytes):
+            for group, moments in enumerate(self.groups):
+                moments.update(traces[groups == group])
+
+    def merge(self, other: "TVLAAccumulator"):
+        for moments, other_moments in zip(self.groups, other.groups):
+            moments.merge(other_moments)
+
+    def t_statistic(self, order: int = 1) -> np.ndarray:
+        """ Welch's t-statistic of every sample, of the means ( order 1 ) or of the variances ( order 2 ). """
+        a, b = self.groups
+        if min(a.n, b.n) < 2:
+            raise ValueError("Both groups of the t-test need at least two traces.")
+        if order == 1:
+            mean_a, mean_b = a.mean, b.mean
+            var_a, var_b = a.m2 / (a.n - 1), b.m2 / (b.n - 1)
+        else:
+            # mean and variance of the squared centered samples
+            mean_a, mean_b = a.m2 / a.n, b.m2 / b.n
+            var_a, var_b = a.m4 / a.n - mean_a ** 2, b.m4 / b.n - mean_b ** 2
+        denominator = np.sqrt(var_a / a.n + var_b / b.n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denominator > 0, (mean_a - mean_b) / denominator, 0.0)
+
+
+class TVLAResult(NamedTuple):
+    """
+    n_traces: number of traces in each group
+    t: first order t-statistic of every sample
+    t2: second order t-statistic of every sample, None if not computed
+    leaking: samples with a first ( or second ) order |t| above the threshold
+    """
+    n_traces: tuple
+    t: np.ndarray
+    t2: np.ndarray
+    leaking: np.ndarray
+
+
+def partition(measurement: Measurement, start: int, stop: int, method: str, fixed_plaintext: np.ndarray = None,
+              model: str = "frnd", byte_idx: int = 0, threshold: float = None) -> np.ndarray:
+    """
+    Group of each of the traces start to stop: fixed: 0 for the fixed plaintext, 1 for the others.
+    model: 0 below and 1 above threshold of the leakage model of key byte byte_idx under the known key,
+    -1 for traces with the value equal to the threshold.
+    """
+    if method == "fixed":
+        return np.where(np.all(measurement.plaintexts[start:stop] == fixed_plaintext, axis=1), 0, 1)
+    attack_mode = leakage.LEAKAGE_MODELS[model].attack_mode
+    texts = measurement.ciphertexts[start:stop] if attack_mode == "lrnd" else measurement.plaintexts[start:stop]
+    key_byte = attacked_key(measurement, attack_mode)[byte_idx]
+    values = leakage.model_hypotheses(model, texts, [byte_idx])[0, :, key_byte].astype(np.float64)
+    return np.where(values < threshold, 0, np.where(values > threshold, 1, -1))
+
+
+def model_threshold(measurement: Measurement, model: str, byte_idx: int) -> float:
+    """
+    Mean value of the leakage model under the known key over all values of the text byte and of the byte
+    shifted onto it, e.g. 4 for hamming weights.
+    """
+    texts = np.zeros((256 * 256, 16), dtype=np.uint8)
+    texts[:, leakage.ShiftRowInverse[byte_idx]] = np.tile(leakage.KEY_GUESSES, 256)
+    texts[:, byte_idx] = np.repeat(leakage.KEY_GUESSES, 256)
+    key_byte = attacked_key(measurement, leakage.LEAKAGE_MODELS[model].attack_mode)[byte_idx]
+    return float(np.mean(leakage.model_hypotheses(model, texts, [byte_idx])[0, :, key_byte]))
+
+
+def accumulate_range(measurement: Measurement, start: int, stop: int, order: int, chunk_size: int,
+                     partition_args: dict) -> TVLAAccumulator:
+    """ Moments of the two groups over the traces start to stop, read in chunks of chunk_size rows. """
+    accumulator = TVLAAccumulator(measurement.trace_length, order)
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        accumulator.update(partition(measurement, chunk_start, chunk_stop, **partition_args),
+                           measurement.traces[chunk_start:chunk_stop])
+    return accumulator
+
+
+def tvla(measurement: Measurement, method: str = "fixed", order: int = 1, n_traces: int = 0,
+         fixed_plaintext: np.ndarray = None, model: str = "frnd", byte_idx: int = 0,
+         threshold: float = T_THRESHOLD, workers: int = 1, chunk_size: int = 16384) -> TVLAResult:
+    """
+    Welch's t-test of every sample of the traces.
+    :param str method: fixed for fixed vs. random plaintext, model for a partition by a leakage model
+    :param int order: 1 for the test of the means, 2 also for the test of the variances
+    :param np.ndarray fixed_plaintext: the fixed plaintext, the most frequent plaintext if not given
+    :param str model: leakage model of the model partition ( see leakage.LEAKAGE_MODELS ), needs the key
+    :param int byte_idx: key byte of the model partition
+    :param float threshold: samples with |t| above threshold leak
+    :param int workers: number of processes accumulating ranges of the traces
+    """
+    if method not in PARTITIONS:
+        raise ValueError("Unknown TVLA partition.")
+    if n_traces == 0:
+        n_traces = measurement.cnt
+    if method == "fixed":
+        if fixed_plaintext is None:
+            first_rows, _, counts = group_texts(measurement.plaintexts[:n_traces])
+            if np.max(counts) < 2:
+                raise ValueError("No plaintext repeats in the capture, pass fixed_plaintext or use the model partition.")
+            fixed_plaintext = measurement.plaintexts[first_rows[np.argmax(counts)]]
+        partition_args = { "method": method, "fixed_plaintext": np.asarray(fixed_plaintext, dtype=np.uint8) }
+    else:
+        if model not in leakage.LEAKAGE_MODELS:
+            raise ValueError(f"Unknown leakage model '{model}'.")
+        if measurement.encryption_key is None:
+            raise ValueError("The encryption key of the measurement is needed for the model partition.")
+        partition_args = { "method": method, "model": model, "byte_idx": byte_idx,
+                           "threshold": model_threshold(measurement, model, byte_idx) }
+
+    ranges = np.array_split(np.arange(n_traces), max(workers, 1))
+    starts = [ int(part[0]) for part in ranges if part.size > 0 ]
+    stops = [ int(part[-1]) + 1 for part in ranges if part.size > 0 ]
+    if len(starts) <= 1:
+        accumulator = accumulate_range(measurement, 0, n_traces, order, chunk_size, partition_args)
+    else:
+        with ProcessPoolExecutor(max_workers=len(starts)) as pool:
+            parts = list(pool.map(accumulate_range, repeat(measurement), starts, stops, repeat(order),
+                                  repeat(chunk_size), repeat(partition_args)))
+        accumulator = parts[0]
+        for part in parts[1:]:
+            accumulator.merge(part)
+
+    t = accumulator.t_statistic(1)
+    t2 = accumulator.t_statistic(2) if order > 1 else None
+    leaking = np.abs(t) > threshold
+    if t2 is not None:
+        leaking |= np.abs(t2) > threshold
+    return TVLAResult(tuple(group.n for group in accumulator.groups), t, t2, np.flatnonzero(leaking))
+
+
+def print_tvla_result(result: TVLAResult):
+    print(f"Traces in the groups: {result.n_traces[0]} / {result.n_traces[1]}")
+    for name, t in (("First", result.t), ("Second", result.t2)):
+        if t is not None:
+            sample = int(np.argmax(np.abs(t)))
+            print(f"{name} order: max |t| = {abs(t[sample]):.2f} at sample {sample}")
+    if result.leaking.size > 0:
+        print(f"Leaking samples ({result.leaking.size}): {' '.join(str(sample) for sample in result.leaking)}")
+    else:
+        print("No leaking samples.")
+
+
+def plot_tvla(result: TVLAResult, threshold: float = T_THRESHOLD):
+    import matplotlib.pyplot as plt
+    plt.plot(result.t, color='red', linewidth=1, label="first order")
+    if result.t2 is not None:
+        plt.plot(result.t2, color='blue', linewidth=1, label="second order")
+    plt.axhline(threshold, color='black', linestyle='--', linewidth=1)
+    plt.axhline(-threshold, color='black', linestyle='--', linewidth=1)
+    plt.xlabel("trace sample")
+    plt.ylabel("t-statistic")
+    plt.title("Welch's t-test")
+    plt.legend()
+    plt.grid(True)
+    plt.show()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Not enough arguments: python3 tvla.py /path/to/capture_dir [fixed|model] [order] [workers] [key_hex|-] [fixed_plaintext_hex]")
+        exit()
+    method = sys.argv[2] if len(sys.argv) >= 3 else "fixed"
+    order = int(sys.argv[3]) if len(sys.argv) >= 4 else 1
+    workers = int(sys.argv[4]) if len(sys.argv) >= 5 else 1
+    encryption_key = list(bytes.fromhex(sys.argv[5])) if len(sys.argv) >= 6 and sys.argv[5] != "-" else None
+    fixed_plaintext = list(bytes.fromhex(sys.argv[6])) if len(sys.argv) >= 7 else None
+    measurement = open_capture(sys.argv[1], encryption_key)
+    result = tvla(measurement, method, order, fixed_plaintext=fixed_plaintext, workers=workers)
+    print_tvla_result(result)
+    plot_tvla(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Fast viewer of captured traces and correlation traces.
+
+The traces are read straight from the memory mapped traces.bin ( or a dataset file ) in chunks,
+the minimum, maximum and mean of every sample over all traces are reduced chunk by chunk,
+so the envelope of a capture of any size is computed in a single pass with constant memory.
+Before plotting, the samples are decimated to about the width of the plot: every column keeps
+the minimum of the minima, the maximum of the maxima and the mean of the means of its samples,
+so no peak is lost to the decimation.
+The correlation of every key guess with every sample is computed once with the usual accumulators,
+saved as a .npy file of shape ( n_bytes, 256, trace_length ) and plotted from the memory mapped file.
+"""
+import sys
+from typing import List, NamedTuple
+
+import numpy as np
+
+from cpa import accumulate_traces, attacked_key, new_accumulator
+from dataset import open_measurement
+from instrumentation import stage
+from measurement import Measurement
+
+
+class Envelope(NamedTuple):
+    """
+    Minimum, maximum and mean of every sample over n_traces traces.
+    :param np.ndarray samples: index of every sample ( column ) in the full traces
+    """
+    n_traces: int
+    samples: np.ndarray
+    minimum: np.ndarray
+    maximum: np.ndarray
+    mean: np.ndarray
+
+
+def trace_envelope(measurement: Measurement, n_traces: int = 0, sample_start: int = 0, sample_stop: int = 0,
+                   chunk_size: int = 65536) -> Envelope:
+    """
+    Returns the envelope of the first n_traces traces ( all if 0 ) over the samples [ sample_start, sample_stop ),
+    sample_stop 0 is the end of the traces.
+    """
+    if n_traces == 0 or n_traces > measurement.cnt:
+        n_traces = measurement.cnt
+    if sample_stop == 0:
+        sample_stop = measurement.trace_length
+    if not 0 <= sample_start < sample_stop <= measurement.trace_length:
+        raise ValueError("The sample window is outside of the traces.")
+    if n_traces == 0:
+        raise ValueError("The measurement has no traces.")
+    minimum = np.full(sample_stop - sample_start, np.inf)
+    maximum = np.full(sample_stop - sample_start, -np.inf)
+    sums = np.zeros(sample_stop - sample_start)
+    for start in range(0, n_traces, chunk_size):
+        stop = min(start + chunk_size, n_traces)
+        with stage("envelope", (stop - start) * (sample_stop - sample_start) * np.dtype(measurement.trace_dtype).itemsize):
+            chunk = measurement.traces[start:stop, sample_start:sample_stop]
+            np.minimum(minimum, chunk.min(axis=0), out=minimum)
+            np.maximum(maximum, chunk.max(axis=0), out=maximum)
+            sums += chunk.sum(axis=0, dtype=np.float64)
+    return Envelope(n_traces, np.arange(sample_start, sample_stop), minimum, maximum, sums / n_traces)
+
+
+def decimate(envelope: Envelope, width: int) -> Envelope:
+    """
+    Returns the envelope reduced to at most width columns, every column covering the same number of samples
+    ( the last one fewer ). Each column is placed at its first sample.
+    """
+    length = envelope.samples.shape[0]
+    factor = -(-length // width)
+    if factor <= 1:
+        return envelope
+    columns = np.arange(0, length, factor)
+    counts = np.diff(np.append(columns, length))
+    return Envelope(envelope.n_traces, envelope.samples[columns],
+                    np.minimum.reduceat(envelope.minimum, columns),
+                    np.maximum.reduceat(envelope.maximum, columns),
+                    np.add.reduceat(envelope.mean, columns) / counts)
+
+
+def plot_envelope(envelope: Envelope, title: str = "", width: int = 2000, traces: np.ndarray = None):
+    """
+    Plot the envelope decimated to width columns and optionally a few traces over the same samples.
+    Sizes:
+    Traces : ( n, len(envelope.samples) )
+    """
+    import matplotlib.pyplot as plt
+    decimated = decimate(envelope, width)
+    plt.fill_between(decimated.samples, decimated.minimum, decimated.maximum, color='lightgrey',
+                     step='post', label="min / max")
+    if traces is not None:
+        for trace in traces:
+            plt.plot(envelope.samples, trace, linewidth=0.5)
+    plt.plot(decimated.samples, decimated.mean, color='red', linewidth=1, label="mean")
+    plt.title(f"{title} ({envelope.n_traces} traces)")
+    plt.xlabel("trace sample")
+    plt.ylabel("measured value")
+    plt.legend()
+    plt.grid(True)
+    plt.show()
+
+
+def correlation_traces(measurement: Measurement, attack_mode: str = "lrnd", n_traces: int = 0,
+                       byte_indices: List[int] = None, engine: str = "partitioned",
+                       chunk_size: int = 8192) -> np.ndarray:
+    """
+    Returns the absolute correlation of every key guess with every trace sample over the first n_traces traces.
+    Sizes:
+    Correlation : ( len(byte_indices), 256, trace_length ), float32
+    """
+    if attack_mode not in ("lrnd", "frnd"):
+        raise ValueError("Unknown attack mode.")
+    if n_traces == 0 or n_traces > measurement.cnt:
+        n_traces = measurement.cnt
+    if byte_indices is None:
+        byte_indices = list(range(measurement.key_length))
+    accumulator = new_accumulator(engine, attack_mode, byte_indices, measurement.trace_length)
+    accumulate_traces(accumulator, measurement, attack_mode, byte_indices, 0, n_traces, chunk_size)
+    correlation = np.empty((len(byte_indices), 256, measurement.trace_length), dtype=np.float32)
+    for i in range(len(byte_indices)):
+        correlation[i] = accumulator.correlation(i)
+    return correlation
+
+
+def save_correlation(measurement: Measurement, path: str, attack_mode: str = "lrnd", n_traces: int = 0,
+                     engine: str = "partitioned") -> np.ndarray:
+    """ Compute the correlation traces of all key bytes ( see correlation_traces ) and save them to a .npy file. """
+    correlation = correlation_traces(measurement, attack_mode, n_traces, engine=engine)
+    np.save(path, correlation)
+    return correlation
+
+
+def load_correlation(path: str) -> np.ndarray:
+    """ Returns the memory mapped correlation traces saved by save_correlation. """
+    return np.load(path, mmap_mode='r')
+
+
+def plot_correlation(correlation: np.ndarray, key: np.ndarray = None, byte_indices: List[int] = None,
+                     width: int = 2000):
+    """
+    Plot the correlation versus time of every key byte: the grey envelope is the maximum over
+    the other key guesses, the red line is the correct key guess, or the best one if the key is not given.
+    :param np.ndarray key: correct key guess of every key byte of the correlation
+    :param list byte_indices: key bytes to plot, all if not given
+    Sizes:
+    Correlation : ( n_bytes, 256, trace_length )
+    """
+    import matplotlib.pyplot as plt
+    if byte_indices is None:
+        byte_indices = list(range(correlation.shape[0]))
+    n_cols = int(np.ceil(np.sqrt(len(byte_indices))))
+    n_rows = -(-len(byte_indices) // n_cols)
+    figure, axes = plt.subplots(n_rows, n_cols, sharex=True, sharey=True, squeeze=False)
+    for ax, byte_idx in zip(axes.ravel(), byte_indices):
+        byte_correlation = np.asarray(correlation[byte_idx])
+        guess = int(key[byte_idx]) if key is not None else int(np.argmax(np.max(byte_correlation, axis=1)))
+        others = np.max(np.delete(byte_correlation, guess, axis=0), axis=0)
+        samples = np.arange(byte_correlation.shape[1])
+        # decimated to maxima, so the peaks of both curves survive
+        factor = max(-(-samples.shape[0] // width), 1)
+        columns = samples[::factor]
+        ax.fill_between(columns, 0, np.maximum.reduceat(others, columns), color='lightgrey', step='post')
+        ax.plot(columns, np.maximum.reduceat(byte_correlation[guess], columns), color='red', linewidth=1)
+        ax.set_title(f"byte {byte_idx}: {guess:02X}", fontsize=8)
+        ax.grid(True)
+    for ax in axes.ravel()[len(byte_indices):]:
+        ax.set_visible(False)
+    figure.supxlabel("trace sample")
+    figure.supylabel("absolute correlation")
+    plt.show()
+
+
+def main():
+    usage = ("Wrong arguments: python3 viewer.py traces /path/to/capture [n_traces] [sample_start sample_stop] [n_plotted]\n"
+             "                 python3 viewer.py correlate /path/to/capture out.npy [lrnd|frnd] [n_traces] [key_hex]\n"
+             "                 python3 viewer.py correlation correlation.npy [attacked_key_hex]\n"
+             "The capture is a capture directory or a dataset file.")
+    if len(sys.argv) < 3 or sys.argv[1] not in ("traces", "correlate", "correlation"):
+        print(usage)
+        exit()
+    match sys.argv[1]:
+        case "traces":
+            measurement = open_measurement(sys.argv[2])
+            n_traces = int(sys.argv[3]) if len(sys.argv) >= 4 else 0
+            sample_start, sample_stop = (int(sys.argv[4]), int(sys.argv[5])) if len(sys.argv) >= 6 else (0, 0)
+            n_plotted = int(sys.argv[6]) if len(sys.argv) >= 7 else 0
+            envelope = trace_envelope(measurement, n_traces, sample_start, sample_stop)
+            traces = measurement.traces[:n_plotted, envelope.samples[0]:envelope.samples[-1] + 1] if n_plotted else None
+            plot_envelope(envelope, str(measurement.trace_path), traces=traces)
+        case "correlate":
+            if len(sys.argv) < 4:
+                print(usage)
+                exit()
+            attack_mode = sys.argv[4] if len(sys.argv) >= 5 else "lrnd"
+            n_traces = int(sys.argv[5]) if len(sys.argv) >= 6 else 0
+            encryption_key = list(bytes.fromhex(sys.argv[6])) if len(sys.argv) >= 7 else None
+            measurement = open_measurement(sys.argv[2], encryption_key)
+            correlation = save_correlation(measurement, sys.argv[3], attack_mode, n_traces)
+            key = attacked_key(measurement, attack_mode)
+            if key is not None:
+                print(f"Attacked key: {bytes(key).hex().upper()}")
+            plot_correlation(correlation, key)
+        case "correlation":
+            key = np.frombuffer(bytes.fromhex(sys.argv[3]), dtype=np.uint8) if len(sys.argv) >= 4 else None
+            plot_correlation(load_correlation(sys.argv[2]), key)
+
+
+if __name__ == "__main__":
+    main()